@@ -0,0 +1,251 @@
+import argparse
+import csv
+import json
+import logging
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Rows read per query while exporting
+EXPORT_BATCH_SIZE = 1000
+
+# Source rows counted per rollup transaction
+ROLLUP_BATCH_SIZE = 5000
+
+# Exported columns per table
+EXPORT_COLUMNS = {
+    'users': (
+        'id', 'telegram_id', 'username', 'first_name', 'last_name', 'tokens',
+        'created_at', 'last_access', 'trial_expires_at', 'trial_expired'
+    ),
+    'payments': ('id', 'user_id', 'amount', 'tokens', 'payment_date', 'reference'),
+}
+
+DAILY_STATS_COLUMNS = ('day', 'signups', 'active_users', 'searches', 'tokens_sold', 'revenue')
+
+class Analytics:
+    """Exports the hot tables for reporting and keeps per-day rollups of them
+
+    Exports read in pages by id, each its own short query, so memory stays
+    constant and no long read holds back WAL checkpoints. Rollups count only
+    the rows added since the last run: every source table has a watermark in
+    bot_state, the last id already counted. Ids are handed out by one writer
+    at a time, so rows never commit below a watermark. Days are UTC, as
+    CURRENT_TIMESTAMP stores them.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def rows(self, table, batch_size=EXPORT_BATCH_SIZE):
+        """Yield every row of an exported table in id order, one page at a time"""
+        columns = EXPORT_COLUMNS[table]
+        conn = self.db.get_connection()
+        after_id = 0
+        while True:
+            page = conn.execute(f'''
+                SELECT {', '.join(columns)} FROM {table}
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after_id, batch_size)).fetchall()
+            yield from page
+            if len(page) < batch_size:
+                return
+            after_id = page[-1][0]
+
+    def export(self, table, out, fmt='csv', batch_size=EXPORT_BATCH_SIZE):
+        """Write a table to a text file as CSV with a header or as JSON lines; returns the row count"""
+        columns = EXPORT_COLUMNS[table]
+        exported = 0
+        if fmt == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for row in self.rows(table, batch_size):
+                writer.writerow(row)
+                exported += 1
+        elif fmt == 'jsonl':
+            for row in self.rows(table, batch_size):
+                out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+                exported += 1
+        else:
+            raise ValueError(f"Unsupported format: {fmt!r} (expected csv or jsonl)")
+        return exported
+
+    def _watermark(self, cursor, key):
+        cursor.execute('SELECT value FROM bot_state WHERE key = ?', (key,))
+        return cursor.fetchone()[0]
+
+    def _add(self, cursor, day, **counts):
+        """Add counts to a day's totals"""
+        columns = ', '.join(counts)
+        updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in counts)
+        cursor.execute(f'''
+            INSERT INTO daily_stats (day, {columns}) VALUES (?, {', '.join('?' * len(counts))})
+            ON CONFLICT (day) DO UPDATE SET {updates}
+        ''', (day, *counts.values()))
+
+    def _roll_signups(self, cursor, batch_size):
+        cursor.execute('''
+            WITH batch AS (
+                SELECT id, created_at FROM users
+                WHERE id > ? ORDER BY id LIMIT ?
+            )
+            SELECT date(created_at), COUNT(*), MAX(id) FROM batch GROUP BY 1
+        ''', (self._watermark(cursor, 'rollup_users'), batch_size))
+
+        counted = 0
+        for day, signups, last_id in cursor.fetchall():
+            self._add(cursor, day, signups=signups)
+            cursor.execute("UPDATE bot_state SET value = MAX(value, ?) WHERE key = 'rollup_users'", (last_id,))
+            counted += signups
+        return counted
+
+    def _roll_searches(self, cursor, batch_size):
+        watermark = self._watermark(cursor, 'rollup_ledger')
+        cursor.execute('''
+            WITH batch AS (
+                SELECT id FROM token_ledger
+                WHERE id > ? AND reason = 'search' ORDER BY id LIMIT ?
+            )
+            SELECT COUNT(*), MAX(id) FROM batch
+        ''', (watermark, batch_size))
+        counted, last_id = cursor.fetchone()
+        if not counted:
+            return 0
+
+        # A user counts as active once a day, however many searches they run: the batch's
+        # first search of theirs that day counts unless an earlier run counted one. The
+        # earlier ones are looked up in idx_token_ledger_user, so a row that arrives late
+        # for a day rolled up long ago is not counted again
+        cursor.execute('''
+            WITH searches AS (
+                SELECT user_id, date(created_at) AS day FROM token_ledger
+                WHERE id > :watermark AND id <= :last_id AND reason = 'search'
+            )
+            SELECT day, COUNT(*), (
+                SELECT COUNT(*) FROM (SELECT DISTINCT user_id FROM searches s WHERE s.day = daily.day) active
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM token_ledger counted
+                    WHERE counted.user_id = active.user_id AND counted.id <= :watermark
+                      AND counted.reason = 'search' AND date(counted.created_at) = daily.day
+                )
+            )
+            FROM searches daily GROUP BY day
+        ''', {'watermark': watermark, 'last_id': last_id})
+
+        for day, searches, active_users in cursor.fetchall():
+            self._add(cursor, day, searches=searches, active_users=active_users)
+
+        cursor.execute("UPDATE bot_state SET value = ? WHERE key = 'rollup_ledger'", (last_id,))
+        return counted
+
+    def _roll_payments(self, cursor, batch_size):
+        cursor.execute('''
+            WITH batch AS (
+                SELECT id, payment_date, tokens, amount FROM payments
+                WHERE id > ? ORDER BY id LIMIT ?
+            )
+            SELECT date(payment_date), COUNT(*), SUM(tokens), SUM(amount), MAX(id) FROM batch GROUP BY 1
+        ''', (self._watermark(cursor, 'rollup_payments'), batch_size))
+
+        counted = 0
+        for day, payments, tokens, amount, last_id in cursor.fetchall():
+            self._add(cursor, day, tokens_sold=tokens, revenue=amount)
+            cursor.execute("UPDATE bot_state SET value = MAX(value, ?) WHERE key = 'rollup_payments'", (last_id,))
+            counted += payments
+        return counted
+
+    def update_rollups(self, batch_size=ROLLUP_BATCH_SIZE):
+        """Count the rows added since the last run into daily_stats; returns the number counted
+
+        Each transaction counts at most batch_size rows per source table and
+        moves the watermarks with them, so an interrupted run loses nothing
+        and counts nothing twice.
+        """
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        counted = 0
+
+        while True:
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                rolled = [
+                    self._roll_signups(cursor, batch_size),
+                    self._roll_searches(cursor, batch_size),
+                    self._roll_payments(cursor, batch_size)
+                ]
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+            counted += sum(rolled)
+            if all(rows < batch_size for rows in rolled):
+                return counted
+
+    def daily(self, start, end):
+        """Return the rolled up totals for start <= day < end, oldest first"""
+        cursor = self.db.get_connection().execute(f'''
+            SELECT {', '.join(DAILY_STATS_COLUMNS)} FROM daily_stats
+            WHERE day >= ? AND day < ? ORDER BY day
+        ''', (str(start), str(end)))
+        return [dict(zip(DAILY_STATS_COLUMNS, row)) for row in cursor.fetchall()]
+
+def main() -> None:
+    """Export tables, update the rollups or print recent days from the command line."""
+    parser = argparse.ArgumentParser(description="Reporting exports and daily rollups")
+    parser.add_argument('--db', default=config.DATABASE_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help="stream a table to CSV or JSON lines")
+    export_parser.add_argument('table', choices=sorted(EXPORT_COLUMNS))
+    export_parser.add_argument('--output', help="file to write (default: standard output)")
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'],
+                               help="defaults to the output file extension, else csv")
+    export_parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+
+    rollup_parser = commands.add_parser('rollup', help="count new rows into the daily totals")
+    rollup_parser.add_argument('--batch-size', type=int, default=ROLLUP_BATCH_SIZE)
+
+    report_parser = commands.add_parser('report', help="print the daily totals as CSV")
+    report_parser.add_argument('--days', type=int, default=30)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    db = Database(args.db)
+    analytics = Analytics(db)
+    try:
+        if args.command == 'export':
+            fmt = args.format or ('jsonl' if args.output and args.output.endswith('.jsonl') else 'csv')
+            started = time.monotonic()
+            if args.output:
+                with open(args.output, 'w', newline='', encoding='utf-8') as out:
+                    exported = analytics.export(args.table, out, fmt, args.batch_size)
+            else:
+                exported = analytics.export(args.table, sys.stdout, fmt, args.batch_size)
+            logger.info("Exported %s %s rows in %.1fs", exported, args.table, time.monotonic() - started)
+        elif args.command == 'rollup':
+            started = time.monotonic()
+            counted = analytics.update_rollups(args.batch_size)
+            logger.info("Counted %s new rows in %.1fs", counted, time.monotonic() - started)
+        else:
+            today = date(*time.gmtime()[:3])
+            writer = csv.writer(sys.stdout)
+            writer.writerow(DAILY_STATS_COLUMNS)
+            for day in analytics.daily(today - timedelta(days=args.days - 1), today + timedelta(days=1)):
+                writer.writerow(day.values())
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import logging
+import time
+
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Users moved per transaction
+ARCHIVE_BATCH_SIZE = 500
+
+# Free pages handed back to the file system per step, and the pause between steps (seconds)
+VACUUM_STEP_PAGES = 1000
+VACUUM_STEP_PAUSE = 0.05
+
+def archive_cold_users(db, days=config.ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, pause=0.0):
+    """Move users who have been cold for days into the archive database, batch by batch
+
+    A cold user's trial ended, and they have neither visited nor paid, more
+    than days ago. Their payments and ledger entries go with them, and
+    they are restored as soon as they come back. Returns the number of users
+    archived.
+    """
+    age = f'-{days} days'
+    # Visits still buffered in memory count
+    db.flush_last_access()
+    # Users restored just before a crash may still have a copy here
+    purged = db.purge_restored_copies()
+    if purged:
+        logger.info("Deleted %s archive copies of restored users", purged)
+
+    archived = 0
+    after_id = 0
+    while True:
+        user_ids = db.find_cold_users(age, after_id, batch_size)
+        if not user_ids:
+            return archived
+        archived += db.archive_users(user_ids, age)
+        after_id = user_ids[-1]
+        logger.info("Archived %s users so far", archived)
+        time.sleep(pause)
+
+def compact(db, step_pages=VACUUM_STEP_PAGES, step_pause=VACUUM_STEP_PAUSE):
+    """Give the free pages of the live database back to the file system
+
+    Freed pages are released with incremental vacuum, step_pages at a time
+    in short write transactions. A database created before incremental
+    auto-vacuum is switched over with one full VACUUM, during which writers
+    wait. Returns page counts before and after, and the duration.
+    """
+    conn = db.get_connection()
+    started = time.perf_counter()
+    before = conn.execute('PRAGMA main.page_count').fetchone()[0]
+
+    if conn.execute('PRAGMA main.auto_vacuum').fetchone()[0] != 2:
+        logger.warning("Switching %s to incremental auto-vacuum with a full VACUUM", db.db_path)
+        conn.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM main')
+    else:
+        free = conn.execute('PRAGMA main.freelist_count').fetchone()[0]
+        while free:
+            conn.execute(f'PRAGMA main.incremental_vacuum({int(step_pages)})').fetchall()
+            remaining = conn.execute('PRAGMA main.freelist_count').fetchone()[0]
+            if remaining >= free:
+                break
+            free = remaining
+            time.sleep(step_pause)
+
+    # In WAL mode the file only shrinks once the log is checkpointed
+    conn.execute('PRAGMA main.wal_checkpoint(TRUNCATE)').fetchone()
+    after = conn.execute('PRAGMA main.page_count').fetchone()[0]
+
+    return {'pages_before': before, 'pages_after': after, 'seconds': time.perf_counter() - started}
+
+def main() -> None:
+    """Archive cold users and compact the database from the command line."""
+    parser = argparse.ArgumentParser(description="Move cold users to the archive database and compact the live one")
+    parser.add_argument('--db', default=config.DATABASE_PATH)
+    parser.add_argument('--archive', default=config.ARCHIVE_PATH,
+                        help="archive database; the bot must use the same ARCHIVE_PATH to restore users")
+    parser.add_argument('--days', type=int, default=config.ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--no-compact', action='store_true', help="skip the incremental vacuum")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    if not args.archive:
+        raise SystemExit("ARCHIVE_PATH is not set")
+
+    db = Database(args.db, archive_path=args.archive)
+    try:
+        started = time.monotonic()
+        archived = archive_cold_users(db, args.days, args.batch_size)
+        logger.info("Archived %s users in %.1fs", archived, time.monotonic() - started)
+
+        if not args.no_compact:
+            result = compact(db)
+            logger.info(
+                "Compacted %s from %s to %s pages in %.1fs",
+                args.db, result['pages_before'], result['pages_after'], result['seconds']
+            )
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
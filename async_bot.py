@@ -0,0 +1,415 @@
+import asyncio
+import functools
+import logging
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from telegram import Update
+
+import bot
+import config
+import metrics
+from bot_api import API_BASE_URL, AsyncBotApi, TelegramApiError
+from webhook import WebhookServer, webhook_secret
+
+logger = logging.getLogger(__name__)
+
+class AsyncContext:
+    """Per-update context handed to coroutine handlers, like PTB's CallbackContext"""
+
+    def __init__(self, runtime, args=None):
+        self.runtime = runtime
+        self.bot = runtime.api
+        self.args = args or []
+
+    async def run_db(self, func, *args, **kwargs):
+        """Run a blocking Database call on the dedicated executor"""
+        return await self.runtime.run_db(func, *args, **kwargs)
+
+async def reply(update: Update, context: AsyncContext, text: str, reply_markup=None) -> None:
+    """Reply to the message in update without blocking the event loop."""
+    await context.bot.send_message(update.effective_chat.id, text, reply_markup=reply_markup)
+
+async def start(update: Update, context: AsyncContext) -> None:
+    """Send a message when the command /start is issued."""
+    user = update.effective_user
+    db_user = await context.run_db(bot.get_or_create_user, user)
+    await reply(update, context, bot.welcome_text(user.first_name, db_user['tokens']))
+
+async def help_command(update: Update, context: AsyncContext) -> None:
+    """Send a message when the command /help is issued."""
+    await reply(update, context, bot.HELP_TEXT)
+
+async def search_command(update: Update, context: AsyncContext) -> None:
+    """Handle the /search command."""
+    charge = await context.run_db(bot.get_db().charge_search, **bot.search_charge(update))
+
+    if not charge['is_active']:
+        await reply(update, context, bot.TRIAL_EXPIRED_TEXT)
+        return
+
+    if not charge['charged']:
+        await reply(update, context, bot.NO_TOKENS_TEXT)
+        return
+
+    pages = await context.run_db(bot.get_search_pages, ' '.join(context.args))
+
+    text, keyboard, attachments = bot.search_reply(update.effective_user.id, charge, pages)
+    await reply(update, context, text, reply_markup=keyboard)
+    await send_attachments(context, update.effective_chat.id, attachments)
+
+async def send_attachment(context: AsyncContext, chat_id: int, attachment, file):
+    """Send one attachment as a photo or document and return its Telegram file_id."""
+    message = await context.bot.send_file(attachment.kind, chat_id, file, filename=os.path.basename(attachment.name))
+    if attachment.kind == 'photo':
+        return message['photo'][-1]['file_id']
+    return message['document']['file_id']
+
+async def send_attachments(context: AsyncContext, chat_id: int, attachments: tuple) -> None:
+    """Send the files of a page of search results, uploading each one only once."""
+    store = bot.get_attachments()
+    for name in attachments:
+        try:
+            await store.send_async(name, functools.partial(send_attachment, context, chat_id), context.run_db)
+        except (OSError, ValueError, aiohttp.ClientError, asyncio.TimeoutError, TelegramApiError) as error:
+            logger.warning("Could not send attachment %s: %s", name, error)
+
+async def profile_command(update: Update, context: AsyncContext) -> None:
+    """Handle the /profile command."""
+    db_user, token_status = await context.run_db(bot.get_profile, update.effective_user)
+
+    await reply(
+        update, context,
+        bot.profile_text(db_user, token_status),
+        reply_markup=bot.profile_keyboard()
+    )
+
+async def button_handler(update: Update, context: AsyncContext) -> None:
+    """Handle button presses."""
+    query = update.callback_query
+
+    if query.data == "recharge":
+        await context.bot.answer_callback_query(query.id)
+        await context.bot.edit_message_text(
+            query.message.chat.id,
+            query.message.message_id,
+            bot.PAYMENT_OPTIONS_TEXT
+        )
+    elif query.data.startswith("page:"):
+        # Turn the page from the cursor; nothing is searched or charged again
+        page = bot.search_page_reply(query.from_user.id, query.data)
+        if page is None:
+            await context.bot.answer_callback_query(query.id, bot.SEARCH_EXPIRED_TEXT)
+            return
+        await context.bot.answer_callback_query(query.id)
+        text, keyboard, attachments = page
+        await context.bot.edit_message_text(
+            query.message.chat.id,
+            query.message.message_id,
+            text,
+            reply_markup=keyboard
+        )
+        await send_attachments(context, query.message.chat.id, attachments)
+    else:
+        await context.bot.answer_callback_query(query.id)
+
+async def buy_tokens(update: Update, context: AsyncContext, amount: int, price: int) -> None:
+    """Handle token purchase."""
+    db_user = await context.run_db(bot.get_db().get_user, update.effective_user.id)
+    if not db_user:
+        await reply(update, context, bot.USER_NOT_FOUND_TEXT)
+        return
+    await context.run_db(bot.get_db().update_last_access, db_user['id'])
+
+    payment_info = bot.get_payment_handler().generate_payment_info(db_user['id'], amount, price)
+
+    await reply(update, context, payment_info)
+
+async def stats_command(update: Update, context: AsyncContext) -> None:
+    """Handle the admin-only /stats command."""
+    if not bot.is_admin(update.effective_user):
+        return
+
+    await reply(update, context, bot.stats_text())
+
+COMMANDS = {
+    'start': start,
+    'help': help_command,
+    'search': search_command,
+    'profile': profile_command,
+    'stats': stats_command,
+}
+
+for _command, (_amount, _price) in bot.BUY_OPTIONS.items():
+    COMMANDS[_command] = functools.partial(buy_tokens, amount=_amount, price=_price)
+
+# Time every handler like the sync runtime does
+COMMANDS = {command: metrics.timed_handler(command, handler) for command, handler in COMMANDS.items()}
+timed_button_handler = metrics.timed_handler('button', button_handler)
+
+def parse_command(update: Update):
+    """Return the command a message starts with, without '/' or '@botname', and its arguments"""
+    message = update.message
+    if not message or not message.text or not message.text.startswith('/'):
+        return None, []
+
+    command, *args = message.text.split()
+    return command[1:].split('@')[0], args
+
+class AsyncRuntime:
+    """Polls for updates and runs coroutine handlers with Database work on a bounded executor"""
+
+    def __init__(self, api, db, db_workers=config.DB_EXECUTOR_WORKERS,
+                 max_concurrent_updates=config.ASYNC_MAX_CONCURRENT_UPDATES, flood_control=None, tracker=None):
+        self.api = api
+        self.db = db
+        self.flood_control = flood_control
+        # Drops redelivered updates and commits the offset of handled ones
+        self.tracker = tracker
+        self._catching_up = False
+        self.executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='db')
+        self.max_concurrent_updates = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._tasks = set()
+        self._stopping = None
+
+    async def run_db(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def allow(self, update: Update) -> bool:
+        """Whether an update is within its user's flood limit"""
+        user = update.effective_user
+        return not (self.flood_control and user and not self.flood_control.allow(user.id))
+
+    async def dispatch(self, update: Update) -> None:
+        """Route an update to its handler"""
+        # A catch-up applies the flood limit itself
+        if not self._catching_up and not self.allow(update):
+            # Otherwise the pressed button spins until Telegram gives up on it
+            if update.callback_query:
+                try:
+                    await self.api.answer_callback_query(update.callback_query.id, bot.FLOOD_TEXT)
+                except (aiohttp.ClientError, asyncio.TimeoutError, TelegramApiError) as error:
+                    logger.warning("Could not answer a throttled callback query: %s", error)
+            return
+
+        if update.callback_query:
+            await timed_button_handler(update, AsyncContext(self))
+            return
+
+        command, args = parse_command(update)
+        handler = COMMANDS.get(command)
+        if handler:
+            await handler(update, AsyncContext(self, args))
+
+    async def process_update(self, data: dict) -> None:
+        """Parse and dispatch one raw update, logging handler errors"""
+        update_id = data.get('update_id')
+        # A catch-up claims its batch itself
+        if self.tracker and not self._catching_up and not self.tracker.begin(update_id):
+            return
+
+        try:
+            await self.dispatch(Update.de_json(data, None))
+        except Exception:
+            logger.exception("Error while handling update %s", update_id)
+        finally:
+            if self.tracker and self.tracker.finish(update_id) and not self._catching_up:
+                await self.run_db(self.tracker.commit)
+
+    async def submit(self, data: dict) -> None:
+        """Schedule an update, waiting while too many are already in flight"""
+        await self._slots.acquire()
+        task = asyncio.create_task(self.process_update(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def catch_up(self, batch_size=config.CATCH_UP_BATCH_SIZE) -> int:
+        """Drain the updates that queued up while the bot was down, one batch at a time
+
+        Every search in a batch is charged in one transaction before the
+        handlers run, and the offset is committed once per batch. Returns the
+        number of updates handled.
+        """
+        handled = 0
+        self._catching_up = True
+        # No offset at first: it would confirm updates whose ids Telegram restarted below it
+        offset = None
+        try:
+            while True:
+                try:
+                    updates = await self.api.get_updates(offset=offset, timeout=0, limit=batch_size)
+                except (aiohttp.ClientError, asyncio.TimeoutError, TelegramApiError) as error:
+                    # Polling picks up whatever is left
+                    logger.warning("Catch-up stopped: %s", error)
+                    break
+
+                admitted = []
+                for data in updates:
+                    if not self.tracker.begin(data['update_id']):
+                        continue
+                    update = Update.de_json(data, None)
+                    if not self.allow(update):
+                        self.tracker.finish(data['update_id'])
+                        continue
+                    admitted.append((data, update))
+
+                searches = [bot.search_charge(update) for _, update in admitted if parse_command(update)[0] == 'search']
+                if searches:
+                    await self.run_db(self.db.charge_searches, searches)
+
+                for data, _ in admitted:
+                    await self.submit(data)
+                if self._tasks:
+                    await asyncio.gather(*self._tasks, return_exceptions=True)
+                await self.run_db(self.tracker.commit)
+                handled += len(admitted)
+                offset = self.tracker.offset + 1
+
+                if len(updates) < batch_size:
+                    break
+        finally:
+            self._catching_up = False
+
+        return handled
+
+    async def poll(self, offset=None) -> None:
+        """Long-poll getUpdates from offset until stopped
+
+        Without an offset the first batch is whatever Telegram still holds,
+        and the tracker drops what was handled already.
+        """
+        while not self._stopping.is_set():
+            try:
+                updates = await self.api.get_updates(offset=offset)
+            except (aiohttp.ClientError, asyncio.TimeoutError, TelegramApiError) as error:
+                logger.warning("getUpdates failed: %s", error)
+                await asyncio.sleep(1)
+                continue
+
+            for data in updates:
+                offset = data['update_id'] + 1
+                await self.submit(data)
+
+    async def every(self, interval, func, *args) -> None:
+        """Run a blocking Database call every interval seconds until stopped, logging its errors"""
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                try:
+                    await self.run_db(func, *args)
+                except Exception:
+                    logger.exception("Periodic %s failed", func.__name__)
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def run(self, updates=None) -> None:
+        """Serve updates from getUpdates (or from the given async iterator) until stopped"""
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        periodic = [
+            # Write out buffered last_access updates
+            asyncio.create_task(self.every(config.LAST_ACCESS_FLUSH_INTERVAL, self.db.flush_last_access)),
+            # Mark ended trials expired, which drops them from the partial index on trial_expires_at
+            asyncio.create_task(self.every(config.TRIAL_SWEEP_INTERVAL, bot.sweep_trials, self.db))
+        ]
+
+        try:
+            if updates is None:
+                offset = None
+                if self.tracker and config.CATCH_UP:
+                    started = loop.time()
+                    handled = await self.catch_up()
+                    logger.info("Caught up on %s updates in %.1f s", handled, loop.time() - started)
+                    # Resume after the last handled update rather than whatever Telegram still holds
+                    offset = self.tracker.offset + 1
+                poller = asyncio.create_task(self.poll(offset))
+                await self._stopping.wait()
+                poller.cancel()
+            else:
+                async for data in updates:
+                    await self.submit(data)
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._stopping.set()
+            await asyncio.gather(*periodic)
+            await self.shutdown()
+
+    async def shutdown(self) -> None:
+        """Flush buffered writes and release the executor and HTTP session"""
+        await self.run_db(self.db.close)
+        self.executor.shutdown(wait=True)
+        await self.api.close()
+
+async def drain(queue: asyncio.Queue):
+    """Yield updates put on queue until a None sentinel arrives."""
+    while True:
+        data = await queue.get()
+        if data is None:
+            return
+        yield data
+
+def run(token: str, base_url: str = API_BASE_URL) -> None:
+    """Run the bot in asyncio mode until SIGINT or SIGTERM."""
+    async def main():
+        runtime = AsyncRuntime(
+            AsyncBotApi(token, base_url), bot.get_db(),
+            flood_control=bot.flood_control, tracker=bot.get_update_tracker()
+        )
+        loop = asyncio.get_running_loop()
+        server = None
+        updates = None
+
+        if config.UPDATE_MODE == 'webhook':
+            secret_token = webhook_secret(config.WEBHOOK_SECRET, config.WEBHOOK_URL)
+            queue = asyncio.Queue()
+            server = WebhookServer(
+                lambda data: loop.call_soon_threadsafe(queue.put_nowait, data),
+                host=config.WEBHOOK_LISTEN,
+                port=config.WEBHOOK_PORT,
+                path=config.WEBHOOK_PATH,
+                secret_token=secret_token
+            )
+            updates = drain(queue)
+
+        def stop():
+            runtime.stop()
+            if server is not None:
+                queue.put_nowait(None)
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop)
+
+        if server is not None:
+            server.start()
+            if config.WEBHOOK_URL:
+                await runtime.api.call('setWebhook', {
+                    'url': config.WEBHOOK_URL,
+                    'secret_token': secret_token
+                })
+
+        metrics_server = bot.start_metrics_server()
+        backups = bot.start_backups()
+        try:
+            await runtime.run(updates)
+        finally:
+            if server is not None:
+                server.stop()
+            if metrics_server is not None:
+                metrics_server.stop()
+            if backups is not None:
+                backups.stop()
+            logger.info("Flood control stats: %s", bot.flood_control.stats())
+            logger.info("Update tracking stats: %s", runtime.tracker.stats())
+
+    asyncio.run(main())
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from collections import namedtuple
+
+import config
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Sent with sendPhoto; every other file goes out with sendDocument
+PHOTO_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+# How long a sender waits for someone else's upload of the same file (seconds)
+UPLOAD_WAIT = 60
+
+# Hashes of files on disk, remembered by path, size and modification time
+HASH_CACHE_SIZE = 1024
+
+# Part of the error Telegram returns for a file_id it no longer accepts
+STALE_FILE_ID_ERROR = 'file identifier'
+
+Attachment = namedtuple('Attachment', 'name path sha256 kind size')
+
+def attachment_kind(name):
+    """Return 'photo' or 'document', the Bot API field a file is sent as"""
+    return 'photo' if os.path.splitext(name)[1].lower() in PHOTO_EXTENSIONS else 'document'
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class AttachmentStore:
+    """Uploads each attachment to Telegram once and reuses its file_id
+
+    file_ids are stored by content hash in the telegram_files table, so a
+    file renamed or shared by several catalog entries is uploaded once, and
+    a changed file is uploaded again. Senders that want a file while it is
+    being uploaded wait for that upload instead of starting another one.
+    """
+
+    def __init__(self, db, directory=config.ATTACHMENTS_DIR):
+        self.db = db
+        self.directory = directory
+        self._file_ids = {}
+        self._hashes = LRUCache(maxsize=HASH_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self._uploads = {}
+        self._async_uploads = {}
+        self.uploaded = 0
+        self.reused = 0
+        self.waited = 0
+
+    def resolve(self, name):
+        """Return the Attachment for a file name under the attachments directory"""
+        path = os.path.join(self.directory, name)
+        # Names come from the catalog; never read outside the directory
+        if os.path.commonpath([os.path.abspath(path), os.path.abspath(self.directory)]) != os.path.abspath(self.directory):
+            raise ValueError(f"Attachment outside {self.directory}: {name!r}")
+
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        sha256 = self._hashes.get(key)
+        if sha256 is None:
+            sha256 = file_sha256(path)
+            self._hashes.set(key, sha256)
+        return Attachment(name, path, sha256, attachment_kind(name), stat.st_size)
+
+    def file_id(self, attachment):
+        """Return the stored file_id for an attachment's content, or None"""
+        file_id = self._file_ids.get(attachment.sha256)
+        if file_id is None:
+            cursor = self.db.get_connection().execute('''
+                SELECT file_id FROM telegram_files WHERE sha256 = ? AND kind = ?
+            ''', (attachment.sha256, attachment.kind))
+            row = cursor.fetchone()
+            if row:
+                file_id = self._file_ids[attachment.sha256] = row[0]
+        return file_id
+
+    def remember(self, attachment, file_id):
+        """Store the file_id Telegram returned for an upload"""
+        conn = self.db.get_connection()
+        conn.execute('''
+            INSERT INTO telegram_files (sha256, kind, file_id, size) VALUES (?, ?, ?, ?)
+            ON CONFLICT (sha256) DO UPDATE SET
+                kind = excluded.kind, file_id = excluded.file_id, uploaded_at = CURRENT_TIMESTAMP
+        ''', (attachment.sha256, attachment.kind, file_id, attachment.size))
+        conn.commit()
+        self._file_ids[attachment.sha256] = file_id
+
+    def forget(self, attachment):
+        """Drop a file_id Telegram no longer accepts, so the next send uploads again"""
+        self._file_ids.pop(attachment.sha256, None)
+        conn = self.db.get_connection()
+        conn.execute('DELETE FROM telegram_files WHERE sha256 = ?', (attachment.sha256,))
+        conn.commit()
+
+    def send(self, name, deliver):
+        """Send an attachment from a thread, uploading it only if no file_id is known
+
+        deliver(attachment, file) sends file, a file_id or an open file,
+        and returns the file_id of the sent message.
+        """
+        attachment = self.resolve(name)
+        while True:
+            file_id = self.file_id(attachment)
+            if file_id is not None:
+                try:
+                    file_id = deliver(attachment, file_id)
+                except Exception as error:
+                    if STALE_FILE_ID_ERROR not in str(error):
+                        raise
+                    self.forget(attachment)
+                    continue
+                self.reused += 1
+                return file_id
+
+            with self._lock:
+                upload = self._uploads.get(attachment.sha256)
+                if upload is None:
+                    upload = self._uploads[attachment.sha256] = threading.Event()
+                    break
+
+            # Someone else is uploading it: use their file_id, or take over if they failed
+            self.waited += 1
+            upload.wait(UPLOAD_WAIT)
+
+        try:
+            with open(attachment.path, 'rb') as f:
+                file_id = deliver(attachment, f)
+            self.remember(attachment, file_id)
+            self.uploaded += 1
+            return file_id
+        finally:
+            with self._lock:
+                del self._uploads[attachment.sha256]
+            upload.set()
+
+    async def send_async(self, name, deliver, run_db):
+        """Send an attachment from the event loop; like send, with blocking work on run_db
+
+        deliver(attachment, file) is a coroutine; file is a file_id or the
+        file's bytes.
+        """
+        attachment = await run_db(self.resolve, name)
+        while True:
+            file_id = await run_db(self.file_id, attachment)
+            if file_id is not None:
+                try:
+                    file_id = await deliver(attachment, file_id)
+                except Exception as error:
+                    if STALE_FILE_ID_ERROR not in str(error):
+                        raise
+                    await run_db(self.forget, attachment)
+                    continue
+                self.reused += 1
+                return file_id
+
+            upload = self._async_uploads.get(attachment.sha256)
+            if upload is None:
+                upload = self._async_uploads[attachment.sha256] = asyncio.get_running_loop().create_future()
+                break
+
+            # Someone else is uploading it: use their file_id, or take over if they failed
+            self.waited += 1
+            await asyncio.wait({upload}, timeout=UPLOAD_WAIT)
+
+        try:
+            content = await run_db(self._read, attachment)
+            file_id = await deliver(attachment, content)
+            await run_db(self.remember, attachment, file_id)
+            self.uploaded += 1
+            return file_id
+        finally:
+            del self._async_uploads[attachment.sha256]
+            upload.set_result(None)
+
+    @staticmethod
+    def _read(attachment):
+        with open(attachment.path, 'rb') as f:
+            return f.read()
+
+    def stats(self):
+        """Return upload counters"""
+        return {'uploaded': self.uploaded, 'reused': self.reused, 'waited': self.waited}
@@ -0,0 +1,212 @@
+import argparse
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+import config
+
+logger = logging.getLogger(__name__)
+
+class BackupError(Exception):
+    """A snapshot failed its integrity check"""
+
+def snapshots(db_path, directory):
+    """Return the snapshots of a database in directory, oldest first"""
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    # Timestamps in the names sort in time order; the digits keep users-archive-* out of users-*
+    return sorted(glob.glob(os.path.join(directory, f'{stem}-{"[0-9]" * 8}-*.db')))
+
+def _copy(source, name, path, step_pages, step):
+    """Copy one database of source into a new file at path, verified, and return its page count"""
+    partial = path + '.partial'
+    progress = {'pages': 0}
+
+    def count(status, remaining, total):
+        progress['pages'] = total
+        step()
+
+    target = sqlite3.connect(partial)
+    try:
+        source.backup(target, pages=step_pages, progress=count, name=name)
+
+        # A snapshot is one self-contained file
+        target.execute('PRAGMA journal_mode = DELETE')
+        check = target.execute('PRAGMA integrity_check').fetchall()
+        if check != [('ok',)]:
+            raise BackupError(f"Integrity check of {path} failed: {check[:5]}")
+    except BaseException:
+        target.close()
+        os.remove(partial)
+        raise
+    target.close()
+
+    os.replace(partial, path)
+    return progress['pages']
+
+def backup(db_path, directory=config.BACKUP_DIR, keep=config.BACKUP_KEEP,
+           step_pages=config.BACKUP_STEP_PAGES, step_pause=config.BACKUP_STEP_PAUSE, archive_path=None):
+    """Copy a live database into a new verified snapshot and drop the oldest beyond keep
+
+    The copy is made with SQLite's online backup API, step_pages pages at a
+    time with a step_pause (seconds) pause between steps. It reads one
+    snapshot of the database inside a read transaction, so writers carry on
+    in WAL mode and never force the copy to start over. With archive_path,
+    the archive database gets a snapshot of its own, read at the same moment
+    as the live one, so a user being moved between them is in at least one.
+    Returns the paths, page count, duration and pages per second.
+    """
+    if keep < 1:
+        raise ValueError(f"keep must be at least 1, not {keep}")
+
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S-%f')
+    databases = [('main', db_path)] + ([('archive', archive_path)] if archive_path else [])
+    paths = {
+        name: os.path.join(directory, f"{os.path.splitext(os.path.basename(path))[0]}-{stamp}.db")
+        for name, path in databases
+    }
+
+    def step():
+        # Give handler threads the disk and the GIL between steps
+        time.sleep(step_pause)
+
+    started = time.perf_counter()
+    source = sqlite3.connect(db_path)
+    locker = None
+    try:
+        if archive_path:
+            source.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+            # Hold off writers to both files for a moment, so both snapshots start together
+            locker = sqlite3.connect(db_path)
+            locker.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+            locker.execute('BEGIN IMMEDIATE')
+
+        # Pin one snapshot: without it every commit elsewhere restarts the copy
+        source.execute('BEGIN')
+        for name, _ in databases:
+            source.execute(f'SELECT COUNT(*) FROM {name}.sqlite_master').fetchone()
+        if locker is not None:
+            locker.close()
+            locker = None
+
+        pages = sum(_copy(source, name, paths[name], step_pages, step) for name, _ in databases)
+    finally:
+        # Closing rolls back, letting writers in again
+        if locker is not None:
+            locker.close()
+        source.close()
+    seconds = time.perf_counter() - started
+
+    for _, path in databases:
+        for old in snapshots(path, directory)[:-keep]:
+            os.remove(old)
+
+    result = {
+        'path': paths['main'],
+        'pages': pages,
+        'seconds': seconds,
+        'pages_per_second': pages / seconds if seconds else 0.0
+    }
+    if archive_path:
+        result['archive_path'] = paths['archive']
+    return result
+
+class BackupScheduler:
+    """Backs up a database every interval seconds on a background thread
+
+    The first backup is due interval seconds after the newest snapshot, so
+    restarting the bot neither skips nor repeats one. options are passed on
+    to backup(), e.g. archive_path.
+    """
+
+    def __init__(self, db_path, interval=config.BACKUP_INTERVAL, directory=config.BACKUP_DIR, **options):
+        if options.get('keep', config.BACKUP_KEEP) < 1:
+            raise ValueError(f"keep must be at least 1, not {options.get('keep', config.BACKUP_KEEP)}")
+        self.db_path = db_path
+        self.interval = interval
+        self.directory = directory
+        self.options = options
+        self.runs = 0
+        self.failures = 0
+        self.last = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='backup', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def next_delay(self):
+        """Seconds until the next backup is due"""
+        existing = snapshots(self.db_path, self.directory)
+        if not existing:
+            return 0
+        return max(0, os.path.getmtime(existing[-1]) + self.interval - time.time())
+
+    def run_once(self):
+        """Make one backup, logging rather than raising failures"""
+        try:
+            self.last = backup(self.db_path, self.directory, **self.options)
+            self.runs += 1
+            logger.info(
+                "Backed up %s pages to %s in %.1f s (%.0f pages/s)",
+                self.last['pages'], self.last['path'], self.last['seconds'], self.last['pages_per_second']
+            )
+        except (sqlite3.Error, OSError, BackupError):
+            self.failures += 1
+            logger.exception("Backup of %s failed", self.db_path)
+
+    def _run(self):
+        delay = self.next_delay()
+        while not self._stopping.wait(delay):
+            self.run_once()
+            delay = self.interval
+
+    def stats(self):
+        """Return backup counters and the last backup's figures"""
+        stats = {'runs': self.runs, 'failures': self.failures}
+        if self.last:
+            stats.update(
+                last_pages=self.last['pages'],
+                last_seconds=self.last['seconds'],
+                last_pages_per_second=self.last['pages_per_second']
+            )
+        return stats
+
+def main() -> None:
+    """Back up the database once from the command line."""
+    parser = argparse.ArgumentParser(description="Make a verified online backup of the bot database")
+    parser.add_argument('--db', default=config.DATABASE_PATH)
+    parser.add_argument('--dir', default=config.BACKUP_DIR, help="where snapshots are kept")
+    parser.add_argument('--keep', type=int, default=config.BACKUP_KEEP, help="snapshots to keep, at least 1")
+    parser.add_argument('--archive', default=config.ARCHIVE_PATH, help="archive database to back up alongside")
+    parser.add_argument('--step-pages', type=int, default=config.BACKUP_STEP_PAGES)
+    parser.add_argument('--step-pause', type=float, default=config.BACKUP_STEP_PAUSE)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    if args.keep < 1:
+        parser.error("--keep must be at least 1")
+
+    result = backup(args.db, args.dir, args.keep, args.step_pages, args.step_pause, args.archive or None)
+    logger.info(
+        "Backed up %s pages to %s in %.1f s (%.0f pages/s)",
+        result['pages'], result['path'], result['seconds'], result['pages_per_second']
+    )
+
+if __name__ == '__main__':
+    main()
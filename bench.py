@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# config reads DATABASE_PATH on import and bot.get_db() opens it on first use;
+# point it at a scratch file before either is imported
+BENCH_DIR = tempfile.mkdtemp(prefix='bot-bench-')
+os.environ['DATABASE_PATH'] = os.path.join(BENCH_DIR, 'bench.db')
+
+from telegram import Update, User
+
+import bot
+
+# Queries cycled through by the search benchmark
+SEARCH_QUERIES = ['', 'манипуляция', 'влияние', 'психология убеждения', 'эмоции', 'контроль']
+
+class FakeBot:
+    """Records what handlers send instead of calling the Bot API"""
+
+    defaults = None
+
+    def __init__(self):
+        self.replies = 0
+        self._lock = threading.Lock()
+
+    def _record(self):
+        with self._lock:
+            self.replies += 1
+        return True
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        return self._record()
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, *args, **kwargs):
+        return self._record()
+
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        return True
+
+class BenchContext:
+    """The parts of CallbackContext the handlers use"""
+
+    def __init__(self, bot, args=None):
+        self.bot = bot
+        self.args = args or []
+
+class StatementCounter:
+    """Counts SQL statements run on every connection the Database opens"""
+
+    def __init__(self, db):
+        self.count = 0
+        self._lock = threading.Lock()
+        connect = db._connect
+
+        def traced_connect():
+            conn = connect()
+            conn.set_trace_callback(self._trace)
+            return conn
+
+        # Reopen pooled connections so each one is traced
+        db.close()
+        db._connect = traced_connect
+
+    def _trace(self, statement):
+        with self._lock:
+            self.count += 1
+
+def message_update(fake_bot, update_id, user_id, text):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'},
+            'text': text
+        }
+    }, fake_bot)
+
+def callback_update(fake_bot, update_id, user_id, data):
+    sender = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    return Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': sender,
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': 0,
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'profile'
+            }
+        }
+    }, fake_bot)
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def make_calls(fake_bot, users, requests):
+    """Build (handler, update, context) calls for each benchmarked handler, spread over users"""
+    def user_ids():
+        return [1 + i % users for i in range(requests)]
+
+    def messages(text, args=None):
+        return [
+            (message_update(fake_bot, i, user_id, text), BenchContext(fake_bot, args))
+            for i, user_id in enumerate(user_ids())
+        ]
+
+    return {
+        'start': (bot.start, messages('/start')),
+        'search_command': (bot.search_command, [
+            (message_update(fake_bot, i, user_id, '/search'),
+             BenchContext(fake_bot, SEARCH_QUERIES[i % len(SEARCH_QUERIES)].split()))
+            for i, user_id in enumerate(user_ids())
+        ]),
+        'profile_command': (bot.profile_command, messages('/profile')),
+        'buy_tokens': (bot.buy_10_command, messages('/buy_10')),
+        'button_handler': (bot.button_handler, [
+            (callback_update(fake_bot, i, user_id, 'recharge'), BenchContext(fake_bot))
+            for i, user_id in enumerate(user_ids())
+        ])
+    }
+
+def run_handler(handler, calls, concurrency, counter):
+    """Run every call on a thread pool and return throughput, latency and SQL counters"""
+    latencies = []
+    errors = 0
+
+    def timed(call):
+        update, context = call
+        started = time.perf_counter()
+        try:
+            handler(update, context)
+            failed = False
+        except Exception:
+            failed = True
+        return time.perf_counter() - started, failed
+
+    statements = counter.count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, failed in executor.map(timed, calls):
+            latencies.append(latency)
+            errors += failed
+    elapsed = time.perf_counter() - started
+    statements = counter.count - statements
+
+    latencies.sort()
+    return {
+        'requests': len(calls),
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(calls) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'sql_statements': statements,
+        'sql_per_request': round(statements / len(calls), 2) if calls else 0.0
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(users=200, requests=2000, concurrency=8, handlers=None):
+    """Benchmark the handlers in order against the scratch database and return the results"""
+    fake_bot = FakeBot()
+    counter = StatementCounter(bot.get_db())
+    calls = make_calls(fake_bot, users, requests)
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'users': users,
+        'requests': requests,
+        'concurrency': concurrency,
+        'handlers': {}
+    }
+
+    for name, (handler, handler_calls) in calls.items():
+        if handlers and name not in handlers:
+            continue
+        if name == 'search_command':
+            # Enough tokens that every search is served rather than refused
+            for user_id in range(1, users + 1):
+                db_user = bot.get_or_create_user(User(user_id, f'User{user_id}', False, username=f'user{user_id}'))
+                bot.get_db().add_tokens(db_user['id'], requests)
+        results['handlers'][name] = run_handler(handler, handler_calls, concurrency, counter)
+
+    bot.get_db().flush_last_access()
+    results['replies'] = fake_bot.replies
+    return results
+
+def compare(results, baseline):
+    """Print each handler's change in throughput and p95 against a previous run"""
+    print(f"Compared with {baseline.get('revision')} ({baseline.get('timestamp')}):")
+    for name, current in results['handlers'].items():
+        previous = baseline.get('handlers', {}).get(name)
+        if not previous:
+            continue
+        throughput = (current['throughput'] / previous['throughput'] - 1) * 100 if previous['throughput'] else 0
+        print(
+            f"  {name:16} throughput {throughput:+6.1f}%  "
+            f"p95 {previous['p95_ms']:.3f} -> {current['p95_ms']:.3f} ms  "
+            f"sql/request {previous['sql_per_request']} -> {current['sql_per_request']}"
+        )
+
+def main() -> None:
+    """Benchmark the handlers from the command line."""
+    parser = argparse.ArgumentParser(description="Benchmark bot handlers against a scratch database")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000, help="calls per handler")
+    parser.add_argument('--concurrency', type=int, default=8, help="threads calling handlers")
+    parser.add_argument('--handler', action='append', dest='handlers', help="only run this handler (repeatable)")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="results JSON of an earlier run")
+    args = parser.parse_args()
+
+    try:
+        results = run_benchmarks(args.users, args.requests, args.concurrency, args.handlers)
+    finally:
+        bot.close_db()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    for name, stats in results['handlers'].items():
+        print(
+            f"{name:16} {stats['throughput']:>9.1f} req/s  "
+            f"p50 {stats['p50_ms']:.3f}  p95 {stats['p95_ms']:.3f}  p99 {stats['p99_ms']:.3f} ms  "
+            f"{stats['sql_per_request']} sql/request  {stats['errors']} errors"
+        )
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,25 @@
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters
+from telegram.error import TelegramError
+from telegram.ext import (
+    Updater, CommandHandler, CallbackContext, CallbackQueryHandler, TypeHandler, DispatcherHandlerStop
+)
 from database import Database
-from payment import payment_handler
+from catalog import Catalog, SearchCache, SearchCursors
+from attachments import AttachmentStore
+from payment import PaymentHandler
+from ratelimit import FloodControl
+from offsets import UpdateTracker
+from backup import BackupScheduler
+import metrics
+from webhook import WebhookServer, webhook_secret
+import config
+import functools
 import os
+import signal
+import threading
+import time
+import warnings
 from datetime import datetime
 
 # Enable logging
@@ -14,61 +30,170 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Initialize database
-db = Database()
+# The database, payments and catalog are opened on first use, so importing this
+# module (from tests and tools) never touches DATABASE_PATH
+_db = None
+_payment_handler = None
+_search_cache = None
+_update_tracker = None
+_attachments = None
+_backups = None
+_db_lock = threading.Lock()
+
+def get_db() -> Database:
+    """Open the database on first use, applying pending migrations."""
+    global _db, _payment_handler, _search_cache, _update_tracker, _attachments
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                started = time.perf_counter()
+                db = Database(
+                    config.DATABASE_PATH,
+                    last_access_flush_interval=config.LAST_ACCESS_FLUSH_INTERVAL,
+                    last_access_flush_size=config.LAST_ACCESS_FLUSH_SIZE,
+                    user_cache_size=config.USER_CACHE_SIZE,
+                    user_cache_ttl=config.USER_CACHE_TTL,
+                    archive_path=config.ARCHIVE_PATH or None
+                )
+
+                # Payments are recorded in the same database
+                _payment_handler = PaymentHandler(db)
+
+                # Rendered results for repeated queries, dropped whenever the catalog changes
+                _search_cache = SearchCache(
+                    Catalog(db),
+                    render_search_pages,
+                    maxsize=config.SEARCH_CACHE_SIZE,
+                    max_bytes=config.SEARCH_CACHE_MAX_BYTES,
+                    limit=config.SEARCH_MAX_RESULTS
+                )
+
+                # Where polling resumes and which updates were already handled
+                _update_tracker = UpdateTracker(db)
+
+                # Files sent with search results, uploaded to Telegram once
+                _attachments = AttachmentStore(db, config.ATTACHMENTS_DIR)
+
+                _db = db
+                logger.info("Opened %s in %.1f ms", config.DATABASE_PATH, (time.perf_counter() - started) * 1000)
+    return _db
+
+def get_payment_handler() -> PaymentHandler:
+    """Return the payment handler bound to the bot's database."""
+    get_db()
+    return _payment_handler
+
+def get_search_cache() -> SearchCache:
+    """Return the rendered search results cache."""
+    get_db()
+    return _search_cache
+
+def get_update_tracker() -> UpdateTracker:
+    """Return the tracker of handled updates, loaded from the database."""
+    get_db()
+    return _update_tracker
+
+def get_attachments() -> AttachmentStore:
+    """Return the store of search result attachments and their Telegram file_ids."""
+    get_db()
+    return _attachments
+
+def close_db() -> None:
+    """Flush and close the database if it was opened."""
+    global _db
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+            _db = None
+
+# Per-user limit on updates, checked before any handler touches the database
+flood_control = FloodControl(config.FLOOD_RATE, config.FLOOD_BURST, maxsize=config.FLOOD_MAX_USERS)
+
+# Open /search result pages, turned by inline buttons without searching again
+search_cursors = SearchCursors(maxsize=config.SEARCH_CURSORS, ttl=config.SEARCH_CURSOR_TTL)
+
+# Cache and flood control state, read whenever metrics are scraped
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_user_cache', 'User cache counters', 'stat', lambda: _db.user_cache.stats() if _db else {}
+))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_search_cache', 'Search cache counters', 'stat', lambda: _search_cache.stats() if _search_cache else {}
+))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_search_cursors', 'Search result cursor counters', 'stat', lambda: search_cursors.stats()
+))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_attachments', 'Attachment upload counters', 'stat', lambda: _attachments.stats() if _attachments else {}
+))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_backup', 'Online backup counters', 'stat', lambda: _backups.stats() if _backups else {}
+))
+metrics.REGISTRY.register(metrics.Gauge('bot_flood_control', 'Flood control counters', 'stat', lambda: flood_control.stats()))
 
 # Bot token (you need to set this as an environment variable)
-BOT_TOKEN = os.environ.get('8429262459:AAEYBZKC8a-sonFPkGxO_cmaSf41eNP9au4')
-
-def start(update: Update, context: CallbackContext) -> None:
-    """Send a message when the command /start is issued."""
-    user = update.effective_user
-
-    # Create or get user in database
-    db_user = db.get_user(user.id)
-    if not db_user:
-        db_user = db.create_user(
-            telegram_id=user.id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
-
-    welcome_message = f"""
-Привет, {user.first_name}! 👋
-
-Я бот по черной психологии. Используй команду /search для поиска материалов.
-
-У тебя есть {db_user['tokens']} токенов для использования.
-После 3 дней использования токены закончатся, и тебе нужно будет пополнить баланс через /profile.
-
-Используй /help для получения списка команд.
-    """
+BOT_TOKEN = config.BOT_TOKEN
+
+def plural(number: int, one: str, few: str, many: str) -> str:
+    """Return number with the Russian noun form that agrees with it, e.g. 3 дня, 5 дней."""
+    if number % 10 == 1 and number % 100 != 11:
+        form = one
+    elif 2 <= number % 10 <= 4 and not 12 <= number % 100 <= 14:
+        form = few
+    else:
+        form = many
+    return f"{number} {form}"
 
-    update.message.reply_text(welcome_message)
+def trial_text() -> str:
+    """Describe the trial from TRIAL_DAYS and TRIAL_TOKENS, e.g. '3 дня и 10 токенов'."""
+    return f"{plural(config.TRIAL_DAYS, 'день', 'дня', 'дней')} и {plural(config.TRIAL_TOKENS, 'токен', 'токена', 'токенов')}"
 
-def help_command(update: Update, context: CallbackContext) -> None:
-    """Send a message when the command /help is issued."""
-    help_text = """
+# Reply texts shared by the sync and async runtimes
+HELP_TEXT = f"""
 Доступные команды:
 
 /start - Начать работу с ботом
-/search - Поиск материалов по черной психологии
+/search <слова> - Поиск материалов по черной психологии
 /profile - Просмотр профиля и баланса токенов
 /help - Показать это сообщение
 
 Каждый поиск расходует 1 токен.
-У тебя есть 3 дня и 10 токенов для использования.
+У тебя есть {trial_text()} для использования.
 После этого нужно пополнить баланс.
     """
 
-    update.message.reply_text(help_text)
+TRIAL_EXPIRED_TEXT = "Твой пробный период закончился. Пополни баланс через команду /profile"
 
-def search_command(update: Update, context: CallbackContext) -> None:
-    """Handle the /search command."""
-    user = update.effective_user
+NO_TOKENS_TEXT = "У тебя закончились токены. Пополни баланс через команду /profile"
+
+USER_NOT_FOUND_TEXT = "Ошибка: пользователь не найден."
+
+SEARCH_EXPIRED_TEXT = "Результаты устарели. Повторите поиск."
+
+FLOOD_TEXT = "Слишком много запросов. Подождите немного."
+
+PAYMENT_OPTIONS_TEXT = """
+Выберите количество токенов для покупки:
+
+1 токен = 10 рублей
 
-    # Get or create user
+Варианты:
+- 10 токенов (100 рублей) - /buy_10
+- 25 токенов (250 рублей) - /buy_25
+- 50 токенов (500 рублей) - /buy_50
+- 100 токенов (1000 рублей) - /buy_100
+        """
+
+# Purchase commands: command -> (tokens, price in RUB)
+BUY_OPTIONS = {
+    'buy_10': (10, 100),
+    'buy_25': (25, 250),
+    'buy_50': (50, 500),
+    'buy_100': (100, 1000),
+}
+
+def get_or_create_user(user) -> dict:
+    """Return the database row for a Telegram user, creating it on first contact, and record the visit."""
+    db = get_db()
     db_user = db.get_user(user.id)
     if not db_user:
         db_user = db.create_user(
@@ -76,67 +201,123 @@ def search_command(update: Update, context: CallbackContext) -> None:
             username=user.username,
             first_name=user.first_name,
             last_name=user.last_name
-        )
-
-    # Check token status
+        ) or db.get_user(user.id)  # created concurrently by another update
+    # Buffered and written in batches; /search records its visit in the charge
+    db.update_last_access(db_user['id'])
+    return db_user
+
+def get_profile(user) -> tuple:
+    """Return a Telegram user's database row and token status for /profile."""
+    db = get_db()
+    db_user = get_or_create_user(user)
     token_status = db.get_user_token_status(db_user['id'])
+    if token_status is None:
+        # Archived by archive.py while still cached here; the lookup brings them back
+        db.user_cache.invalidate(user.id)
+        db_user = get_or_create_user(user)
+        token_status = db.get_user_token_status(db_user['id'])
+    return db_user, token_status
+
+def sweep_trials(db: Database) -> int:
+    """Mark the trials that have ended as expired and return how many were marked."""
+    swept = len(db.sweep_expired_trials())
+    if swept:
+        logger.info("Marked %s trials expired", swept)
+    return swept
+
+def welcome_text(first_name: str, tokens: int) -> str:
+    """Build the /start greeting."""
+    return f"""
+Привет, {first_name}! 👋
 
-    if not token_status['is_active']:
-        update.message.reply_text(
-            "Твой пробный период закончился. Пополни баланс через команду /profile"
-        )
-        return
-
-    if not token_status['has_tokens']:
-        update.message.reply_text(
-            "У тебя закончились токены. Пополни баланс через команду /profile"
-        )
-        return
+Я бот по черной психологии. Используй команду /search для поиска материалов.
 
-    # Use one token
-    if db.use_token(db_user['id']):
-        db.update_last_access(db_user['id'])
+У тебя есть {plural(tokens, 'токен', 'токена', 'токенов')} для использования.
+Пробный период длится {plural(config.TRIAL_DAYS, 'день', 'дня', 'дней')}, после него нужно будет пополнить баланс через /profile.
 
-        # Simulate search results for black psychology content
-        search_results = get_black_psychology_content()
+Используй /help для получения списка команд.
+    """
 
-        response = f"""
+def search_text(charge: dict, search_results: str, page: int = 0, pages: int = 1) -> str:
+    """Build the /search reply from a successful charge."""
+    page_line = f"Страница {page + 1} из {pages}\n" if pages > 1 else ""
+    return f"""
 Результаты поиска по черной психологии:
 
 {search_results}
 
-Осталось токенов: {token_status['tokens'] - 1}
-Дней до окончания пробного периода: {token_status['days_remaining']}
+{page_line}Осталось токенов: {charge['tokens']}
+Дней до окончания пробного периода: {charge['days_remaining']}
         """
 
-        update.message.reply_text(response)
-    else:
-        update.message.reply_text(
-            "Не удалось использовать токен. Попробуйте позже."
-        )
-
-def profile_command(update: Update, context: CallbackContext) -> None:
-    """Handle the /profile command."""
-    user = update.effective_user
-
-    # Get or create user
-    db_user = db.get_user(user.id)
-    if not db_user:
-        db_user = db.create_user(
-            telegram_id=user.id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
-
-    # Get token status
-    token_status = db.get_user_token_status(db_user['id'])
-
+def page_keyboard(cursor_id: str, page: int, pages: int):
+    """Build the previous/next buttons under a page of search results, or None for one page."""
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"page:{cursor_id}:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"page:{cursor_id}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def search_reply(user_id: int, charge: dict, pages: tuple):
+    """Return the text, keyboard and attachments of the first page, opening a cursor if there are more."""
+    text, attachments = pages[0]
+    if len(pages) == 1:
+        return search_text(charge, text), None, attachments
+
+    # The charge is shown on every page, so it is kept with the pages
+    state = {'tokens': charge['tokens'], 'days_remaining': charge['days_remaining'], 'sent': {0}}
+    cursor_id = search_cursors.open(user_id, pages, state)
+    return search_text(charge, text, 0, len(pages)), page_keyboard(cursor_id, 0, len(pages)), attachments
+
+def search_page_reply(user_id: int, data: str):
+    """Return the text, keyboard and attachments for a page button's callback data, or None if it expired.
+
+    A page's attachments are only returned the first time it is shown.
+    """
+    try:
+        _, cursor_id, page = data.split(':')
+        page = int(page)
+    except ValueError:
+        return None
+
+    cursor = search_cursors.get(cursor_id, user_id)
+    if cursor is None:
+        return None
+    pages, state = cursor
+    if not 0 <= page < len(pages):
+        return None
+
+    text, attachments = pages[page]
+    if page in state['sent']:
+        attachments = ()
+    state['sent'].add(page)
+    return search_text(state, text, page, len(pages)), page_keyboard(cursor_id, page, len(pages)), attachments
+
+def send_attachment(bot, chat_id: int, attachment, file):
+    """Send one attachment as a photo or document and return its Telegram file_id."""
+    if attachment.kind == 'photo':
+        message = bot.send_photo(chat_id, file)
+        return message.photo[-1].file_id
+    message = bot.send_document(chat_id, file, filename=os.path.basename(attachment.name))
+    return message.document.file_id
+
+def send_attachments(bot, chat_id: int, attachments: tuple) -> None:
+    """Send the files of a page of search results, uploading each one only once."""
+    for name in attachments:
+        try:
+            get_attachments().send(name, functools.partial(send_attachment, bot, chat_id))
+        except (OSError, ValueError, TelegramError) as error:
+            # The results were sent already; a missing file only loses the attachment
+            logger.warning("Could not send attachment %s: %s", name, error)
+
+def profile_text(db_user: dict, token_status: dict) -> str:
+    """Build the /profile reply."""
     # Format registration date
     created_date = datetime.fromisoformat(db_user['created_at'])
     formatted_date = created_date.strftime("%d.%m.%Y")
 
-    profile_text = f"""
+    return f"""
 👤 Профиль:
 Имя: {db_user['first_name'] or 'Не указано'}
 Статус: {'Активен' if token_status['is_active'] else 'Не активен'}
@@ -148,121 +329,473 @@ def profile_command(update: Update, context: CallbackContext) -> None:
 Цена: 1 токен = 10 рублей
     """
 
-    # Create payment button
+def profile_keyboard() -> InlineKeyboardMarkup:
+    """Build the payment button shown under the profile."""
     keyboard = [[InlineKeyboardButton("Пополнить баланс", callback_data="recharge")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+def start(update: Update, context: CallbackContext) -> None:
+    """Send a message when the command /start is issued."""
+    user = update.effective_user
+
+    # Create or get user in database
+    db_user = get_or_create_user(user)
+
+    update.message.reply_text(welcome_text(user.first_name, db_user['tokens']))
+
+def help_command(update: Update, context: CallbackContext) -> None:
+    """Send a message when the command /help is issued."""
+    update.message.reply_text(HELP_TEXT)
+
+def command_of(update: Update):
+    """Return the command an update's message starts with, without '/' or '@botname', or None."""
+    message = update.message
+    if not message or not message.text or not message.entities:
+        return None
+    entity = message.entities[0]
+    if entity.type != 'bot_command' or entity.offset != 0:
+        return None
+    return message.text[1:entity.length].split('@')[0]
+
+def search_charge(update: Update) -> dict:
+    """Build the charge_search arguments for a /search update."""
+    user = update.effective_user
+    return {
+        'telegram_id': user.id,
+        'username': user.username,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        # A redelivered update finds this charge instead of making another
+        'update_id': update.update_id
+    }
+
+def search_command(update: Update, context: CallbackContext) -> None:
+    """Handle the /search command."""
+    # Create the user if needed, check the trial and charge one token in one transaction
+    charge = get_db().charge_search(**search_charge(update))
+
+    if not charge['is_active']:
+        update.message.reply_text(TRIAL_EXPIRED_TEXT)
+        return
+
+    if not charge['charged']:
+        update.message.reply_text(NO_TOKENS_TEXT)
+        return
 
-    update.message.reply_text(profile_text, reply_markup=reply_markup)
+    # Look up the query terms in the content catalog
+    pages = get_search_pages(' '.join(context.args or []))
+
+    text, keyboard, attachments = search_reply(update.effective_user.id, charge, pages)
+    update.message.reply_text(text, reply_markup=keyboard)
+    send_attachments(context.bot, update.effective_chat.id, attachments)
+
+def profile_command(update: Update, context: CallbackContext) -> None:
+    """Handle the /profile command."""
+    # Get or create user and their token status
+    db_user, token_status = get_profile(update.effective_user)
+
+    update.message.reply_text(profile_text(db_user, token_status), reply_markup=profile_keyboard())
 
 def button_handler(update: Update, context: CallbackContext) -> None:
     """Handle button presses."""
     query = update.callback_query
-    query.answer()
 
     if query.data == "recharge":
+        query.answer()
         # Show payment options
-        payment_text = """
-Выберите количество токенов для покупки:
-
-1 токен = 10 рублей
-
-Варианты:
-- 10 токенов (100 рублей) - /buy_10
-- 25 токенов (250 рублей) - /buy_25
-- 50 токенов (500 рублей) - /buy_50
-- 100 токенов (1000 рублей) - /buy_100
-        """
-
-        query.edit_message_text(text=payment_text)
+        query.edit_message_text(text=PAYMENT_OPTIONS_TEXT)
+    elif query.data.startswith("page:"):
+        # Turn the page from the cursor; nothing is searched or charged again
+        reply = search_page_reply(query.from_user.id, query.data)
+        if reply is None:
+            query.answer(SEARCH_EXPIRED_TEXT)
+            return
+        query.answer()
+        text, keyboard, attachments = reply
+        query.edit_message_text(text=text, reply_markup=keyboard)
+        send_attachments(context.bot, query.message.chat.id, attachments)
+    else:
+        query.answer()
 
 def buy_tokens(update: Update, context: CallbackContext, amount: int, price: int) -> None:
     """Handle token purchase."""
     user = update.effective_user
 
     # Get user
-    db_user = db.get_user(user.id)
+    db_user = get_db().get_user(user.id)
     if not db_user:
-        update.message.reply_text("Ошибка: пользователь не найден.")
+        update.message.reply_text(USER_NOT_FOUND_TEXT)
         return
+    get_db().update_last_access(db_user['id'])
 
     # Generate payment information
-    payment_info = payment_handler.generate_payment_info(db_user['id'], amount, price)
+    payment_info = get_payment_handler().generate_payment_info(db_user['id'], amount, price)
 
     update.message.reply_text(payment_info)
 
 def buy_10_command(update: Update, context: CallbackContext) -> None:
     """Handle /buy_10 command."""
-    buy_tokens(update, context, 10, 100)
+    buy_tokens(update, context, *BUY_OPTIONS['buy_10'])
 
 def buy_25_command(update: Update, context: CallbackContext) -> None:
     """Handle /buy_25 command."""
-    buy_tokens(update, context, 25, 250)
+    buy_tokens(update, context, *BUY_OPTIONS['buy_25'])
 
 def buy_50_command(update: Update, context: CallbackContext) -> None:
     """Handle /buy_50 command."""
-    buy_tokens(update, context, 50, 500)
+    buy_tokens(update, context, *BUY_OPTIONS['buy_50'])
 
 def buy_100_command(update: Update, context: CallbackContext) -> None:
     """Handle /buy_100 command."""
-    buy_tokens(update, context, 100, 1000)
-
-def get_black_psychology_content() -> str:
-    """Simulate fetching black psychology content from different sources."""
-    content = """
-📚 Материалы по черной психологии:
-
-1. "Темная триада личности" - Психологические черты макиавеллизма, нарциссизма и психопатии.
-   Источник: Журнал "Психология и безопасность"
+    buy_tokens(update, context, *BUY_OPTIONS['buy_100'])
 
-2. "Манипуляции в межличностных отношениях" - Техники психологического влияния.
-   Источник: Международный журнал прикладной психологии
+def format_search_results(entries: list, first_number: int = 1) -> str:
+    """Render catalog entries as the /search results block."""
+    if not entries:
+        return "📚 По вашему запросу ничего не найдено. Попробуйте другие слова."
 
-3. "Психология обмана и лжи" - Как распознать ложь и манипуляции.
-   Источник: Российский журнал психологии
+    items = "\n\n".join(
+        f'{number}. "{entry["title"]}" - {entry["summary"]}\n   Источник: {entry["source"]}'
+        for number, entry in enumerate(entries, first_number)
+    )
 
-4. "Темные стороны лидерства" - Психология токсичных лидеров.
-   Источник: Журнал социальной психологии
+    return f"""
+📚 Материалы по черной психологии:
 
-5. "Психология насилия" - Психологические аспекты агрессивного поведения.
-   Источник: Психологический журнал МГУ
+{items}
 
 ⚠️ Важно: Вся информация предоставлена исключительно в образовательных целях.
     """
 
-    return content
+def render_search_pages(entries: list) -> tuple:
+    """Render catalog entries as a tuple of (text, attachments) pages, numbered across pages."""
+    size = config.SEARCH_PAGE_SIZE
+    return tuple(
+        (
+            format_search_results(entries[start:start + size], start + 1),
+            tuple(dict.fromkeys(entry['attachment'] for entry in entries[start:start + size] if entry.get('attachment')))
+        )
+        for start in range(0, len(entries), size)
+    ) or ((format_search_results([]), ()),)
 
-def main() -> None:
-    """Start the bot."""
-    if not TOKEN:
-        logger.error("TELEGRAM_BOT_TOKEN environment variable is not set")
+def get_search_pages(query: str = '') -> tuple:
+    """Search the content catalog and return the rendered pages of matches."""
+    return get_search_cache().get(query)
+
+def serve_webhook(updater: Updater) -> None:
+    """Feed the dispatcher from the embedded webhook server until SIGINT or SIGTERM."""
+    dispatcher = updater.dispatcher
+    secret_token = webhook_secret(config.WEBHOOK_SECRET, config.WEBHOOK_URL)
+
+    server = WebhookServer(
+        lambda data: dispatcher.update_queue.put(Update.de_json(data, updater.bot)),
+        host=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        path=config.WEBHOOK_PATH,
+        secret_token=secret_token
+    )
+
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    updater.job_queue.start()
+    server.start()
+
+    if config.WEBHOOK_URL:
+        updater.bot.set_webhook(url=config.WEBHOOK_URL, secret_token=secret_token)
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+    stop.wait()
+
+    server.stop()
+    updater.job_queue.stop()
+    dispatcher.stop()
+
+def is_admin(user) -> bool:
+    """Whether a Telegram user may use admin commands."""
+    return user is not None and user.id in config.ADMIN_IDS
+
+def stats_text() -> str:
+    """Build the admin /stats reply from the metrics registry."""
+    lines = ["📈 Обработчики (вызовы, ошибки, среднее / p95 мс):"]
+    for name, summary in metrics.handler_summary().items():
+        lines.append(
+            f"{name}: {summary['count']}, {summary['errors']}, "
+            f"{summary['mean'] * 1000:.1f} / {summary['p95'] * 1000:.1f}"
+        )
+
+    lines.append("")
+    lines.append("🗄 База данных (вызовы, ошибки, повторы из-за блокировки, всего мс):")
+    for method in metrics.DB_CALLS.label_values():
+        summary = metrics.DB_SECONDS.summary(method)
+        lines.append(
+            f"{method}: {summary['count']}, {metrics.DB_ERRORS.get(method)}, "
+            f"{metrics.DB_LOCK_RETRIES.get(method)}, {summary['mean'] * summary['count'] * 1000:.0f}"
+        )
+
+    lines.append("")
+    lines.append(f"Кэш пользователей: {get_db().user_cache.stats()}")
+    lines.append(f"Кэш поиска: {get_search_cache().stats()}")
+    lines.append(f"Курсоры поиска: {search_cursors.stats()}")
+    lines.append(f"Вложения: {get_attachments().stats()}")
+    lines.append(f"Флуд-контроль: {flood_control.stats()}")
+    if _backups is not None:
+        lines.append(f"Резервные копии: {_backups.stats()}")
+    return "\n".join(lines)
+
+def stats_command(update: Update, context: CallbackContext) -> None:
+    """Handle the admin-only /stats command."""
+    if not is_admin(update.effective_user):
         return
 
+    update.message.reply_text(stats_text())
+
+def start_metrics_server():
+    """Serve Prometheus metrics on METRICS_PORT, unless it is 0."""
+    if not config.METRICS_PORT:
+        return None
+    server = metrics.MetricsServer(config.METRICS_LISTEN, config.METRICS_PORT)
+    server.start()
+    return server
+
+def start_backups():
+    """Back up the database, and the archive if any, every BACKUP_INTERVAL seconds, unless it is 0."""
+    global _backups
+    if not config.BACKUP_INTERVAL:
+        return None
+    _backups = BackupScheduler(
+        config.DATABASE_PATH, config.BACKUP_INTERVAL, config.BACKUP_DIR, archive_path=config.ARCHIVE_PATH or None
+    ).start()
+    return _backups
+
+def claim_update(update: Update, context: CallbackContext) -> None:
+    """Stop updates that were already handled, e.g. redelivered after a restart."""
+    # A catch-up claims its batch itself
+    if context.bot_data.get('catching_up'):
+        return
+    if not context.bot_data['update_tracker'].begin(update.update_id):
+        raise DispatcherHandlerStop()
+
+def finish_update(update: Update, context: CallbackContext) -> None:
+    """Mark an update handled and commit the offset, which a catch-up does per batch instead."""
+    tracker = context.bot_data.get('update_tracker')
+    if tracker and tracker.finish(update.update_id) and not context.bot_data.get('catching_up'):
+        tracker.commit()
+
+def tracked_handler(callback):
+    """Wrap a handler so its update is marked handled when it returns or fails."""
+    @functools.wraps(callback)
+    def wrapper(update: Update, context: CallbackContext):
+        try:
+            return callback(update, context)
+        finally:
+            finish_update(update, context)
+    return wrapper
+
+def throttle_update(update: Update, context: CallbackContext) -> None:
+    """Stop updates from users over their flood limit before the handlers run."""
+    # A catch-up applies the limit itself
+    if context.bot_data.get('catching_up'):
+        return
+    user = update.effective_user
+    if user and not flood_control.allow(user.id):
+        finish_update(update, context)
+        # Otherwise the pressed button spins until Telegram gives up on it
+        if update.callback_query:
+            try:
+                update.callback_query.answer(FLOOD_TEXT)
+            except TelegramError as error:
+                logger.warning("Could not answer a throttled callback query: %s", error)
+        raise DispatcherHandlerStop()
+
+def build_updater(token: str, base_url: str = config.BOT_API_BASE_URL,
+                  workers: int = config.UPDATE_WORKERS, tracker: UpdateTracker = None) -> Updater:
+    """Create an Updater with every handler and the last_access flush and trial sweep jobs registered.
+
+    With a tracker, updates that were already handled are dropped and the
+    offset of handled updates is committed as handlers finish.
+    """
     # Create the Updater and pass it your bot's token.
-    updater = Updater(TOKEN)
+    with warnings.catch_warnings():
+        # Running without worker threads is deliberate; run_async is off below
+        warnings.simplefilter('ignore', UserWarning)
+        updater = Updater(token, base_url=base_url, workers=workers)
+    # Handlers run on the worker threads; with no workers they run on the dispatcher thread
+    run_async = workers > 0
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
-    # Register command handlers
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("search", search_command))
-    dispatcher.add_handler(CommandHandler("profile", profile_command))
-    dispatcher.add_handler(CommandHandler("buy_10", buy_10_command))
-    dispatcher.add_handler(CommandHandler("buy_25", buy_25_command))
-    dispatcher.add_handler(CommandHandler("buy_50", buy_50_command))
-    dispatcher.add_handler(CommandHandler("buy_100", buy_100_command))
-
-    # Register button handler
-    dispatcher.add_handler(MessageHandler(Filters.text & Filters.regex('Пополнить баланс'), button_handler))
+    # Drop redelivered updates first, then floods; groups -2 and -1 run before the handlers below
+    if tracker is not None:
+        dispatcher.bot_data['update_tracker'] = tracker
+        dispatcher.add_handler(TypeHandler(Update, claim_update), group=-2)
+    dispatcher.add_handler(TypeHandler(Update, throttle_update), group=-1)
+
+    def wrap(name, callback):
+        callback = metrics.timed_handler(name, callback)
+        return tracked_handler(callback) if tracker is not None else callback
+
+    # Register command handlers, each timed by the metrics subsystem
+    commands = {
+        "start": start,
+        "help": help_command,
+        "search": search_command,
+        "profile": profile_command,
+        "stats": stats_command,
+        "buy_10": buy_10_command,
+        "buy_25": buy_25_command,
+        "buy_50": buy_50_command,
+        "buy_100": buy_100_command,
+    }
+    for command, callback in commands.items():
+        dispatcher.add_handler(CommandHandler(command, wrap(command, callback), run_async=run_async))
+
+    # Register the inline button handler
+    dispatcher.add_handler(CallbackQueryHandler(wrap('button', button_handler), run_async=run_async))
+
+    # Updates no handler above took are handled too
+    if tracker is not None:
+        dispatcher.add_handler(TypeHandler(Update, finish_update))
+
+    # Periodically write out buffered last_access updates
+    updater.job_queue.run_repeating(
+        lambda context: get_db().flush_last_access(),
+        interval=config.LAST_ACCESS_FLUSH_INTERVAL
+    )
+
+    # Mark ended trials expired, which drops them from the partial index on trial_expires_at
+    updater.job_queue.run_repeating(
+        lambda context: sweep_trials(get_db()),
+        interval=config.TRIAL_SWEEP_INTERVAL,
+        name='sweep_trials'
+    )
+
+    return updater
+
+def catch_up(updater: Updater, batch_size: int = config.CATCH_UP_BATCH_SIZE) -> int:
+    """Drain the updates that queued up while the bot was down, one batch at a time.
+
+    Every search in a batch is charged in one transaction before the handlers
+    run, and the offset is committed once per batch. Returns the number of
+    updates handled.
+    """
+    dispatcher = updater.dispatcher
+    tracker = dispatcher.bot_data['update_tracker']
+    handled = 0
+
+    # Handlers run on the dispatcher's worker threads, which exist only while it runs
+    started_here = not dispatcher.running
+    if started_here:
+        ready = threading.Event()
+        threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, name='dispatcher', daemon=True).start()
+        ready.wait()
+
+    dispatcher.bot_data['catching_up'] = True
+    # No offset at first: it would confirm updates whose ids Telegram restarted below it
+    offset = None
+    try:
+        while True:
+            try:
+                updates = updater.bot.get_updates(offset=offset, limit=batch_size, timeout=0)
+            except TelegramError as error:
+                # Polling picks up whatever is left
+                logger.warning("Catch-up stopped: %s", error)
+                break
+
+            admitted = []
+            for update in updates:
+                if not tracker.begin(update.update_id):
+                    continue
+                user = update.effective_user
+                if user and not flood_control.allow(user.id):
+                    tracker.finish(update.update_id)
+                    continue
+                admitted.append(update)
+
+            searches = [search_charge(update) for update in admitted if command_of(update) == 'search']
+            if searches:
+                get_db().charge_searches(searches)
+
+            for update in admitted:
+                dispatcher.process_update(update)
+            tracker.wait_idle()
+            tracker.commit()
+            handled += len(admitted)
+            offset = tracker.offset + 1
+
+            if len(updates) < batch_size:
+                break
+    finally:
+        dispatcher.bot_data['catching_up'] = False
+        # Polling starts it again
+        if started_here:
+            dispatcher.stop()
+
+    return handled
+
+def run_sync() -> None:
+    """Run the bot on the threaded PTB Updater and Dispatcher."""
+    started = time.perf_counter()
+    # Migrate before taking updates rather than inside the first handler
+    tracker = get_update_tracker()
+    updater = build_updater(BOT_TOKEN, tracker=tracker)
+    metrics_server = start_metrics_server()
+    backups = start_backups()
+    logger.info("Started in %.1f ms", (time.perf_counter() - started) * 1000)
 
     # Start the Bot
-    updater.start_polling()
+    if config.UPDATE_MODE == 'webhook':
+        serve_webhook(updater)
+    else:
+        if config.CATCH_UP:
+            updater.bot.delete_webhook()
+            caught_up = time.perf_counter()
+            handled = catch_up(updater)
+            logger.info("Caught up on %s updates in %.1f s", handled, time.perf_counter() - caught_up)
+            # Resume after the last handled update rather than whatever Telegram still holds
+            updater.last_update_id = tracker.offset + 1
+        # Otherwise the first poll has no offset, and the tracker drops what was handled
+        updater.start_polling()
+
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+
+    logger.info("Search cache stats: %s", get_search_cache().stats())
+    logger.info("Flood control stats: %s", flood_control.stats())
+    logger.info("Update tracking stats: %s", tracker.stats())
+
+    if metrics_server is not None:
+        metrics_server.stop()
+    if backups is not None:
+        backups.stop()
+
+    # Write out buffered last_access updates and release pooled connections
+    close_db()
+
+def main() -> None:
+    """Start the bot."""
+    if not BOT_TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN environment variable is not set")
+        return
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    logger.info("Starting bot in %s mode", config.BOT_MODE)
+
+    if config.BOT_MODE == 'async':
+        import async_bot
+        async_bot.run(BOT_TOKEN, config.BOT_API_BASE_URL)
+    elif config.BOT_MODE == 'sync':
+        run_sync()
+    elif config.BOT_MODE == 'multiprocess':
+        import workers
+        # Migrate once here; only the worker processes use the database afterwards
+        get_db()
+        close_db()
+        workers.run(BOT_TOKEN, config.BOT_API_BASE_URL)
+    else:
+        logger.error("Unknown BOT_MODE %r, expected 'sync', 'async' or 'multiprocess'", config.BOT_MODE)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,107 @@
+import json
+
+import aiohttp
+
+API_BASE_URL = 'https://api.telegram.org/bot'
+
+# Long polling timeout for getUpdates (seconds)
+POLL_TIMEOUT = 30
+
+# HTTP timeout for ordinary Bot API calls (seconds)
+REQUEST_TIMEOUT = 30
+
+class TelegramApiError(Exception):
+    """Error response returned by the Bot API"""
+
+    def __init__(self, method, error_code, description, retry_after=None):
+        super().__init__(f"{method} failed with {error_code}: {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+class AsyncBotApi:
+    """Minimal non-blocking Bot API client sharing one HTTP connection pool"""
+
+    def __init__(self, token, base_url=API_BASE_URL, connection_limit=100):
+        self.url = f"{base_url}{token}/"
+        self.connection_limit = connection_limit
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connection_limit)
+            )
+        return self._session
+
+    async def call(self, method, params=None, request_timeout=REQUEST_TIMEOUT, files=None):
+        """Call a Bot API method and return its result
+
+        files maps parameter names to (filename, bytes) uploads, which are
+        sent as multipart/form-data together with params.
+        """
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        if files:
+            body = aiohttp.FormData()
+            for key, value in params.items():
+                body.add_field(key, value if isinstance(value, str) else json.dumps(value))
+            for key, (filename, content) in files.items():
+                body.add_field(key, content, filename=filename)
+            request = {'data': body}
+        else:
+            request = {'json': params}
+
+        async with self._get_session().post(
+            self.url + method,
+            timeout=aiohttp.ClientTimeout(total=request_timeout),
+            **request
+        ) as response:
+            payload = await response.json(content_type=None)
+
+        if not payload.get('ok'):
+            raise TelegramApiError(
+                method,
+                payload.get('error_code', response.status),
+                payload.get('description', ''),
+                payload.get('parameters', {}).get('retry_after')
+            )
+        return payload['result']
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self.call('sendMessage', {
+            'chat_id': chat_id,
+            'text': text,
+            'reply_markup': reply_markup.to_dict() if reply_markup else None
+        })
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        return await self.call('editMessageText', {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text,
+            'reply_markup': reply_markup.to_dict() if reply_markup else None
+        })
+
+    async def send_file(self, kind, chat_id, file, filename=None, caption=None):
+        """Send a photo or document: a file_id to resend, or bytes to upload"""
+        method = 'sendPhoto' if kind == 'photo' else 'sendDocument'
+        params = {'chat_id': chat_id, 'caption': caption}
+        if isinstance(file, bytes):
+            return await self.call(method, params, files={kind: (filename or kind, file)})
+        params[kind] = file
+        return await self.call(method, params)
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        return await self.call('answerCallbackQuery', {'callback_query_id': callback_query_id, 'text': text})
+
+    async def get_updates(self, offset=None, timeout=POLL_TIMEOUT, limit=None):
+        return await self.call(
+            'getUpdates',
+            {'offset': offset, 'timeout': timeout, 'limit': limit},
+            request_timeout=timeout + REQUEST_TIMEOUT
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
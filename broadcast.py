@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+import config
+from bot_api import API_BASE_URL, AsyncBotApi, TelegramApiError
+from database import Database
+from ratelimit import TokenBucket, TokenBucketRegistry
+
+logger = logging.getLogger(__name__)
+
+# Recipients read, sent and checkpointed together
+PAGE_SIZE = 200
+
+# Attempts per message before it is counted as failed
+MAX_ATTEMPTS = 5
+
+# Wait before retrying a network or server error; doubled on each attempt (seconds)
+RETRY_BACKOFF = 1.0
+
+# Error codes that will not go away on retry: blocked the bot, chat not found, ...
+PERMANENT_ERRORS = (400, 403)
+
+# Who receives a broadcast: a WHERE clause over users and the default text
+AUDIENCES = {
+    'all': (
+        "1",
+        "📢 Новости бота: загляните в /help, чтобы узнать о новых возможностях."
+    ),
+    'trial_expiring': (
+        "trial_expired = 0 AND trial_expires_at > datetime('now') "
+        "AND trial_expires_at <= datetime('now', '+24 hours')",
+        "⏳ Ваш пробный период заканчивается менее чем через сутки.\n"
+        "Чтобы продолжить пользоваться ботом, купите токены через /profile"
+    ),
+    'zero_balance': (
+        "tokens = 0",
+        "🪙 У вас закончились токены.\nПополнить баланс: /profile"
+    )
+}
+
+class Broadcaster:
+    """Sends one text to an audience of users within Telegram's rate limits
+
+    Recipients are read in pages ordered by user id and the last id of
+    each finished page is stored in the broadcasts table, so a restarted
+    broadcast continues after it. Only the page in flight when a run is
+    interrupted can be delivered twice.
+    """
+
+    def __init__(self, db, api, rate=config.BROADCAST_RATE, chat_rate=config.BROADCAST_CHAT_RATE,
+                 concurrency=config.BROADCAST_CONCURRENCY, page_size=PAGE_SIZE,
+                 max_attempts=MAX_ATTEMPTS, retry_backoff=RETRY_BACKOFF):
+        self.db = db
+        self.api = api
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.bucket = TokenBucket(rate)
+        self.chat_buckets = TokenBucketRegistry(chat_rate, capacity=1)
+        self.concurrency = concurrency
+        # A 429 holds back every sender, not just the one that received it
+        self._resume_at = 0.0
+
+    def create(self, name, audience, text=None):
+        """Register a broadcast, or return the existing one with that name"""
+        if audience not in AUDIENCES:
+            raise ValueError(f"Unknown audience: {audience!r}")
+
+        conn = self.db.get_connection()
+        conn.execute('''
+            INSERT INTO broadcasts (name, audience, text) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO NOTHING
+        ''', (name, audience, text or AUDIENCES[audience][1]))
+        conn.commit()
+        return self.get(name)
+
+    def get(self, name):
+        """Return a broadcast's progress as a dict, or None"""
+        cursor = self.db.get_connection().execute('''
+            SELECT id, name, audience, text, status, last_user_id, sent, failed
+            FROM broadcasts WHERE name = ?
+        ''', (name,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'name', 'audience', 'text', 'status', 'last_user_id', 'sent', 'failed')
+        return dict(zip(keys, row))
+
+    def next_page(self, audience, after_id):
+        """Return (id, telegram_id) of the next page of recipients after a user id"""
+        cursor = self.db.get_connection().execute(f'''
+            SELECT id, telegram_id FROM users
+            WHERE id > ? AND ({AUDIENCES[audience][0]})
+            ORDER BY id LIMIT ?
+        ''', (after_id, self.page_size))
+        return cursor.fetchmany(self.page_size)
+
+    def record_page(self, broadcast_id, last_user_id, sent, failed, finished=False):
+        """Checkpoint a finished page in one short transaction"""
+        conn = self.db.get_connection()
+        conn.execute('''
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = sent + ?, failed = failed + ?,
+                status = CASE WHEN ? THEN 'done' ELSE status END,
+                finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP ELSE finished_at END
+            WHERE id = ?
+        ''', (last_user_id, sent, failed, finished, finished, broadcast_id))
+        conn.commit()
+
+    async def _wait_for_slot(self, chat_id):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.bucket.acquire()
+        await self.chat_buckets.get(chat_id).acquire()
+
+    async def send(self, chat_id, text):
+        """Deliver one message, retrying rate limits and transient errors; True if sent"""
+        for attempt in range(self.max_attempts):
+            await self._wait_for_slot(chat_id)
+            try:
+                await self.api.send_message(chat_id, text)
+                return True
+            except TelegramApiError as e:
+                if e.error_code == 429:
+                    retry_after = e.retry_after or 1
+                    self._resume_at = max(self._resume_at, time.monotonic() + retry_after)
+                    logger.warning("Rate limited, pausing for %ss", retry_after)
+                    continue
+                if e.error_code in PERMANENT_ERRORS:
+                    logger.info("Skipping chat %s: %s", chat_id, e.description)
+                    return False
+                logger.warning("Send to %s failed: %s", chat_id, e)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Send to %s failed: %r", chat_id, e)
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+        return False
+
+    async def run(self, name, max_pages=None):
+        """Send a created broadcast until its audience is exhausted or max_pages are done
+
+        Returns the broadcast's progress afterwards.
+        """
+        broadcast = await asyncio.to_thread(self.get, name)
+        if broadcast is None:
+            raise ValueError(f"Unknown broadcast: {name!r}")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(chat_id):
+            async with semaphore:
+                return await self.send(chat_id, broadcast['text'])
+
+        last_user_id = broadcast['last_user_id']
+        pages = 0
+        while broadcast['status'] != 'done' and (max_pages is None or pages < max_pages):
+            page = await asyncio.to_thread(self.next_page, broadcast['audience'], last_user_id)
+            finished = len(page) < self.page_size
+
+            results = await asyncio.gather(*(deliver(telegram_id) for _, telegram_id in page))
+            if page:
+                last_user_id = page[-1][0]
+            sent = sum(results)
+
+            await asyncio.to_thread(
+                self.record_page, broadcast['id'], last_user_id, sent, len(results) - sent, finished
+            )
+            pages += 1
+            logger.info("Broadcast %s: page %s, %s sent, %s failed", name, pages, sent, len(results) - sent)
+
+            if finished:
+                break
+
+        return await asyncio.to_thread(self.get, name)
+
+async def broadcast(db, token, name, audience, text=None, base_url=API_BASE_URL, max_pages=None):
+    """Create (or resume) a broadcast and send it"""
+    api = AsyncBotApi(token, base_url)
+    try:
+        broadcaster = Broadcaster(db, api)
+        broadcaster.create(name, audience, text)
+        return await broadcaster.run(name, max_pages)
+    finally:
+        await api.close()
+
+def main() -> None:
+    """Send or resume a broadcast from the command line."""
+    parser = argparse.ArgumentParser(description="Message an audience of bot users within rate limits")
+    parser.add_argument('audience', choices=sorted(AUDIENCES))
+    parser.add_argument('--name', help="broadcast name; rerun with the same name to resume "
+                                       "(default: audience and today's date)")
+    parser.add_argument('--text', help="message text (default depends on the audience)")
+    parser.add_argument('--max-pages', type=int)
+    parser.add_argument('--db', default=config.DATABASE_PATH)
+    parser.add_argument('--base-url', default=API_BASE_URL)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    if not config.BOT_TOKEN:
+        raise SystemExit("TELEGRAM_BOT_TOKEN is not set")
+
+    name = args.name or f"{args.audience}-{time.strftime('%Y-%m-%d')}"
+    db = Database(args.db)
+    try:
+        result = asyncio.run(broadcast(
+            db, config.BOT_TOKEN, name, args.audience, args.text, args.base_url, args.max_pages
+        ))
+    finally:
+        db.close()
+
+    logger.info("Broadcast %s %s: %s sent, %s failed", name, result['status'], result['sent'], result['failed'])
+
+if __name__ == '__main__':
+    main()
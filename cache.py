@@ -0,0 +1,96 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """Thread-safe in-process cache with LRU eviction and an optional TTL
+
+    If max_bytes is given, entries are also evicted to keep the summed
+    sizeof(value) under that cap.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, max_bytes=None, sizeof=sys.getsizeof):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at, size = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Store value under key, evicting the least recently used entries if full"""
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        size = self.sizeof(value) if self.max_bytes else 0
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self.bytes += size
+            while self._data and (
+                len(self._data) > self.maxsize
+                or (self.max_bytes and self.bytes > self.max_bytes)
+            ):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def update(self, key, func):
+        """Apply func to a cached value in place, keeping its TTL; no-op if absent"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at, size = entry
+                value = func(value)
+                new_size = self.sizeof(value) if self.max_bytes else 0
+                self._data[key] = (value, expires_at, new_size)
+                self.bytes += new_size - size
+
+    def invalidate(self, key):
+        """Drop key from the cache"""
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def __len__(self):
+        return len(self._data)
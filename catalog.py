@@ -0,0 +1,272 @@
+import re
+import secrets
+import sqlite3
+
+from cache import LRUCache
+
+# Entries the catalog starts with on a fresh database
+SEED_ENTRIES = [
+    {
+        'external_id': 'seed-1',
+        'title': 'Темная триада личности',
+        'summary': 'Психологические черты макиавеллизма, нарциссизма и психопатии.',
+        'source': 'Журнал "Психология и безопасность"'
+    },
+    {
+        'external_id': 'seed-2',
+        'title': 'Манипуляции в межличностных отношениях',
+        'summary': 'Техники психологического влияния.',
+        'source': 'Международный журнал прикладной психологии'
+    },
+    {
+        'external_id': 'seed-3',
+        'title': 'Психология обмана и лжи',
+        'summary': 'Как распознать ложь и манипуляции.',
+        'source': 'Российский журнал психологии'
+    },
+    {
+        'external_id': 'seed-4',
+        'title': 'Темные стороны лидерства',
+        'summary': 'Психология токсичных лидеров.',
+        'source': 'Журнал социальной психологии'
+    },
+    {
+        'external_id': 'seed-5',
+        'title': 'Психология насилия',
+        'summary': 'Психологические аспекты агрессивного поведения.',
+        'source': 'Психологический журнал МГУ'
+    },
+]
+
+# Russian inflectional endings, longest first, stripped from query terms so
+# that a prefix query matches every case and number of the same word
+RUSSIAN_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ией', 'иям', 'иях', 'ого', 'его', 'ому', 'ему',
+    'ыми', 'ими', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей',
+    'ую', 'юю', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ия', 'ии', 'ию', 'ья',
+    'ов', 'ев', 'ых', 'их', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+# Stems are never cut shorter than this many characters
+MIN_STEM_LENGTH = 4
+
+# Default number of results returned by a search
+SEARCH_LIMIT = 5
+
+# Rendered search results kept in memory: entry count and total size cap
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# Open result cursors: how many to keep and for how long (seconds)
+SEARCH_CURSORS = 10000
+SEARCH_CURSOR_TTL = 3600
+
+def stem(word):
+    """Strip one Russian inflectional ending from a lowercase word"""
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+def query_terms(query):
+    """Split free user text into unique stemmed terms, in order of appearance"""
+    terms = []
+    for word in re.findall(r'\w+', (query or '').lower().replace('ё', 'е')):
+        term = stem(word)
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+def build_match_query(query):
+    """Turn free user text into an FTS5 MATCH expression of stemmed prefix terms"""
+    # Quoting keeps FTS5 operators typed by users from being interpreted
+    return ' OR '.join(f'"{term}"*' for term in query_terms(query))
+
+def normalize_query(query):
+    """Reduce a query to the order-independent set of terms it searches for"""
+    return ' '.join(sorted(query_terms(query)))
+
+class Catalog:
+    """Content catalog stored next to the users table with an FTS5 index"""
+
+    def __init__(self, db):
+        # The tables and seed entries come from the database migrations
+        self.db = db
+
+    def _bump_version(self, cursor):
+        """Mark the catalog as changed, inside the caller's write transaction"""
+        cursor.execute("UPDATE catalog_meta SET value = value + 1 WHERE key = 'version'")
+
+    def version(self):
+        """Return the current catalog version"""
+        cursor = self.db.get_connection().cursor()
+        cursor.execute("SELECT value FROM catalog_meta WHERE key = 'version'")
+        return cursor.fetchone()[0]
+
+    def add_entry(self, title, summary='', source='', external_id=None, attachment=None):
+        """Add one entry to the catalog"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute('''
+                INSERT INTO catalog (external_id, title, summary, source, attachment)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (external_id, title, summary, source, attachment))
+            entry_id = cursor.lastrowid
+            self._bump_version(cursor)
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            return None
+
+        return entry_id
+
+    def upsert_entries(self, rows):
+        """Insert or update (external_id, title, summary, source, attachment) rows in one transaction
+
+        The FTS index follows through the catalog triggers, so only the
+        entries in this batch are reindexed. Returns the number of rows
+        inserted or changed.
+        """
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            # Unchanged rows are skipped so they do not churn the index
+            cursor.executemany('''
+                INSERT INTO catalog (external_id, title, summary, source, attachment)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (external_id) DO UPDATE SET
+                    title = excluded.title,
+                    summary = excluded.summary,
+                    source = excluded.source,
+                    attachment = excluded.attachment
+                WHERE title IS NOT excluded.title
+                   OR summary IS NOT excluded.summary
+                   OR source IS NOT excluded.source
+                   OR attachment IS NOT excluded.attachment
+            ''', rows)
+            changed = cursor.rowcount
+            if changed:
+                self._bump_version(cursor)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+        return changed
+
+    def merge_index(self, pages=500):
+        """Do a bounded amount of FTS segment merging"""
+        conn = self.db.get_connection()
+        conn.execute("INSERT INTO catalog_fts (catalog_fts, rank) VALUES ('merge', ?)", (pages,))
+        conn.commit()
+
+    def rebuild_index(self):
+        """Rebuild the whole FTS index from the catalog table"""
+        conn = self.db.get_connection()
+        conn.execute("INSERT INTO catalog_fts (catalog_fts) VALUES ('rebuild')")
+        self._bump_version(conn.cursor())
+        conn.commit()
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return the best-ranked entries for query, or the newest ones for an empty query"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+
+        match = build_match_query(query or '')
+        if match:
+            # Title hits outrank summary hits, which outrank source hits
+            cursor.execute('''
+                SELECT c.id, c.title, c.summary, c.source, c.attachment
+                FROM catalog_fts
+                JOIN catalog c ON c.id = catalog_fts.rowid
+                WHERE catalog_fts MATCH ?
+                ORDER BY bm25(catalog_fts, 10.0, 3.0, 1.0)
+                LIMIT ?
+            ''', (match, limit))
+        else:
+            cursor.execute('''
+                SELECT id, title, summary, source, attachment FROM catalog
+                ORDER BY id DESC LIMIT ?
+            ''', (limit,))
+
+        return [
+            {'id': row[0], 'title': row[1], 'summary': row[2], 'source': row[3], 'attachment': row[4]}
+            for row in cursor.fetchall()
+        ]
+
+def rendered_size(rendered):
+    """Size in bytes of a rendering: a text, or nested tuples of texts"""
+    if rendered is None:
+        return 0
+    if isinstance(rendered, tuple):
+        return sum(rendered_size(part) for part in rendered)
+    return len(rendered.encode())
+
+class SearchCache:
+    """Caches rendered search results by normalized query until the catalog changes
+
+    render turns the found entries into a text or a tuple of pages.
+    """
+
+    def __init__(self, catalog, render, maxsize=SEARCH_CACHE_SIZE, max_bytes=SEARCH_CACHE_MAX_BYTES,
+                 limit=SEARCH_LIMIT):
+        self.catalog = catalog
+        self.render = render
+        self.limit = limit
+        self.cache = LRUCache(
+            maxsize=maxsize,
+            max_bytes=max_bytes,
+            sizeof=rendered_size
+        )
+        self._version = None
+
+    def get(self, query):
+        """Return the rendered results for query, searching only on a miss"""
+        version = self.catalog.version()
+        if version != self._version:
+            self.cache.clear()
+            self._version = version
+
+        # The version is part of the key so results rendered from an older
+        # catalog by a concurrent caller are never served as current
+        key = (version, normalize_query(query))
+        text = self.cache.get(key)
+        if text is None:
+            text = self.render(self.catalog.search(query, self.limit))
+            self.cache.set(key, text)
+        return text
+
+    def stats(self):
+        """Return cache counters, including the hit rate"""
+        return self.cache.stats()
+
+class SearchCursors:
+    """Server-side state of paginated results, looked up by a short random id
+
+    Callback data is limited to 64 bytes, so page buttons carry only the
+    cursor id and a page number. A cursor refers to the rendered pages held
+    by the search cache rather than copying them, and expires after ttl.
+    """
+
+    def __init__(self, maxsize=SEARCH_CURSORS, ttl=SEARCH_CURSOR_TTL):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def open(self, owner, pages, state=None):
+        """Store pages shown to owner, with extra state for re-rendering them, and return the cursor id"""
+        cursor_id = secrets.token_urlsafe(6)
+        self.cache.set(cursor_id, (owner, pages, state))
+        return cursor_id
+
+    def get(self, cursor_id, owner):
+        """Return (pages, state) of a live cursor opened by owner, or None"""
+        cursor = self.cache.get(cursor_id)
+        if cursor is None or cursor[0] != owner:
+            return None
+        return cursor[1], cursor[2]
+
+    def stats(self):
+        """Return cursor cache counters"""
+        return self.cache.stats()
@@ -5,11 +5,56 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Telegram Bot Configuration
-BOT_TOKEN = os.getenv('8429262459:AAEYBZKC8a-sonFPkGxO_cmaSf41eNP9au4')
+BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+# Bot API endpoint; point it at a local server for load tests
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL', 'https://api.telegram.org/bot')
+
+# Runtime: 'sync' (threaded PTB Updater), 'async' (asyncio handlers) or
+# 'multiprocess' (one receiver fanning out to WORKER_PROCESSES processes)
+BOT_MODE = os.getenv('BOT_MODE', 'sync')
+
+# Update delivery: 'polling' (getUpdates) or 'webhook' (embedded HTTP server)
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # public URL registered with setWebhook
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+# Threads running handlers in sync mode; 0 runs them one at a time on the dispatcher thread
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 4))
+
+# Threads running Database calls in async mode
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 4))
+
+# Updates handled at once in async mode
+ASYNC_MAX_CONCURRENT_UPDATES = int(os.getenv('ASYNC_MAX_CONCURRENT_UPDATES', 1000))
 
 # Database Configuration
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'users.db')
 
+# last_access updates are buffered and written in batches
+LAST_ACCESS_FLUSH_INTERVAL = int(os.getenv('LAST_ACCESS_FLUSH_INTERVAL', 30))  # seconds
+LAST_ACCESS_FLUSH_SIZE = int(os.getenv('LAST_ACCESS_FLUSH_SIZE', 500))
+
+# In-process user cache in front of Database.get_user
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))  # seconds
+
+# Rendered /search results cache
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 1000))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv('SEARCH_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+
+# Paginated search: results per page, results kept per query, and how long page buttons work
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 5))
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', 50))
+SEARCH_CURSORS = int(os.getenv('SEARCH_CURSORS', 10000))
+SEARCH_CURSOR_TTL = int(os.getenv('SEARCH_CURSOR_TTL', 3600))  # seconds
+
+# Files sent with search results; catalog entries name them relative to this directory
+ATTACHMENTS_DIR = os.getenv('ATTACHMENTS_DIR', 'attachments')
+
 # Payment Configuration
 TOKEN_PRICE = 10  # Price per token in RUB
 ADMIN_CONTACT = os.getenv('ADMIN_CONTACT', '@admin')
@@ -17,3 +62,43 @@ ADMIN_CONTACT = os.getenv('ADMIN_CONTACT', '@admin')
 # Trial period configuration
 TRIAL_DAYS = 3
 TRIAL_TOKENS = 10
+# Seconds between sweeps that mark ended trials expired
+TRIAL_SWEEP_INTERVAL = int(os.getenv('TRIAL_SWEEP_INTERVAL', 3600))
+
+# Broadcasts: messages per second overall and per chat, and messages in flight
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 30))
+BROADCAST_CHAT_RATE = float(os.getenv('BROADCAST_CHAT_RATE', 1))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+
+# Flood control: updates a user may send at once, and per second after that
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', 5))
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', 1))
+FLOOD_MAX_USERS = int(os.getenv('FLOOD_MAX_USERS', 100000))
+
+# Telegram ids allowed to use admin commands such as /stats
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+# Prometheus metrics endpoint (http://METRICS_LISTEN:METRICS_PORT/metrics); 0 turns it off
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+
+# Multi-process mode: worker processes, updates queued per worker, and health report interval
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', os.cpu_count() or 1))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 1000))
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', 5))
+
+# Polling startup: drain the updates that queued up while the bot was down in batches first
+CATCH_UP = os.getenv('CATCH_UP', '1') == '1'
+CATCH_UP_BATCH_SIZE = int(os.getenv('CATCH_UP_BATCH_SIZE', 100))  # at most 100, the getUpdates limit
+
+# Cold-user archival: where archived users go (empty turns archival off) and how long inactive users stay
+ARCHIVE_PATH = os.getenv('ARCHIVE_PATH', '')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+
+# Online backups: seconds between snapshots (0 turns them off), where they go and how many are kept
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL', 0))
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))
+# Pages copied per step, and the pause between steps (seconds)
+BACKUP_STEP_PAGES = int(os.getenv('BACKUP_STEP_PAGES', 256))
+BACKUP_STEP_PAUSE = float(os.getenv('BACKUP_STEP_PAUSE', 0.01))
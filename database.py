@@ -1,61 +1,364 @@
+import functools
+import json
+import logging
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 import os
+import config
+import metrics
+import migrations
+from cache import LRUCache
 
+logger = logging.getLogger(__name__)
+
+# How long a connection waits on a locked database before giving up (ms)
+BUSY_TIMEOUT_MS = 5000
+
+# Number of prepared statements kept per connection
+STATEMENT_CACHE_SIZE = 128
+
+# Cached user rows: how many to keep and for how long (seconds)
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# Reasons recorded in the token ledger
+LEDGER_TRIAL = 'trial'
+LEDGER_PURCHASE = 'purchase'
+LEDGER_SEARCH = 'search'
+LEDGER_ADJUSTMENT = 'adjustment'
+
+# Days left in the trial, rounded up; SQLite has no portable CEIL, so it is spelled out
+_TRIAL_LEFT = "(julianday(trial_expires_at) - julianday('now'))"
+DAYS_REMAINING_SQL = f"MAX(0, CAST({_TRIAL_LEFT} AS INTEGER) + ({_TRIAL_LEFT} > CAST({_TRIAL_LEFT} AS INTEGER)))"
+
+# Whether the trial is still running
+TRIAL_ACTIVE_SQL = "trial_expires_at > datetime('now')"
+
+# Tables moved to the archive database, with the column naming the user
+ARCHIVED_TABLES = (('users', 'id'), ('payments', 'user_id'), ('token_ledger', 'user_id'))
+
+# Cold users: the trial ended, and no visit or payment since, this long ago
+COLD_USER_SQL = """
+    trial_expires_at < datetime('now', :age) AND last_access < datetime('now', :age)
+    AND NOT EXISTS (
+        SELECT 1 FROM payments p WHERE p.user_id = users.id AND p.payment_date >= datetime('now', :age)
+    )
+"""
+
+# Buffered last_access updates are written out after this many seconds...
+LAST_ACCESS_FLUSH_INTERVAL = 30
+
+# ...or as soon as this many users are waiting, whichever comes first
+LAST_ACCESS_FLUSH_SIZE = 500
+
+def _sql_time(value=None):
+    """Format a UTC datetime (default now) the way CURRENT_TIMESTAMP stores it"""
+    if value is None:
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+# Extra attempts for a call that still found the database locked after busy_timeout
+LOCK_RETRIES = 3
+
+# Wait before the first retry of a locked call; doubled on each retry (seconds)
+LOCK_RETRY_BACKOFF = 0.05
+
+# Database methods left out of metrics and lock retries
+UNINSTRUMENTED_METHODS = {'get_connection', 'close', 'init_db'}
+
+# Whether the calling thread is inside an instrumented Database call, and whether that call has committed
+_instrumented_call = threading.local()
+
+def _instrumented(name, method):
+    """Wrap a Database method to time it and retry it while the database is locked
+
+    Only the outermost call on a thread is counted and retried: a method
+    called by another, like charge_searches by charge_search, runs bare so
+    its time is not counted twice and its retries do not multiply. A call
+    is only retried while nothing it did has been committed, so a write is
+    never applied twice.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_instrumented_call, 'active', False):
+            return method(self, *args, **kwargs)
+
+        _instrumented_call.active = True
+        started = time.perf_counter()
+        try:
+            for attempt in range(LOCK_RETRIES + 1):
+                _instrumented_call.committed = False
+                try:
+                    return method(self, *args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if 'database is locked' not in str(e) or attempt == LOCK_RETRIES or _instrumented_call.committed:
+                        raise
+                    # Drop the failed transaction before trying again
+                    self.get_connection().rollback()
+                    metrics.DB_LOCK_RETRIES.inc(name)
+                    time.sleep(LOCK_RETRY_BACKOFF * 2 ** attempt)
+        except Exception:
+            metrics.DB_ERRORS.inc(name)
+            raise
+        finally:
+            _instrumented_call.active = False
+            metrics.DB_CALLS.inc(name)
+            metrics.DB_SECONDS.observe(name, time.perf_counter() - started)
+    return wrapper
+
+def _instrument(cls):
+    """Instrument every public method of cls"""
+    for name, method in list(vars(cls).items()):
+        if callable(method) and not name.startswith('_') and name not in UNINSTRUMENTED_METHODS:
+            setattr(cls, name, _instrumented(name, method))
+    return cls
+
+@_instrument
 class Database:
-    def __init__(self, db_path='users.db'):
+    def __init__(self, db_path='users.db', busy_timeout=BUSY_TIMEOUT_MS,
+                 last_access_flush_interval=LAST_ACCESS_FLUSH_INTERVAL,
+                 last_access_flush_size=LAST_ACCESS_FLUSH_SIZE,
+                 user_cache_size=USER_CACHE_SIZE, user_cache_ttl=USER_CACHE_TTL,
+                 trial_days=config.TRIAL_DAYS, trial_tokens=config.TRIAL_TOKENS, archive_path=None):
         self.db_path = db_path
+        # Cold users are moved to this database and restored from it when they return
+        self.archive_path = archive_path
+        self._archive_columns = {}
+        self.trial_days = trial_days
+        self.trial_tokens = trial_tokens
+        self.busy_timeout = busy_timeout
+        self.last_access_flush_interval = last_access_flush_interval
+        self.last_access_flush_size = last_access_flush_size
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._pending_access = {}
+        self._pending_access_lock = threading.Lock()
+        self._last_access_flushed = time.monotonic()
+        self.user_cache = LRUCache(maxsize=user_cache_size, ttl=user_cache_ttl)
         self.init_db()
     
+    def _commit(self, conn):
+        """Commit, after which the running call is no longer retried when the database is locked"""
+        conn.commit()
+        _instrumented_call.committed = True
+    
+    def _connect(self):
+        """Open a new tuned connection to the database file"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout / 1000,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False
+        )
+        # Lets compaction hand free pages back a few at a time; set before a new file gets its first table
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute('PRAGMA foreign_keys = ON')
+        if self.archive_path:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            # Commits spanning two WAL files are not atomic, so users are moved in two steps
+            conn.execute('PRAGMA archive.journal_mode = WAL')
+        return conn
+    
+    def get_connection(self):
+        """Return the long-lived connection owned by the calling thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def close(self):
+        """Flush buffered writes and close every pooled connection"""
+        self.flush_last_access()
+        
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        # Threads still holding a closed connection reconnect on next use
+        self._local = threading.local()
+    
     def init_db(self):
-        """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_path)
+        """Bring the schema up to date by applying pending migrations"""
+        migrations.migrate(self)
+        if self.archive_path:
+            self._init_archive()
+    
+    def _init_archive(self):
+        """Create the archive tables, or add the columns live tables gained since"""
+        conn = self.get_connection()
+        for table, _ in ARCHIVED_TABLES:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0')
+            columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+            archived = {row[1] for row in conn.execute(f'PRAGMA archive.table_info({table})')}
+            for column in columns:
+                if column not in archived:
+                    conn.execute(f'ALTER TABLE archive.{table} ADD COLUMN {column}')
+            conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_{table}_id ON {table} (id)')
+            self._archive_columns[table] = ', '.join(columns)
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_users_telegram_id ON users (telegram_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_payments_user ON payments (user_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_token_ledger_user ON token_ledger (user_id)')
+        self._commit(conn)
+    
+    def _copy_users(self, cursor, source, target, user_ids):
+        """Copy users with their payments and ledger from source to target, inside the caller's transaction
+        
+        Only target is written: a commit that spans two WAL databases is not
+        atomic, so the source rows are deleted in a later transaction by
+        _delete_copied_users.
+        """
+        ids = json.dumps(user_ids)
+        for table, key in ARCHIVED_TABLES:
+            columns = self._archive_columns[table]
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO {target}.{table} ({columns})
+                SELECT {columns} FROM {source}.{table} WHERE {key} IN (SELECT value FROM json_each(?))
+            ''', (ids,))
+    
+    def _delete_copied_users(self, cursor, source, target, user_ids, unchanged=True):
+        """Delete users from source whose rows are in target, inside the caller's transaction
+        
+        Only rows whose id is in target are deleted, so repeating it after a
+        crash is safe. With unchanged, users whose rows in source differ from
+        their copies, e.g. who came back since, are kept whole. Returns the
+        telegram_ids of the users deleted.
+        """
+        if unchanged:
+            changed = set()
+            for table, key in ARCHIVED_TABLES:
+                columns = self._archive_columns[table]
+                cursor.execute(f'''
+                    SELECT DISTINCT {key} FROM (
+                        SELECT {columns} FROM {source}.{table} WHERE {key} IN (SELECT value FROM json_each(:ids))
+                        EXCEPT
+                        SELECT {columns} FROM {target}.{table} WHERE {key} IN (SELECT value FROM json_each(:ids))
+                    )
+                ''', {'ids': json.dumps(user_ids)})
+                changed.update(row[0] for row in cursor.fetchall())
+            user_ids = [user_id for user_id in user_ids if user_id not in changed]
+        
+        ids = json.dumps(user_ids)
+        # Ledger rows point at payments, and both at users
+        for table, key in reversed(ARCHIVED_TABLES[1:]):
+            cursor.execute(f'''
+                DELETE FROM {source}.{table}
+                WHERE {key} IN (SELECT value FROM json_each(?)) AND id IN (SELECT id FROM {target}.{table})
+            ''', (ids,))
+        cursor.execute(f'''
+            DELETE FROM {source}.users
+            WHERE id IN (SELECT value FROM json_each(?)) AND id IN (SELECT id FROM {target}.users)
+            RETURNING telegram_id
+        ''', (ids,))
+        return [row[0] for row in cursor.fetchall()]
+    
+    def _restore_users(self, cursor, where, params=()):
+        """Copy archived users matching a WHERE clause back, inside the caller's transaction
+        
+        The archive copies are deleted by _drop_restored once the caller has
+        committed. Returns the number restored; 0 when there is no archive.
+        """
+        if not self.archive_path:
+            return 0
+        # A user somehow present in both is never overwritten from the archive
+        cursor.execute(f'''
+            SELECT id FROM archive.users
+            WHERE ({where}) AND telegram_id NOT IN (SELECT telegram_id FROM main.users)
+        ''', params)
+        user_ids = [row[0] for row in cursor.fetchall()]
+        if user_ids:
+            self._copy_users(cursor, 'archive', 'main', user_ids)
+            self._local.restored = getattr(self._local, 'restored', []) + user_ids
+        return len(user_ids)
+    
+    def _drop_restored(self):
+        """Delete the archive copies of the users this thread restored, in a transaction of its own
+        
+        Only copies already in the live database go, so after a rollback nothing
+        is lost; copies left by a crash or a lock are removed by
+        purge_restored_copies. The restore is already committed, so a locked
+        database is logged rather than raised.
+        """
+        user_ids = getattr(self._local, 'restored', None)
+        if not user_ids:
+            return
+        self._local.restored = []
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            self._delete_copied_users(cursor, 'archive', 'main', user_ids, unchanged=False)
+            self._commit(conn)
+        except sqlite3.Error as e:
+            conn.rollback()
+            if 'database is locked' not in str(e):
+                raise
+            logger.warning("Archive copies of %s restored users left for purge_restored_copies: %s", len(user_ids), e)
+    
+    def _restore_user(self, telegram_id):
+        """Restore an archived user in a transaction of its own; False if they are not archived"""
+        if not self.archive_path:
+            return False
+        conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                tokens INTEGER DEFAULT 10,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_access TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        cursor.execute('SELECT 1 FROM archive.users WHERE telegram_id = ?', (telegram_id,))
+        if cursor.fetchone() is None:
+            return False
         
-        # Create payments table
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            restored = self._restore_users(cursor, 'telegram_id = ?', (telegram_id,))
+            self._commit(conn)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        self._drop_restored()
+        return restored > 0
+    
+    def _record_ledger(self, cursor, user_id, delta, reason, payment_id=None, update_id=None):
+        """Append a ledger entry inside the caller's transaction"""
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                tokens INTEGER NOT NULL,
-                payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+            INSERT INTO token_ledger (user_id, delta, reason, payment_id, update_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, delta, reason, payment_id, update_id))
     
     def get_user(self, telegram_id):
         """Get user by telegram_id"""
-        conn = sqlite3.connect(self.db_path)
+        cached = self.user_cache.get(telegram_id)
+        if cached is not None:
+            return dict(cached)
+        
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
             SELECT id, telegram_id, username, first_name, last_name, tokens, created_at, last_access
             FROM users WHERE telegram_id = ?
         ''', (telegram_id,))
-        
         user = cursor.fetchone()
-        conn.close()
+        
+        # A returning user who was archived is brought back on the first miss
+        if user is None and self._restore_user(telegram_id):
+            cursor.execute('''
+                SELECT id, telegram_id, username, first_name, last_name, tokens, created_at, last_access
+                FROM users WHERE telegram_id = ?
+            ''', (telegram_id,))
+            user = cursor.fetchone()
         
         if user:
-            return {
+            user = {
                 'id': user[0],
                 'telegram_id': user[1],
                 'username': user[2],
@@ -65,33 +368,32 @@ class Database:
                 'created_at': user[6],
                 'last_access': user[7]
             }
+            self.user_cache.set(telegram_id, dict(user))
+            return user
         return None
     
     def create_user(self, telegram_id, username=None, first_name=None, last_name=None):
         """Create a new user"""
-        conn = sqlite3.connect(self.db_path)
+        # An archived user is restored rather than given a second trial
+        self._restore_user(telegram_id)
+        
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         try:
             cursor.execute('''
-                INSERT INTO users (telegram_id, username, first_name, last_name, tokens)
-                VALUES (?, ?, ?, ?, 10)
-            ''', (telegram_id, username, first_name, last_name))
-            
-            conn.commit()
-            user_id = cursor.lastrowid
-            
-            # Get the created user
-            cursor.execute('''
-                SELECT id, telegram_id, username, first_name, last_name, tokens, created_at, last_access
-                FROM users WHERE id = ?
-            ''', (user_id,))
+                INSERT INTO users (telegram_id, username, first_name, last_name, tokens, trial_expires_at)
+                VALUES (?, ?, ?, ?, ?, datetime('now', ?))
+                RETURNING id, telegram_id, username, first_name, last_name, tokens, created_at, last_access
+            ''', (telegram_id, username, first_name, last_name, self.trial_tokens, f'+{self.trial_days} days'))
             
             user = cursor.fetchone()
-            conn.close()
+            if user:
+                self._record_ledger(cursor, user[0], user[5], LEDGER_TRIAL)
+            self._commit(conn)
             
             if user:
-                return {
+                user = {
                     'id': user[0],
                     'telegram_id': user[1],
                     'username': user[2],
@@ -101,80 +403,356 @@ class Database:
                     'created_at': user[6],
                     'last_access': user[7]
                 }
+                self.user_cache.set(telegram_id, dict(user))
+                return user
             return None
         except sqlite3.IntegrityError:
-            conn.close()
+            conn.rollback()
             return None
     
     def update_last_access(self, user_id):
-        """Update user's last access time"""
-        conn = sqlite3.connect(self.db_path)
+        """Record user's last access time, written to the database in batches"""
+        # Same format as CURRENT_TIMESTAMP so buffered and direct writes compare cleanly
+        now = _sql_time()
+        
+        with self._pending_access_lock:
+            self._pending_access[user_id] = now
+            due = (
+                len(self._pending_access) >= self.last_access_flush_size
+                or time.monotonic() - self._last_access_flushed >= self.last_access_flush_interval
+            )
+        
+        if due:
+            self.flush_last_access()
+    
+    def flush_last_access(self):
+        """Write all buffered last_access times in one transaction"""
+        with self._pending_access_lock:
+            pending, self._pending_access = self._pending_access, {}
+            self._last_access_flushed = time.monotonic()
+        
+        if not pending:
+            return 0
+        
+        conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            UPDATE users SET last_access = CURRENT_TIMESTAMP WHERE id = ?
-        ''', (user_id,))
+        try:
+            cursor.executemany('''
+                UPDATE users SET last_access = ? WHERE id = ?
+            ''', [(last_access, user_id) for user_id, last_access in pending.items()])
+            
+            self._commit(conn)
+        except sqlite3.Error:
+            conn.rollback()
+            # Put the timestamps back unless a newer one arrived meanwhile
+            with self._pending_access_lock:
+                for user_id, last_access in pending.items():
+                    self._pending_access.setdefault(user_id, last_access)
+            raise
         
-        conn.commit()
-        conn.close()
+        return len(pending)
     
     def use_token(self, user_id):
         """Use one token from user's balance"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
             UPDATE users SET tokens = tokens - 1 WHERE id = ? AND tokens > 0
+            RETURNING telegram_id, tokens
         ''', (user_id,))
         
-        conn.commit()
-        rows_affected = cursor.rowcount
-        conn.close()
+        result = cursor.fetchone()
+        if result:
+            self._record_ledger(cursor, user_id, -1, LEDGER_SEARCH)
+        self._commit(conn)
         
-        return rows_affected > 0
+        if result:
+            self._cache_tokens(*result)
+        
+        return result is not None
+    
+    def _cache_tokens(self, telegram_id, tokens):
+        """Write a new balance through to the cached user, if any"""
+        self.user_cache.update(telegram_id, lambda user: {**user, 'tokens': tokens})
+    
+    def _charge(self, cursor, telegram_id, username, first_name, last_name, update_id):
+        """Create the user if needed and charge one search token inside the caller's transaction
+        
+        Returns (charged, replayed, (user_id, tokens, days_remaining, is_active)).
+        """
+        if update_id is not None:
+            # A redelivered update reports the charge it already made
+            cursor.execute(f'''
+                SELECT u.id,
+                       (SELECT SUM(l.delta) FROM token_ledger l WHERE l.user_id = u.id AND l.id <= c.id),
+                       {DAYS_REMAINING_SQL}, 1
+                FROM token_ledger c JOIN users u ON u.id = c.user_id
+                WHERE c.update_id = ?
+            ''', (update_id,))
+            previous = cursor.fetchone()
+            if previous:
+                return True, True, previous
+        
+        # An archived user is restored rather than given a second trial
+        self._restore_users(cursor, 'telegram_id = ?', (telegram_id,))
+        
+        cursor.execute('''
+            INSERT INTO users (telegram_id, username, first_name, last_name, tokens, trial_expires_at)
+            VALUES (?, ?, ?, ?, ?, datetime('now', ?))
+            ON CONFLICT (telegram_id) DO NOTHING
+            RETURNING id, tokens
+        ''', (telegram_id, username, first_name, last_name, self.trial_tokens, f'+{self.trial_days} days'))
+        
+        created = cursor.fetchone()
+        if created:
+            self._record_ledger(cursor, created[0], created[1], LEDGER_TRIAL)
+        
+        cursor.execute(f'''
+            UPDATE users SET tokens = tokens - 1, last_access = CURRENT_TIMESTAMP
+            WHERE telegram_id = ? AND tokens > 0 AND {TRIAL_ACTIVE_SQL}
+            RETURNING id, tokens, {DAYS_REMAINING_SQL}, 1
+        ''', (telegram_id,))
+        
+        result = cursor.fetchone()
+        if result:
+            self._record_ledger(cursor, result[0], -1, LEDGER_SEARCH, update_id=update_id)
+            return True, False, result
+        
+        cursor.execute(f'''
+            SELECT id, tokens, {DAYS_REMAINING_SQL}, {TRIAL_ACTIVE_SQL}
+            FROM users WHERE telegram_id = ?
+        ''', (telegram_id,))
+        return False, False, cursor.fetchone()
+    
+    def _charge_result(self, telegram_id, charged, replayed, row):
+        user_id, tokens, days_remaining, is_active = row
+        
+        # A replayed charge reports an old balance, so only new ones go to the cache
+        if charged and not replayed:
+            self._cache_tokens(telegram_id, tokens)
+        
+        return {
+            'charged': charged,
+            'user_id': user_id,
+            'tokens': tokens,
+            'days_remaining': days_remaining,
+            'is_active': bool(is_active),
+            'has_tokens': tokens > 0
+        }
+    
+    def charge_search(self, telegram_id, username=None, first_name=None, last_name=None, update_id=None):
+        """Get or create a user and charge one search token in a single transaction
+        
+        A charge made with an update_id is made once: calling again with the same
+        update_id returns the balance left by the original charge.
+        """
+        return self.charge_searches([{
+            'telegram_id': telegram_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'update_id': update_id
+        }])[0]
+    
+    def charge_searches(self, searches):
+        """Charge a batch of searches in one transaction, in order
+        
+        searches is a list of dicts with telegram_id and optionally username,
+        first_name, last_name and update_id. Returns a charge_search result
+        for each.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # Take the write lock up front so concurrent charges queue instead of racing
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            charges = []
+            for search in searches:
+                charges.append((search['telegram_id'], *self._charge(
+                    cursor,
+                    search['telegram_id'],
+                    search.get('username'),
+                    search.get('first_name'),
+                    search.get('last_name'),
+                    search.get('update_id')
+                )))
+            
+            self._commit(conn)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        self._drop_restored()
+        
+        return [self._charge_result(*charge) for charge in charges]
     
     def add_tokens(self, user_id, tokens):
         """Add tokens to user's balance"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
+        self._restore_users(cursor, 'id = ?', (user_id,))
         cursor.execute('''
             UPDATE users SET tokens = tokens + ? WHERE id = ?
+            RETURNING telegram_id, tokens
         ''', (tokens, user_id))
         
-        conn.commit()
-        conn.close()
+        result = cursor.fetchone()
+        if result:
+            self._record_ledger(cursor, user_id, tokens, LEDGER_ADJUSTMENT)
+        self._commit(conn)
+        self._drop_restored()
+        
+        if result:
+            self._cache_tokens(*result)
     
     def get_user_token_status(self, user_id):
-        """Check if user has tokens and if they're still valid (within 3 days)"""
-        conn = sqlite3.connect(self.db_path)
+        """Check if user has tokens and if their trial is still running"""
+        conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT tokens, created_at FROM users WHERE id = ?
+        cursor.execute(f'''
+            SELECT tokens, {DAYS_REMAINING_SQL}, {TRIAL_ACTIVE_SQL}
+            FROM users WHERE id = ?
         ''', (user_id,))
         
         result = cursor.fetchone()
-        conn.close()
         
         if result:
-            tokens, created_at = result
-            created_date = datetime.fromisoformat(created_at)
-            now = datetime.now()
-            days_since_creation = (now - created_date).days
+            tokens, days_remaining, is_active = result
             
             return {
                 'tokens': tokens,
-                'days_remaining': max(0, 3 - days_since_creation),
-                'is_active': days_since_creation < 3,
+                'days_remaining': days_remaining,
+                'is_active': bool(is_active),
                 'has_tokens': tokens > 0
             }
         
         return None
     
+    def find_expiring_trials(self, end, start=None):
+        """Return users whose running trial ends after start (default now) and by end
+        
+        start and end are UTC datetimes or 'YYYY-MM-DD HH:MM:SS' strings.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, telegram_id, tokens, trial_expires_at FROM users
+            WHERE trial_expired = 0 AND trial_expires_at > ? AND trial_expires_at <= ?
+            ORDER BY trial_expires_at
+        ''', (_sql_time(start), _sql_time(end)))
+        
+        return [
+            {'id': row[0], 'telegram_id': row[1], 'tokens': row[2], 'trial_expires_at': row[3]}
+            for row in cursor.fetchall()
+        ]
+    
+    def sweep_expired_trials(self, until=None):
+        """Mark every trial that ended by until (default now) as expired in one indexed UPDATE
+        
+        Returns (id, telegram_id) of the users marked by this sweep.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE users SET trial_expired = 1
+            WHERE trial_expired = 0 AND trial_expires_at <= ?
+            RETURNING id, telegram_id
+        ''', (_sql_time(until),))
+        
+        expired = cursor.fetchall()
+        self._commit(conn)
+        
+        return expired
+    
+    def find_cold_users(self, age, after_id=0, limit=500):
+        """Return the ids of up to limit cold users after a user id, without locking writers
+        
+        age is an SQLite modifier such as '-90 days'.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT id FROM users
+            WHERE id > :after_id AND {COLD_USER_SQL}
+            ORDER BY id LIMIT :limit
+        ''', {'after_id': after_id, 'age': age, 'limit': limit})
+        
+        return [row[0] for row in cursor.fetchall()]
+    
+    def archive_users(self, user_ids, age):
+        """Move the given users that are still cold to the archive, with their payments and ledger
+        
+        Returns the number of users archived.
+        """
+        if not self.archive_path:
+            raise RuntimeError("No archive database configured")
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            # Someone may have come back since find_cold_users
+            cursor.execute(f'''
+                SELECT id FROM users
+                WHERE id IN (SELECT value FROM json_each(:ids)) AND {COLD_USER_SQL}
+            ''', {'ids': json.dumps(user_ids), 'age': age})
+            cold = [row[0] for row in cursor.fetchall()]
+            if not cold:
+                conn.rollback()
+                return 0
+            
+            # Copy first and commit, then delete what reached the archive
+            self._copy_users(cursor, 'main', 'archive', cold)
+            self._commit(conn)
+            
+            cursor.execute('BEGIN IMMEDIATE')
+            archived = self._delete_copied_users(cursor, 'main', 'archive', cold)
+            self._commit(conn)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        
+        for telegram_id in archived:
+            self.user_cache.invalidate(telegram_id)
+        
+        return len(archived)
+    
+    def purge_restored_copies(self):
+        """Delete archive copies of users who are back in the live database, e.g. after a crash
+        
+        Returns the number of copies deleted.
+        """
+        if not self.archive_path:
+            return 0
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT id FROM archive.users WHERE id IN (SELECT id FROM main.users)')
+            user_ids = [row[0] for row in cursor.fetchall()]
+            purged = self._delete_copied_users(cursor, 'archive', 'main', user_ids, unchanged=False)
+            self._commit(conn)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        
+        return len(purged)
+    
     def add_payment(self, user_id, amount, tokens):
         """Record a payment"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -182,8 +760,207 @@ class Database:
             VALUES (?, ?, ?)
         ''', (user_id, amount, tokens))
         
-        conn.commit()
+        self._commit(conn)
         payment_id = cursor.lastrowid
-        conn.close()
         
-        return payment_id
\ No newline at end of file
+        return payment_id
+    
+    def confirm_payments(self, confirmations):
+        """Record payments and credit their tokens in one transaction
+        
+        confirmations is a list of (user_id, amount, tokens, reference) tuples.
+        Payments whose reference is already recorded (or repeated within the
+        list) and payments for unknown users are skipped. Returns the applied
+        confirmations in input order.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            cursor.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS pending_payments (
+                    seq INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    amount REAL NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    reference TEXT
+                )
+            ''')
+            cursor.execute('DELETE FROM temp.pending_payments')
+            
+            cursor.executemany('''
+                INSERT INTO temp.pending_payments (user_id, amount, tokens, reference)
+                VALUES (?, ?, ?, ?)
+            ''', confirmations)
+            
+            # Archived buyers come back with their old payments, so their references are known
+            self._restore_users(cursor, 'id IN (SELECT user_id FROM temp.pending_payments)')
+            
+            # Set-based dedupe: drop known references, repeats and unknown users
+            cursor.execute('''
+                DELETE FROM temp.pending_payments
+                WHERE reference IN (SELECT reference FROM payments WHERE reference IS NOT NULL)
+                   OR seq NOT IN (
+                       SELECT MIN(seq) FROM temp.pending_payments
+                       GROUP BY COALESCE(reference, 'seq:' || seq)
+                   )
+                   OR user_id NOT IN (SELECT id FROM users)
+            ''')
+            
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM payments')
+            last_payment_id = cursor.fetchone()[0]
+            
+            cursor.execute('''
+                INSERT INTO payments (user_id, amount, tokens, reference)
+                SELECT user_id, amount, tokens, reference
+                FROM temp.pending_payments ORDER BY seq
+            ''')
+            
+            cursor.execute('''
+                INSERT INTO token_ledger (user_id, delta, reason, payment_id)
+                SELECT user_id, tokens, ?, id FROM payments WHERE id > ?
+            ''', (LEDGER_PURCHASE, last_payment_id))
+            
+            cursor.execute('''
+                UPDATE users SET tokens = tokens + (
+                    SELECT SUM(tokens) FROM temp.pending_payments p WHERE p.user_id = users.id
+                )
+                WHERE id IN (SELECT user_id FROM temp.pending_payments)
+                RETURNING telegram_id, tokens
+            ''')
+            balances = cursor.fetchall()
+            
+            cursor.execute('''
+                SELECT user_id, amount, tokens, reference
+                FROM temp.pending_payments ORDER BY seq
+            ''')
+            applied = cursor.fetchall()
+            
+            cursor.execute('DELETE FROM temp.pending_payments')
+            self._commit(conn)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        self._drop_restored()
+        
+        for telegram_id, tokens in balances:
+            self._cache_tokens(telegram_id, tokens)
+        
+        return applied
+    
+    def get_token_history(self, user_id, limit=50):
+        """Return a user's most recent ledger entries, newest first"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, delta, reason, created_at FROM token_ledger
+            WHERE user_id = ? ORDER BY id DESC LIMIT ?
+        ''', (user_id, limit))
+        
+        return [
+            {'id': row[0], 'delta': row[1], 'reason': row[2], 'created_at': row[3]}
+            for row in cursor.fetchall()
+        ]
+    
+    def get_payment_history(self, user_id):
+        """Return a user's payments, newest first"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT payment_date, amount, tokens FROM payments
+            WHERE user_id = ? ORDER BY payment_date DESC
+        ''', (user_id,))
+        
+        return [
+            {'payment_date': row[0], 'amount': row[1], 'tokens': row[2]}
+            for row in cursor.fetchall()
+        ]
+    
+    def reconcile_balance(self, user_id):
+        """Compare a user's materialized balance with the sum of their ledger"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT tokens, (SELECT COALESCE(SUM(delta), 0) FROM token_ledger WHERE user_id = users.id)
+            FROM users WHERE id = ?
+        ''', (user_id,))
+        
+        result = cursor.fetchone()
+        if result:
+            balance, ledger_total = result
+            return {
+                'balance': balance,
+                'ledger_total': ledger_total,
+                'consistent': balance == ledger_total
+            }
+        return None
+    
+    def find_balance_mismatches(self):
+        """Return (user_id, balance, ledger_total) for every user whose balance drifted"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        # A full pass over every user and the whole ledger, for offline checks; the ledger
+        # is summed from the covering idx_token_ledger_user rather than the table
+        cursor.execute('''
+            SELECT u.id, u.tokens, COALESCE(l.total, 0)
+            FROM users u
+            LEFT JOIN (
+                SELECT user_id, SUM(delta) AS total FROM token_ledger GROUP BY user_id
+            ) l ON l.user_id = u.id
+            WHERE u.tokens IS NOT COALESCE(l.total, 0)
+        ''')
+        
+        return cursor.fetchall()
+    
+    def get_daily_revenue(self, start, end):
+        """Return payments, tokens sold and revenue per day for start <= day < end"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT date(payment_date), COUNT(*), SUM(tokens), SUM(amount)
+            FROM payments
+            WHERE payment_date >= ? AND payment_date < ?
+            GROUP BY date(payment_date)
+            ORDER BY 1
+        ''', (str(start), str(end)))
+        
+        return [
+            {'day': row[0], 'payments': row[1], 'tokens': row[2], 'revenue': row[3]}
+            for row in cursor.fetchall()
+        ]
+    
+    def get_update_offset(self):
+        """Return the last update_id whose handling was committed, 0 if none"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT value FROM bot_state WHERE key = 'update_offset'")
+        
+        return cursor.fetchone()[0]
+    
+    def save_update_offset(self, update_id):
+        """Move the committed update offset forward; an older update_id is ignored"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE bot_state SET value = ? WHERE key = 'update_offset' AND value < ?
+        ''', (update_id, update_id))
+        
+        self._commit(conn)
+    
+    def reset_update_offset(self, update_id):
+        """Set the committed update offset, also lower, after Telegram restarted its update_ids"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("UPDATE bot_state SET value = ? WHERE key = 'update_offset'", (update_id,))
+        
+        self._commit(conn)
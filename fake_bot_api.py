@@ -0,0 +1,188 @@
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# Longest a getUpdates request is held open waiting for updates (seconds)
+MAX_POLL_WAIT = 1.0
+
+class FakeBotApi:
+    """Local stand-in for the Telegram Bot API
+
+    Serves http://host:port/bot<token>/<method>, records every call and
+    answers with plausible results. Updates queued with add_updates are
+    served through getUpdates, and failures queued with fail are returned
+    before the method succeeds again. Files uploaded with sendPhoto or
+    sendDocument are kept in uploads as (method, filename, content), and
+    each upload takes upload_delay seconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, upload_delay=0):
+        self.calls = []
+        self.uploads = []
+        self.upload_delay = upload_delay
+        self._updates = deque()
+        self._failures = {}
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._updates_ready = threading.Condition(self._lock)
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._updates_ready:
+            self._updates_ready.notify_all()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def fail(self, method, times=1, error_code=429, retry_after=1, description='Too Many Requests: retry later'):
+        """Make the next times calls to method fail with the given error"""
+        with self._lock:
+            self._failures.setdefault(method, deque()).extend(
+                [(error_code, description, retry_after)] * times
+            )
+
+    def add_updates(self, updates):
+        """Queue updates for getUpdates, assigning update_ids where missing"""
+        with self._updates_ready:
+            for update in updates:
+                update.setdefault('update_id', next(self._update_ids))
+                self._updates.append((time.monotonic(), update))
+            self._updates_ready.notify_all()
+
+    def pending_updates(self):
+        with self._lock:
+            return len(self._updates)
+
+    def calls_to(self, method):
+        """Return the recorded (timestamp, params) of every call to method"""
+        with self._lock:
+            return [(at, params) for at, name, params in self.calls if name == method]
+
+    def calls_after(self, position):
+        """Return the (timestamp, method, params) calls recorded since position and the new position"""
+        with self._lock:
+            return self.calls[position:], len(self.calls)
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = min(float(params.get('timeout') or 0), MAX_POLL_WAIT)
+
+        with self._updates_ready:
+            # An offset confirms every earlier update, as in the real API
+            while self._updates and self._updates[0][1]['update_id'] < offset:
+                self._updates.popleft()
+            if not self._updates and timeout:
+                self._updates_ready.wait(timeout)
+            return [update for _, update in itertools.islice(self._updates, limit)]
+
+    def _result(self, method, params):
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method in ('sendMessage', 'editMessageText', 'sendDocument', 'sendPhoto'):
+            chat_id = params.get('chat_id')
+            message = {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+            if method == 'sendDocument':
+                message['document'] = self._file(params.get('document'))
+            elif method == 'sendPhoto':
+                message['photo'] = [dict(self._file(params.get('photo')), width=90, height=90)]
+            return message
+        return True
+
+    def _file(self, sent):
+        """Describe a sent file: an upload gets a file_id derived from its content, a file_id is echoed"""
+        if isinstance(sent, bytes):
+            time.sleep(self.upload_delay)
+            file_id = 'file-' + hashlib.sha256(sent).hexdigest()[:16]
+            return {'file_id': file_id, 'file_unique_id': file_id[5:13], 'file_size': len(sent)}
+        return {'file_id': sent, 'file_unique_id': str(sent)[5:13]}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                params, files = server.parse_params(self.headers.get('Content-Type', ''), body)
+                params.update((name, content) for name, _, content in files)
+
+                with server._lock:
+                    server.calls.append((time.monotonic(), method, params))
+                    server.uploads.extend((method, filename, content) for _, filename, content in files)
+                    failures = server._failures.get(method)
+                    failure = failures.popleft() if failures else None
+
+                if failure:
+                    error_code, description, retry_after = failure
+                    payload = {'ok': False, 'error_code': error_code, 'description': description}
+                    if retry_after is not None:
+                        payload['parameters'] = {'retry_after': retry_after}
+                    self._respond(error_code, payload)
+                else:
+                    self._respond(200, {'ok': True, 'result': server._result(method, params)})
+
+            do_GET = do_POST
+
+            def _respond(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @staticmethod
+    def parse_params(content_type, body):
+        """Decode a JSON, form-encoded or multipart request body into params and (name, filename, content) files"""
+        if not body:
+            return {}, []
+        if content_type.startswith('application/json'):
+            return json.loads(body), []
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=HTTP).parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            params, files = {}, []
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                content = part.get_payload(decode=True)
+                if part.get_filename() is None:
+                    params[name] = content.decode()
+                else:
+                    files.append((name, part.get_filename(), content))
+            return params, files
+        return dict(parse_qsl(body.decode())), []
@@ -0,0 +1,129 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from itertools import islice
+
+import config
+from catalog import Catalog
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Rows written per transaction
+BATCH_SIZE = 5000
+
+# Longest title accepted (characters)
+MAX_TITLE_LENGTH = 500
+
+def read_records(path, fmt=None):
+    """Yield raw records from a JSONL or CSV dump one at a time, with their line numbers"""
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'jsonl':
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError:
+                    yield line_number, None
+        elif fmt == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            raise ValueError(f"Unsupported format: {fmt!r} (expected jsonl or csv)")
+
+def validate_records(records, stats):
+    """Yield (external_id, title, summary, source, attachment) rows for valid records, counting the rest"""
+    for line_number, record in records:
+        if not isinstance(record, dict):
+            stats['invalid'] += 1
+            logger.warning("Line %s: not a record", line_number)
+            continue
+
+        external_id = str(record.get('external_id') or record.get('id') or '').strip()
+        title = str(record.get('title') or '').strip()
+
+        if not external_id or not title or len(title) > MAX_TITLE_LENGTH:
+            stats['invalid'] += 1
+            logger.warning("Line %s: missing id or bad title", line_number)
+            continue
+
+        stats['valid'] += 1
+        yield (
+            external_id,
+            title,
+            str(record.get('summary') or '').strip(),
+            str(record.get('source') or '').strip(),
+            str(record.get('attachment') or '').strip() or None
+        )
+
+def batched(rows, size):
+    """Group an iterator into lists of at most size items"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def ingest(catalog, path, fmt=None, batch_size=BATCH_SIZE, rebuild=False):
+    """Stream a dump into the catalog in batched transactions and return counters"""
+    stats = {'valid': 0, 'invalid': 0, 'changed': 0, 'batches': 0}
+    started = time.monotonic()
+
+    for batch in batched(validate_records(read_records(path, fmt), stats), batch_size):
+        # Each batch commits on its own, so readers are never held up by the whole import
+        stats['changed'] += catalog.upsert_entries(batch)
+        stats['batches'] += 1
+
+        # Keep the index compact as segments accumulate
+        catalog.merge_index()
+
+        elapsed = time.monotonic() - started
+        logger.info(
+            "Batch %s: %s rows processed, %.0f rows/s",
+            stats['batches'], stats['valid'], stats['valid'] / elapsed if elapsed else 0
+        )
+
+    if rebuild:
+        logger.info("Rebuilding search index...")
+        catalog.rebuild_index()
+
+    stats['seconds'] = time.monotonic() - started
+    stats['rows_per_second'] = stats['valid'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+def main() -> None:
+    """Load a catalog dump from the command line."""
+    parser = argparse.ArgumentParser(description="Bulk load catalog entries from a JSONL or CSV dump")
+    parser.add_argument('path', help="dump file with external_id, title, summary, source and attachment fields")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help="defaults to the file extension")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--rebuild', action='store_true', help="rebuild the search index after loading")
+    parser.add_argument('--db', default=config.DATABASE_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    db = Database(args.db)
+    try:
+        stats = ingest(Catalog(db), args.path, args.format, args.batch_size, args.rebuild)
+    finally:
+        db.close()
+
+    logger.info(
+        "Done: %s valid, %s invalid, %s inserted or changed in %.1fs (%.0f rows/s)",
+        stats['valid'], stats['invalid'], stats['changed'], stats['seconds'], stats['rows_per_second']
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+# config reads DATABASE_PATH on import and bot.get_db() opens it on first use;
+# point it at a scratch file before either is imported
+LOAD_DIR = tempfile.mkdtemp(prefix='bot-load-')
+os.environ['DATABASE_PATH'] = os.path.join(LOAD_DIR, 'load.db')
+
+import bot
+from bench import percentile
+from fake_bot_api import FakeBotApi
+
+logger = logging.getLogger(__name__)
+
+# Any well-formed token; the fake API accepts them all
+LOAD_TOKEN = '123456:LOAD'
+
+# Commands sent by simulated users, with their relative frequency
+COMMAND_MIX = [('/search манипуляция', 5), ('/profile', 2), ('/start', 2), ('/help', 1)]
+
+# A step is saturated when replies keep up with less than this share of the offered rate
+SATURATION_THRESHOLD = 0.95
+
+# How often load is added and the backlog sampled (seconds)
+TICK = 0.01
+SAMPLE_INTERVAL = 0.5
+
+class ReplyTracker:
+    """Matches replies recorded by the fake API to the updates that caused them"""
+
+    def __init__(self, server):
+        self.server = server
+        self.queued = {}
+        self.latencies = []
+        self._position = 0
+
+    def collect(self):
+        """Record latencies of replies sent since the last call"""
+        calls, self._position = self.server.calls_after(self._position)
+        for at, method, params in calls:
+            if method == 'sendMessage':
+                update_id = params.get('reply_to_message_id')
+            elif method == 'editMessageText':
+                update_id = params.get('message_id')
+            else:
+                continue
+            queued_at = self.queued.pop(int(update_id or 0), None)
+            if queued_at is not None:
+                self.latencies.append(at - queued_at)
+
+    @property
+    def outstanding(self):
+        return len(self.queued)
+
+def make_update(update_id, user_id, text):
+    # In a group chat PTB quotes the message it answers, which lets replies be matched to updates
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': -user_id, 'type': 'group', 'title': 'load'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        }
+    }
+
+def run_step(server, tracker, rate, duration, users, first_update_id, drain_timeout):
+    """Offer updates at rate per second for duration seconds, then wait for the replies"""
+    commands, weights = zip(*COMMAND_MIX)
+    tracker.latencies = []
+    update_id = first_update_id
+    backlog = []
+
+    started = time.monotonic()
+    next_sample = started
+    while True:
+        now = time.monotonic()
+        elapsed = now - started
+        if elapsed >= duration:
+            break
+
+        due = int(elapsed * rate) - (update_id - first_update_id)
+        if due > 0:
+            batch = []
+            for _ in range(due):
+                update_id += 1
+                batch.append(make_update(update_id, random.randint(1, users), random.choices(commands, weights)[0]))
+                tracker.queued[update_id] = now
+            server.add_updates(batch)
+
+        if now >= next_sample:
+            tracker.collect()
+            backlog.append((round(elapsed, 2), tracker.outstanding))
+            next_sample += SAMPLE_INTERVAL
+
+        time.sleep(TICK)
+
+    tracker.collect()
+    backlog_at_end = tracker.outstanding
+    replied_in_time = len(tracker.latencies)
+
+    deadline = time.monotonic() + drain_timeout
+    while tracker.outstanding and time.monotonic() < deadline:
+        time.sleep(SAMPLE_INTERVAL)
+        tracker.collect()
+
+    offered = update_id - first_update_id
+    latencies = sorted(tracker.latencies)
+    throughput = replied_in_time / duration
+    return update_id, {
+        'offered_rate': rate,
+        'offered': offered,
+        'replied': len(latencies),
+        'lost': tracker.outstanding,
+        'throughput': round(throughput, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'backlog_at_end': backlog_at_end,
+        'backlog_growth_per_second': round((backlog[-1][1] - backlog[0][1]) / duration, 1) if backlog else 0.0,
+        'backlog': backlog,
+        'saturated': throughput < rate * SATURATION_THRESHOLD
+    }
+
+def run_load(rates, duration=10, users=1000, workers=4, drain_timeout=30):
+    """Run the polling Updater against a fake Bot API at increasing rates and report each step"""
+    server = FakeBotApi().start()
+    updater = bot.build_updater(LOAD_TOKEN, base_url=server.base_url, workers=workers)
+    updater.start_polling(poll_interval=0.0, timeout=10)
+    tracker = ReplyTracker(server)
+
+    results = {'workers': workers, 'users': users, 'duration': duration, 'steps': []}
+    update_id = 0
+    try:
+        for rate in rates:
+            tracker.queued.clear()
+            update_id, step = run_step(server, tracker, rate, duration, users, update_id, drain_timeout)
+            results['steps'].append(step)
+            logger.info(
+                "%s updates/s: %.1f replies/s, p95 %.1f ms, backlog %s%s",
+                rate, step['throughput'], step['p95_ms'], step['backlog_at_end'],
+                ' (saturated)' if step['saturated'] else ''
+            )
+            if step['saturated']:
+                break
+    finally:
+        updater.stop()
+        server.stop()
+
+    saturated = [step['offered_rate'] for step in results['steps'] if step['saturated']]
+    results['saturation_rate'] = saturated[0] if saturated else None
+    results['flood_control'] = bot.flood_control.stats()
+    return results
+
+def main() -> None:
+    """Load test the sync runtime from the command line."""
+    parser = argparse.ArgumentParser(description="Load test the polling bot against a local fake Bot API")
+    parser.add_argument('--rates', default='25,50,100,200,400,800',
+                        help="comma separated updates per second, tried in order until saturation")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per rate")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4, help="Updater worker threads")
+    parser.add_argument('--drain-timeout', type=float, default=30)
+    parser.add_argument('--output', default='load_results.json')
+    args = parser.parse_args()
+
+    # Keep the per-request logging of the bot and PTB out of the report
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    try:
+        results = run_load(
+            [float(rate) for rate in args.rates.split(',')],
+            args.duration, args.users, args.workers, args.drain_timeout
+        )
+    finally:
+        bot.close_db()
+        shutil.rmtree(LOAD_DIR, ignore_errors=True)
+
+    if results['saturation_rate']:
+        print(f"Saturated at {results['saturation_rate']} updates/s with {args.workers} workers")
+    else:
+        print(f"Not saturated up to {results['steps'][-1]['offered_rate']} updates/s with {args.workers} workers")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds (seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """Monotonic count per label value"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def get(self, label_value):
+        return self._values.get(label_value, 0)
+
+    def label_values(self):
+        with self._lock:
+            return sorted(self._values)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, {self.label: key}, value) for key, value in sorted(self._values.items())]
+
+    def values(self):
+        """Return a copy of the counts, e.g. to send to another process"""
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, values):
+        """Add counts taken with values()"""
+        for key, value in values.items():
+            self.inc(key, value)
+
+    def empty(self):
+        return Counter(self.name, self.help, self.label)
+
+class Gauge:
+    """Values read from a callback returning {label_value: value} at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, label, collect):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, {self.label: key}, value) for key, value in sorted(self.collect().items())]
+
+class Histogram:
+    """Cumulative latency histogram per label value, with a running sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label value -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._values.get(label_value)
+            if values is None:
+                values = self._values[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += seconds
+
+    def summary(self, label_value):
+        """Return count, mean and an upper bound for p50/p95/p99 from the buckets"""
+        with self._lock:
+            values = list(self._values.get(label_value) or [0] * (len(self.buckets) + 1) + [0.0])
+        counts, total = values[:-1], values[-1]
+        count = sum(counts)
+
+        def quantile(fraction):
+            rank, seen = fraction * count, 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                seen += bucket_count
+                if seen >= rank:
+                    return bound
+            return float('inf')
+
+        return {
+            'count': count,
+            'mean': total / count if count else 0.0,
+            'p50': quantile(0.50) if count else 0.0,
+            'p95': quantile(0.95) if count else 0.0,
+            'p99': quantile(0.99) if count else 0.0
+        }
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(values)) for key, values in sorted(self._values.items())]
+
+        samples = []
+        for key, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((f'{self.name}_bucket', {self.label: key, 'le': le}, cumulative))
+            samples.append((f'{self.name}_sum', {self.label: key}, values[-1]))
+            samples.append((f'{self.name}_count', {self.label: key}, cumulative))
+        return samples
+
+    def values(self):
+        """Return a copy of the bucket counts and sums, e.g. to send to another process"""
+        with self._lock:
+            return {key: list(values) for key, values in self._values.items()}
+
+    def merge(self, values):
+        """Add bucket counts and sums taken with values()"""
+        with self._lock:
+            for key, other in values.items():
+                mine = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+                for index, value in enumerate(other):
+                    mine[index] += value
+
+    def empty(self):
+        return Histogram(self.name, self.help, self.label, self.buckets)
+
+class Registry:
+    """Set of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{label_value}"' for key, label_value in labels.items())
+                lines.append(f'{name}{{{label_text}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+HANDLER_CALLS = REGISTRY.register(Counter('bot_handler_calls_total', 'Updates handled', 'handler'))
+HANDLER_ERRORS = REGISTRY.register(Counter('bot_handler_errors_total', 'Handlers that raised', 'handler'))
+HANDLER_SECONDS = REGISTRY.register(Histogram('bot_handler_seconds', 'Handler latency', 'handler'))
+DB_CALLS = REGISTRY.register(Counter('bot_db_calls_total', 'Database method calls', 'method'))
+DB_ERRORS = REGISTRY.register(Counter('bot_db_errors_total', 'Database methods that raised', 'method'))
+DB_SECONDS = REGISTRY.register(Histogram('bot_db_seconds', 'Time spent in Database methods', 'method'))
+DB_LOCK_RETRIES = REGISTRY.register(Counter(
+    'bot_db_lock_retries_total', 'Database calls retried after "database is locked"', 'method'
+))
+
+def snapshot(registry=REGISTRY):
+    """Return the values of every counter and histogram in a registry; gauges are left out"""
+    return {metric.name: metric.values() for metric in registry.metrics if metric.kind != 'gauge'}
+
+class CombinedRegistry:
+    """Renders the counters and histograms of several processes, summed from their snapshots
+
+    snapshots is called at every scrape and returns the latest snapshot()
+    of each process.
+    """
+
+    def __init__(self, snapshots, registry=REGISTRY):
+        self.snapshots = snapshots
+        self.registry = registry
+
+    def render(self):
+        combined = Registry()
+        snapshots = self.snapshots()
+        for metric in self.registry.metrics:
+            if metric.kind == 'gauge':
+                continue
+            total = combined.register(metric.empty())
+            for values in snapshots:
+                total.merge(values.get(metric.name, {}))
+        return combined.render()
+
+def timed_handler(name, handler):
+    """Wrap a sync or coroutine handler to count its calls and errors and time it"""
+    if inspect.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_CALLS.inc(name)
+                HANDLER_SECONDS.observe(name, time.perf_counter() - started)
+    else:
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_CALLS.inc(name)
+                HANDLER_SECONDS.observe(name, time.perf_counter() - started)
+    return wrapper
+
+def handler_summary():
+    """Return per-handler call and error counts with latency summaries"""
+    return {
+        name: {**HANDLER_SECONDS.summary(name), 'errors': HANDLER_ERRORS.get(name)}
+        for name in HANDLER_CALLS.label_values()
+    }
+
+class MetricsServer:
+    """Serves REGISTRY at /metrics from a background thread"""
+
+    def __init__(self, host='127.0.0.1', port=9100, registry=REGISTRY):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info("Serving metrics on port %s", self.port)
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
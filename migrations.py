@@ -0,0 +1,310 @@
+import logging
+import time
+
+from catalog import SEED_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+# Migrations are frozen once released: change the schema by appending a new one.
+# Every step also copes with databases created before versioning, which already
+# have some of these tables.
+
+def _columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return [column[1] for column in cursor.fetchall()]
+
+def _table_exists(cursor, table):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)", (table,))
+    return cursor.fetchone()[0]
+
+def initial_schema(cursor, db):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            tokens INTEGER DEFAULT 10,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_access TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            tokens INTEGER NOT NULL,
+            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+def content_catalog(cursor, db):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            external_id TEXT UNIQUE,
+            title TEXT NOT NULL,
+            summary TEXT NOT NULL DEFAULT '',
+            source TEXT NOT NULL DEFAULT '',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # External-content index: the text lives once, in catalog
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+            title, summary, source,
+            content='catalog',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3 4'
+        )
+    ''')
+
+    # Keep the index in step with the table
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS catalog_ai AFTER INSERT ON catalog BEGIN
+            INSERT INTO catalog_fts (rowid, title, summary, source)
+            VALUES (new.id, new.title, new.summary, new.source);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS catalog_ad AFTER DELETE ON catalog BEGIN
+            INSERT INTO catalog_fts (catalog_fts, rowid, title, summary, source)
+            VALUES ('delete', old.id, old.title, old.summary, old.source);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS catalog_au AFTER UPDATE ON catalog BEGIN
+            INSERT INTO catalog_fts (catalog_fts, rowid, title, summary, source)
+            VALUES ('delete', old.id, old.title, old.summary, old.source);
+            INSERT INTO catalog_fts (rowid, title, summary, source)
+            VALUES (new.id, new.title, new.summary, new.source);
+        END
+    ''')
+
+    # Bumped by every catalog write so caches know when to drop results
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO catalog_meta (key, value) VALUES ('version', 0)")
+
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM catalog)')
+    if not cursor.fetchone()[0]:
+        cursor.executemany('''
+            INSERT INTO catalog (external_id, title, summary, source)
+            VALUES (:external_id, :title, :summary, :source)
+        ''', SEED_ENTRIES)
+        cursor.execute("UPDATE catalog_meta SET value = value + 1 WHERE key = 'version'")
+
+def payment_references(cursor, db):
+    if 'reference' not in _columns(cursor, 'payments'):
+        cursor.execute('ALTER TABLE payments ADD COLUMN reference TEXT')
+
+    # External payment references are unique so confirmations are idempotent
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_reference ON payments (reference)')
+
+def token_ledger(cursor, db):
+    ledger_exists = _table_exists(cursor, 'token_ledger')
+
+    # Append-only record of every balance change; users.tokens is its running total
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS token_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            payment_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (payment_id) REFERENCES payments (id)
+        )
+    ''')
+
+    if not ledger_exists:
+        # Open the ledger with each existing user's current balance
+        cursor.execute("INSERT INTO token_ledger (user_id, delta, reason) SELECT id, tokens, 'adjustment' FROM users")
+
+def ledger_and_payment_indexes(cursor, db):
+    # Covers history and per-user reconciliation without touching the table
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_token_ledger_user
+        ON token_ledger (user_id, id, delta, reason, created_at)
+    ''')
+
+    # Covering indexes for per-user payment history and daily revenue
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_user
+        ON payments (user_id, payment_date, amount, tokens)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_date
+        ON payments (payment_date, amount, tokens)
+    ''')
+
+def trial_expiry(cursor, db):
+    if 'trial_expires_at' not in _columns(cursor, 'users'):
+        cursor.execute('ALTER TABLE users ADD COLUMN trial_expires_at TIMESTAMP')
+        cursor.execute('ALTER TABLE users ADD COLUMN trial_expired INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('UPDATE users SET trial_expires_at = datetime(created_at, ?)', (f'+{db.trial_days} days',))
+
+    # Only running trials are indexed, so expiry sweeps stay small as users accumulate
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_trial_expires
+        ON users (trial_expires_at) WHERE trial_expired = 0
+    ''')
+
+def broadcasts(cursor, db):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            audience TEXT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+def update_tracking(cursor, db):
+    # The last update_id whose handling is committed; polling resumes after it
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO bot_state (key, value) VALUES ('update_offset', 0)")
+
+    # Search charges name the update that caused them, so a redelivered update is not charged again
+    if 'update_id' not in _columns(cursor, 'token_ledger'):
+        cursor.execute('ALTER TABLE token_ledger ADD COLUMN update_id INTEGER')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_token_ledger_update
+        ON token_ledger (update_id) WHERE update_id IS NOT NULL
+    ''')
+
+def attachments(cursor, db):
+    # A file under ATTACHMENTS_DIR sent along with an entry's search results
+    if 'attachment' not in _columns(cursor, 'catalog'):
+        cursor.execute('ALTER TABLE catalog ADD COLUMN attachment TEXT')
+
+    # Telegram file_ids of uploaded attachments, by content hash
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            sha256 TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def daily_rollups(cursor, db):
+    # Per-day totals for reporting, kept up to date by analytics.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            signups INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            searches INTEGER NOT NULL DEFAULT 0,
+            tokens_sold INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Who has been counted as active on the days still being rolled up
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # The last row of each source table already counted
+    cursor.executemany(
+        'INSERT OR IGNORE INTO bot_state (key, value) VALUES (?, 0)',
+        [('rollup_users',), ('rollup_ledger',), ('rollup_payments',)]
+    )
+
+def rollup_active_users_from_ledger(cursor, db):
+    # Active users are now told apart in the ledger itself, which keeps every day
+    cursor.execute('DROP TABLE IF EXISTS daily_active_users')
+
+# (version, name, apply) in the order they are applied
+MIGRATIONS = [
+    (1, 'initial schema', initial_schema),
+    (2, 'content catalog', content_catalog),
+    (3, 'payment references', payment_references),
+    (4, 'token ledger', token_ledger),
+    (5, 'ledger and payment indexes', ledger_and_payment_indexes),
+    (6, 'trial expiry', trial_expiry),
+    (7, 'broadcasts', broadcasts),
+    (8, 'update tracking', update_tracking),
+    (9, 'attachments', attachments),
+    (10, 'daily rollups', daily_rollups),
+    (11, 'active users from the ledger', rollup_active_users_from_ledger),
+]
+
+def current_version(conn):
+    """Return the highest applied migration version, 0 for a new database"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            duration_ms REAL NOT NULL
+        )
+    ''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations').fetchone()[0]
+
+def migrate(db, migrations=MIGRATIONS):
+    """Apply pending migrations in order and return the versions applied
+
+    Each migration runs in its own write transaction, so processes starting
+    together apply it once between them. In WAL mode readers carry on while
+    an index is built; writers wait for it up to busy_timeout.
+    """
+    conn = db.get_connection()
+    version = current_version(conn)
+    conn.commit()
+
+    applied = []
+    for number, name, apply in migrations:
+        if number <= version:
+            continue
+
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have applied it while this one waited for the lock
+            if conn.execute('SELECT 1 FROM schema_migrations WHERE version = ?', (number,)).fetchone():
+                conn.rollback()
+                continue
+
+            apply(conn.cursor(), db)
+            duration_ms = (time.perf_counter() - started) * 1000
+            conn.execute(
+                'INSERT INTO schema_migrations (version, name, duration_ms) VALUES (?, ?, ?)',
+                (number, name, duration_ms)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        applied.append(number)
+        logger.info("Applied migration %s (%s) in %.1f ms", number, name, duration_ms)
+
+    return applied
@@ -0,0 +1,102 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# An update this far below the offset is not a redelivery: after a week without
+# updates Telegram picks the next update_id at random, possibly far lower
+ID_RESTART_GAP = 100000
+
+class UpdateTracker:
+    """Remembers which updates were handled, so redelivered ones are skipped
+
+    The committed offset is the highest update_id below which every update
+    received has been handled; it is stored in the database and survives
+    restarts. Updates that finished above it while a lower one was still
+    running are remembered in memory only, so after a crash they can be
+    delivered again; search charges are made once per update_id regardless.
+    An update far below the offset means Telegram restarted its update_ids,
+    and the offset starts over from it. Callers therefore fetch their first
+    getUpdates batch without an offset, which would confirm, and so drop,
+    such updates.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.offset = db.get_update_offset()
+        self._saved = self.offset
+        self._running = set()
+        self._finished = set()
+        # Updates from before a restart of the update_ids that are still running
+        self._stale = set()
+        self._restarted = False
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.duplicates = 0
+
+    def begin(self, update_id):
+        """Claim an update for handling; False if it was already handled or is running"""
+        with self._lock:
+            if update_id < self.offset - ID_RESTART_GAP:
+                self._restart(update_id)
+            if update_id <= self.offset or update_id in self._running or update_id in self._finished:
+                self.duplicates += 1
+                return False
+            self._running.add(update_id)
+            return True
+
+    def _restart(self, update_id):
+        logger.warning("Update ids restarted: %s is far below offset %s, starting over from it", update_id, self.offset)
+        self._stale |= self._running
+        self._running = set()
+        self._finished.clear()
+        self.offset = update_id - 1
+        self._restarted = True
+
+    def finish(self, update_id):
+        """Mark a claimed update as handled; True if the offset moved forward"""
+        with self._lock:
+            if update_id in self._stale:
+                self._stale.discard(update_id)
+                if not self._running and not self._stale:
+                    self._idle.notify_all()
+                return False
+            self._running.discard(update_id)
+            self._finished.add(update_id)
+
+            # Everything below the oldest running update is done
+            limit = min(self._running) if self._running else None
+            done = sorted(n for n in self._finished if limit is None or n < limit)
+            self._finished.difference_update(done)
+
+            if not self._running and not self._stale:
+                self._idle.notify_all()
+            if done and done[-1] > self.offset:
+                self.offset = done[-1]
+                return True
+            return False
+
+    def wait_idle(self, timeout=None):
+        """Wait until no claimed update is running; False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._running and not self._stale, timeout)
+
+    def commit(self):
+        """Store the offset if it moved since the last commit, or back after a restart of the update_ids"""
+        with self._lock:
+            offset, restarted = self.offset, self._restarted
+            if offset <= self._saved and not restarted:
+                return
+            self._saved, self._restarted = offset, False
+        if restarted:
+            self.db.reset_update_offset(offset)
+        else:
+            self.db.save_update_offset(offset)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'offset': self.offset,
+                'running': len(self._running) + len(self._stale),
+                'duplicates': self.duplicates
+            }
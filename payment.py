@@ -1,4 +1,20 @@
+import argparse
+import csv
+import logging
+from itertools import islice
+
+import config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Confirmations committed per transaction when processing a batch
+CONFIRMATION_BATCH_SIZE = 1000
+
 class PaymentHandler:
+    def __init__(self, db):
+        self.db = db
+
     def generate_payment_info(self, user_id, amount, price):
         return f"""
 🧾 Счёт на оплату
@@ -10,4 +26,63 @@ ID пользователя: {user_id}
 Для оплаты свяжитесь с администратором: @admin
         """
 
-payment_handler = PaymentHandler()
+    def process_payment_confirmation(self, user_id, tokens, amount=None, reference=None):
+        """Record one confirmed payment and credit its tokens; False if already processed"""
+        return self.process_payment_confirmations([(user_id, tokens, amount, reference)]) == 1
+
+    def process_payment_confirmations(self, confirmations, batch_size=CONFIRMATION_BATCH_SIZE):
+        """Apply (user_id, tokens, amount, reference) confirmations in batched transactions
+
+        amount defaults to tokens * TOKEN_PRICE. Confirmations whose reference
+        was already processed are skipped. Returns the number applied.
+        """
+        rows = (
+            (user_id, amount if amount is not None else tokens * config.TOKEN_PRICE, tokens, reference)
+            for user_id, tokens, amount, reference in confirmations
+        )
+
+        applied = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            applied += len(self.db.confirm_payments(batch))
+        return applied
+
+def read_confirmations_csv(path):
+    """Yield (user_id, tokens, amount, reference) from a CSV with those columns"""
+    with open(path, newline='', encoding='utf-8') as f:
+        for record in csv.DictReader(f):
+            amount = record.get('amount')
+            yield (
+                int(record['user_id']),
+                int(record['tokens']),
+                float(amount) if amount else None,
+                record.get('reference') or None
+            )
+
+def main() -> None:
+    """Apply a CSV of confirmed payments from the command line."""
+    parser = argparse.ArgumentParser(description="Confirm payments and credit tokens from a CSV")
+    parser.add_argument('path', help="CSV with user_id, tokens, amount and reference columns")
+    parser.add_argument('--batch-size', type=int, default=CONFIRMATION_BATCH_SIZE)
+    parser.add_argument('--db', default=config.DATABASE_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    db = Database(args.db)
+    try:
+        applied = PaymentHandler(db).process_payment_confirmations(
+            read_confirmations_csv(args.path), args.batch_size
+        )
+    finally:
+        db.close()
+
+    logger.info("Applied %s payment confirmations", applied)
+
+if __name__ == '__main__':
+    main()
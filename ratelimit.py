@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    """Token bucket allowing bursts of capacity and refilling at rate tokens per second"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, tokens=1):
+        """Take tokens if available right now; never waits"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def reserve(self, tokens=1):
+        """Take tokens, going into debt if needed, and return how long to wait before using them"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= tokens
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self, tokens=1):
+        """Wait until tokens are available without blocking the event loop"""
+        delay = self.reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+class TokenBucketRegistry:
+    """One token bucket per key, holding at most maxsize buckets
+
+    Buckets unused for idle_ttl seconds are dropped; a dropped bucket
+    would have been full again anyway, so forgetting it changes nothing.
+    """
+
+    def __init__(self, rate, capacity=None, maxsize=100000, idle_ttl=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        # By default, forget a bucket once it has had time to refill completely
+        self.idle_ttl = idle_ttl if idle_ttl is not None else (capacity or max(1, rate)) / rate
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the bucket for key, creating it if needed"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self._buckets[key] = bucket
+            else:
+                self._buckets.move_to_end(key)
+            self._evict(now)
+            return bucket
+
+    def _evict(self, now):
+        # Least recently used buckets are at the front
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.maxsize and now - bucket.updated < self.idle_ttl:
+                break
+            del self._buckets[key]
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._buckets)
+
+class FloodControl:
+    """Per-user token buckets deciding which updates are handled at all
+
+    Each user may send burst updates at once and rate more per second after
+    that; anything beyond is rejected before it reaches a handler.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.buckets = TokenBucketRegistry(rate, capacity=burst, maxsize=maxsize)
+        self.allowed = 0
+        self.throttled = 0
+        # Handler threads count at the same time
+        self._lock = threading.Lock()
+
+    def allow(self, user_id):
+        """Take one token from the user's bucket; False if the update should be dropped"""
+        allowed = self.buckets.get(user_id).try_consume()
+        with self._lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.throttled += 1
+        return allowed
+
+    def stats(self):
+        """Return update counters and the number of users being tracked"""
+        with self._lock:
+            allowed, throttled = self.allowed, self.throttled
+        return {
+            'allowed': allowed,
+            'throttled': throttled,
+            'tracked_users': len(self.buckets),
+            'evictions': self.buckets.evictions
+        }
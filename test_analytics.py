@@ -0,0 +1,103 @@
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from analytics import Analytics
+from database import Database
+
+def test_analytics():
+    """Test streaming exports and incremental daily rollups"""
+    print("Testing analytics...")
+
+    db = Database('test_analytics.db')
+    analytics = Analytics(db)
+    conn = db.get_connection()
+    today = date(*time.gmtime()[:3])
+    tomorrow = today + timedelta(days=1)
+
+    try:
+        # Two users signed up and searched on an earlier day
+        for telegram_id in (1001, 1002):
+            db.charge_search(telegram_id, first_name='Early')
+        conn.execute("UPDATE users SET created_at = '2024-05-01 09:00:00'")
+        conn.execute("UPDATE token_ledger SET created_at = '2024-05-01 09:00:00'")
+        conn.commit()
+
+        # Today: three new users, one of them searching three times, and two payments
+        for telegram_id in (2001, 2002, 2003):
+            db.create_user(telegram_id, first_name='Today')
+        for _ in range(3):
+            db.charge_search(2001)
+        db.charge_search(1001)
+        db.add_payment(db.get_user(2001)['id'], 100.0, 10)
+        db.add_payment(db.get_user(2002)['id'], 250.0, 25)
+
+        # Small batches take several transactions and count every row once
+        counted = analytics.update_rollups(batch_size=2)
+        print(f"Counted {counted} rows: {analytics.daily('2024-05-01', tomorrow)}")
+        assert counted == 5 + 6 + 2
+        early, latest = analytics.daily('2024-05-01', tomorrow)
+        assert early == {
+            'day': '2024-05-01', 'signups': 2, 'active_users': 2, 'searches': 2, 'tokens_sold': 0, 'revenue': 0
+        }
+        assert latest == {
+            'day': str(today), 'signups': 3, 'active_users': 2, 'searches': 4, 'tokens_sold': 35, 'revenue': 350.0
+        }
+
+        # Nothing new, nothing counted
+        assert analytics.update_rollups() == 0
+        assert analytics.daily(today, tomorrow) == [latest]
+
+        # Later runs only add what arrived since the watermarks
+        print("\nRolling up new activity...")
+        db.charge_search(2001)
+        db.charge_search(2003)
+        db.charge_search(3001, first_name='Later')
+        assert analytics.update_rollups() == 1 + 3
+        today_stats = analytics.daily(today, tomorrow)[0]
+        print(f"Today: {today_stats}")
+        assert today_stats['signups'] == 4 and today_stats['searches'] == 7
+        assert today_stats['active_users'] == 4, "repeat searchers are counted once a day"
+
+        # A search that arrives late for a day rolled up long ago counts its user once
+        print("\nRolling up late searches...")
+        db.charge_search(1002)
+        db.charge_search(2002)
+        conn.execute("UPDATE token_ledger SET created_at = '2024-05-01 18:00:00' WHERE id > (SELECT MAX(id) - 2 FROM token_ledger)")
+        conn.commit()
+        assert analytics.update_rollups() == 2
+        early = analytics.daily('2024-05-01', '2024-05-02')[0]
+        print(f"Early: {early}")
+        assert early['searches'] == 4 and early['active_users'] == 3
+
+        # Exports stream every row in pages, as CSV or JSON lines
+        print("\nExporting...")
+        out = io.StringIO()
+        assert analytics.export('users', out, 'csv', batch_size=2) == 6
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        assert [int(row['telegram_id']) for row in rows] == [1001, 1002, 2001, 2002, 2003, 3001]
+
+        out = io.StringIO()
+        assert analytics.export('payments', out, 'jsonl', batch_size=1) == 2
+        payments = [json.loads(line) for line in out.getvalue().splitlines()]
+        print(f"Payments: {payments}")
+        assert [payment['amount'] for payment in payments] == [100.0, 250.0]
+    finally:
+        # Clean up test database
+        print("\nCleaning up...")
+        db.close()
+        for suffix in ('', '-shm', '-wal'):
+            if os.path.exists('test_analytics.db' + suffix):
+                os.remove('test_analytics.db' + suffix)
+
+    print("Analytics test completed successfully!")
+
+if __name__ == '__main__':
+    test_analytics()
@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import sys
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import User
+
+import bot
+import config
+import metrics
+from archive import archive_cold_users, compact
+from database import Database
+from payment import PaymentHandler
+
+def remove_database(path):
+    for suffix in ('', '-shm', '-wal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def test_archive():
+    """Test moving cold users to the archive, restoring them and compacting the database"""
+    print("Testing cold-user archival...")
+
+    db = Database('test_archive.db', archive_path='test_archive-archive.db')
+    conn = db.get_connection()
+    try:
+        assert conn.execute('PRAGMA main.auto_vacuum').fetchone()[0] == 2, "new databases vacuum incrementally"
+
+        for telegram_id in range(1, 301):
+            db.create_user(telegram_id, first_name='x' * 500)
+            db.charge_search(telegram_id)
+        user = {telegram_id: db.get_user(telegram_id) for telegram_id in (5, 6, 7, 8)}
+
+        # An old purchase goes with its buyer; a recent one keeps the buyer live
+        db.confirm_payments([(user[5]['id'], 100.0, 10, 'old-5'), (user[6]['id'], 100.0, 10, 'new-6')])
+        conn.execute("UPDATE payments SET payment_date = datetime('now', '-150 days') WHERE reference = 'old-5'")
+
+        # The first 200 users let their trial lapse long ago and never came back
+        conn.execute('''
+            UPDATE users SET trial_expires_at = datetime('now', '-200 days'), last_access = datetime('now', '-200 days')
+            WHERE telegram_id <= 200
+        ''')
+        conn.commit()
+        db.user_cache.clear()
+        balance = db.get_user(5)['tokens']
+
+        archived = archive_cold_users(db, days=90, batch_size=50)
+        print(f"Archived {archived} users")
+        assert archived == 199
+        assert conn.execute('SELECT COUNT(*) FROM main.users').fetchone()[0] == 101
+        assert conn.execute('SELECT COUNT(*) FROM archive.users').fetchone()[0] == 199
+        assert conn.execute("SELECT COUNT(*) FROM archive.payments WHERE reference = 'old-5'").fetchone()[0] == 1
+        assert conn.execute('SELECT COUNT(*) FROM main.token_ledger WHERE user_id = ?', (user[7]['id'],)).fetchone()[0] == 0
+
+        # Running again finds nothing more
+        assert archive_cold_users(db, days=90) == 0
+
+        # A user who comes back between the copy and the delete stays live, and the copy is purged
+        print("\nInterrupting a move...")
+        live = db.get_user(250)
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        db._copy_users(cursor, 'main', 'archive', [live['id']])
+        conn.commit()
+        db.charge_search(250)
+        cursor.execute('BEGIN IMMEDIATE')
+        assert db._delete_copied_users(cursor, 'main', 'archive', [live['id']]) == []
+        conn.commit()
+        assert db.get_user(250)['tokens'] == live['tokens'] - 1
+        assert archive_cold_users(db, days=90) == 0
+        assert conn.execute('SELECT COUNT(*) FROM archive.users WHERE telegram_id = 250').fetchone()[0] == 0
+
+        # A returning user is restored on the first lookup, with their history
+        print("\nRestoring returning users...")
+        restored = db.get_user(5)
+        print(f"Restored: {restored}")
+        assert restored['id'] == user[5]['id'] and restored['tokens'] == balance
+        assert [payment['amount'] for payment in db.get_payment_history(user[5]['id'])] == [100.0]
+        assert conn.execute('SELECT COUNT(*) FROM archive.users WHERE telegram_id = 5').fetchone()[0] == 0
+
+        # A search restores the user, whose trial is over, instead of starting a second one
+        tokens = conn.execute('SELECT tokens FROM archive.users WHERE telegram_id = 7').fetchone()[0]
+        charge = db.charge_search(7)
+        assert not charge['charged'] and not charge['is_active'] and charge['tokens'] == tokens
+        assert db.get_user(7)['id'] == user[7]['id']
+
+        # Confirmations restore the buyer first, so an old reference is still recognized
+        assert not PaymentHandler(db).process_payment_confirmation(user[8]['id'], 10, reference='new-6')
+        assert db.get_user(8)['id'] == user[8]['id']
+        ledger = conn.execute('SELECT SUM(delta) FROM token_ledger WHERE user_id = ?', (user[8]['id'],)).fetchone()[0]
+        assert ledger == db.get_user(8)['tokens']
+
+        # Unknown users are still created as usual
+        assert db.create_user(999, first_name='New')['tokens'] == db.trial_tokens
+
+        # The space the archived users took is handed back
+        print("\nCompacting...")
+        result = compact(db, step_pages=10, step_pause=0)
+        print(f"Compaction: {result}")
+        assert result['pages_after'] < result['pages_before']
+        assert conn.execute('PRAGMA main.freelist_count').fetchone()[0] == 0
+    finally:
+        db.close()
+        remove_database('test_archive.db')
+        remove_database('test_archive-archive.db')
+
+    # A database from before incremental vacuum is switched over once
+    print("\nCompacting a legacy database...")
+    legacy = sqlite3.connect('test_archive.db')
+    legacy.execute('CREATE TABLE filler (x)')
+    legacy.commit()
+    legacy.close()
+    db = Database('test_archive.db')
+    try:
+        assert db.get_connection().execute('PRAGMA main.auto_vacuum').fetchone()[0] == 0
+        compact(db)
+        assert db.get_connection().execute('PRAGMA main.auto_vacuum').fetchone()[0] == 2
+    finally:
+        # Clean up test databases
+        print("\nCleaning up...")
+        db.close()
+        remove_database('test_archive.db')
+
+    print("Archival test completed successfully!")
+
+def test_profile_after_archival():
+    """Test that /profile restores a user archived by another process while cached"""
+    print("Testing /profile after archival...")
+
+    # Set here because other tests share the imported modules
+    database_path, archive_path = config.DATABASE_PATH, config.ARCHIVE_PATH
+    config.DATABASE_PATH, config.ARCHIVE_PATH = 'test_archive.db', 'test_archive-archive.db'
+    user = User(42, 'Cached', is_bot=False)
+    try:
+        db_user, _ = bot.get_profile(user)
+        conn = bot.get_db().get_connection()
+        conn.execute("""
+            UPDATE users SET trial_expires_at = datetime('now', '-200 days'), last_access = datetime('now', '-200 days')
+        """)
+        conn.commit()
+
+        # The archival job runs in its own process with its own cache
+        job = Database('test_archive.db', archive_path='test_archive-archive.db')
+        try:
+            assert archive_cold_users(job, days=90) == 1
+        finally:
+            job.close()
+
+        restored, token_status = bot.get_profile(user)
+        print(f"Restored: {restored}, {token_status}")
+        assert restored['id'] == db_user['id'] and token_status['tokens'] == db_user['tokens']
+        assert bot.profile_text(restored, token_status)
+    finally:
+        print("\nCleaning up...")
+        bot.close_db()
+        config.DATABASE_PATH, config.ARCHIVE_PATH = database_path, archive_path
+        remove_database('test_archive.db')
+        remove_database('test_archive-archive.db')
+
+    print("Profile after archival test completed successfully!")
+
+def test_lock_after_restore():
+    """Test that a write committed before the archive was locked is not retried"""
+    print("Testing a locked archive after a restore...")
+
+    db = Database('test_archive.db', busy_timeout=50, archive_path='test_archive-archive.db')
+    blocker = None
+    try:
+        user = db.create_user(42, first_name='Locked')
+        conn = db.get_connection()
+        conn.execute("""
+            UPDATE users SET trial_expires_at = datetime('now', '-200 days'), last_access = datetime('now', '-200 days')
+        """)
+        conn.commit()
+        assert archive_cold_users(db, days=90) == 1
+
+        # add_tokens restores and credits in one commit; deleting the archive copy then finds the archive locked
+        blocker = sqlite3.connect('test_archive-archive.db')
+        blocker.execute('BEGIN IMMEDIATE')
+        retries = metrics.DB_LOCK_RETRIES.get('add_tokens')
+        db.add_tokens(user['id'], 5)
+        blocker.rollback()
+
+        balance = db.get_user(42)['tokens']
+        print(f"Balance: {user['tokens']} -> {balance}")
+        assert balance == user['tokens'] + 5
+        assert conn.execute("SELECT COUNT(*) FROM token_ledger WHERE reason = 'adjustment'").fetchone()[0] == 1
+        assert metrics.DB_LOCK_RETRIES.get('add_tokens') == retries
+
+        # The copy left behind is purged by the next archival run
+        assert conn.execute('SELECT COUNT(*) FROM archive.users').fetchone()[0] == 1
+        assert db.purge_restored_copies() == 1
+    finally:
+        print("\nCleaning up...")
+        if blocker is not None:
+            blocker.close()
+        db.close()
+        remove_database('test_archive.db')
+        remove_database('test_archive-archive.db')
+
+    print("Lock after restore test completed successfully!")
+
+if __name__ == '__main__':
+    test_archive()
+    test_profile_after_archival()
+    test_lock_after_restore()
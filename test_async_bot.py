@@ -0,0 +1,191 @@
+import asyncio
+import os
+import sys
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+import config
+from async_bot import AsyncRuntime
+from catalog import Catalog
+from ratelimit import FloodControl
+
+class RecordingApi:
+    """Stands in for AsyncBotApi and records every outgoing call"""
+
+    def __init__(self):
+        self.sent = []
+        self.markups = []
+        self.answers = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        # Yield like a real network call would
+        await asyncio.sleep(0)
+        self.sent.append((chat_id, text))
+        self.markups.append(reply_markup)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        self.sent.append((chat_id, text))
+        self.markups.append(reply_markup)
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        self.answers.append((callback_query_id, text))
+
+    async def close(self):
+        pass
+
+def make_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text
+        }
+    }
+
+def make_callback(update_id, user_id, data):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': ''}
+        }
+    }
+
+async def feed(updates):
+    for update in updates:
+        yield update
+
+def test_async_runtime():
+    """Test the asyncio runtime against a recording API"""
+    print("Testing async runtime...")
+
+    # Keep the bot away from the production database; set here because other tests share the imported modules
+    database_path = config.DATABASE_PATH
+    config.DATABASE_PATH = 'test_async_bot.db'
+    try:
+        updates = []
+        for user_id in range(1, 6):
+            updates.append(make_update(len(updates) + 1, user_id, '/start'))
+            for _ in range(12):
+                updates.append(make_update(len(updates) + 1, user_id, '/search'))
+
+        api = RecordingApi()
+        runtime = AsyncRuntime(api, bot.get_db(), db_workers=2, max_concurrent_updates=20)
+        asyncio.run(runtime.run(updates=feed(updates)))
+
+        print(f"Processed {len(updates)} updates, sent {len(api.sent)} replies")
+        assert len(api.sent) == len(updates)
+
+        charged = [text for _, text in api.sent if 'Результаты поиска' in text]
+        out_of_tokens = [text for _, text in api.sent if text == bot.NO_TOKENS_TEXT]
+        print(f"Searches served: {len(charged)}, refused: {len(out_of_tokens)}")
+        assert len(charged) == 50 and len(out_of_tokens) == 10
+
+        for user_id in range(1, 6):
+            assert bot.get_db().get_user(user_id)['tokens'] == 0
+
+        # Flood control drops a user's excess updates before they are handled
+        print("\nTesting flood control...")
+        flood_control = FloodControl(rate=0.01, burst=3, maxsize=1)
+        updates = [make_update(100 + i, 6, '/start') for i in range(10)]
+        updates.append(make_callback(110, 6, 'recharge'))
+        updates.append(make_update(200, 7, '/start'))
+
+        api = RecordingApi()
+        runtime = AsyncRuntime(api, bot.get_db(), db_workers=2, max_concurrent_updates=20, flood_control=flood_control)
+        asyncio.run(runtime.run(updates=feed(updates)))
+
+        stats = flood_control.stats()
+        print(f"Flood control stats: {stats}")
+        assert [chat_id for chat_id, _ in api.sent].count(6) == 3
+        assert [chat_id for chat_id, _ in api.sent].count(7) == 1
+        assert stats['allowed'] == 4 and stats['throttled'] == 8
+
+        # A throttled button press is still answered, so it does not spin
+        assert api.answers == [('110', bot.FLOOD_TEXT)]
+
+        # Only maxsize users are remembered
+        assert stats['tracked_users'] == 1 and stats['evictions'] == 1
+
+        # Search results come in pages that inline buttons turn without another search or charge
+        print("\nTesting paginated search...")
+        Catalog(bot.get_db()).upsert_entries([
+            (f'page-{i}', f'Влияние и убеждение {i}', 'Психология влияния.', 'Тест', None) for i in range(12)
+        ])
+
+        api = RecordingApi()
+        runtime = AsyncRuntime(api, bot.get_db(), db_workers=2)
+        asyncio.run(runtime.run(updates=feed([make_update(300, 8, '/search влияние')])))
+        first_page = api.sent[-1][1]
+        buttons = api.markups[-1].inline_keyboard[0]
+        print(f"First page buttons: {[button.text for button in buttons]}")
+        assert 'Страница 1 из 3' in first_page and len(buttons) == 1
+        tokens = bot.get_db().get_user(8)['tokens']
+        misses = bot.get_search_cache().stats()['misses']
+
+        runtime = AsyncRuntime(api, bot.get_db(), db_workers=2)
+        asyncio.run(runtime.run(updates=feed([
+            make_callback(301, 8, buttons[0].callback_data),
+            make_callback(302, 9, buttons[0].callback_data)
+        ])))
+        assert 'Страница 2 из 3' in api.sent[-1][1]
+        assert [button.text for button in api.markups[-1].inline_keyboard[0]] == ['◀️ Назад', 'Вперёд ▶️']
+        assert len(api.sent) == 2, "another user's press is refused"
+        assert bot.get_db().get_user(8)['tokens'] == tokens
+        assert bot.get_search_cache().stats()['misses'] == misses
+
+        # Ended trials are marked expired on a schedule
+        print("\nTesting the trial sweep...")
+        conn = bot.get_db().get_connection()
+        conn.execute("UPDATE users SET trial_expires_at = datetime('now', '-1 hour') WHERE telegram_id = 8")
+        conn.commit()
+
+        async def idle():
+            await asyncio.sleep(0.3)
+            return
+            yield
+
+        sweep_interval = config.TRIAL_SWEEP_INTERVAL
+        config.TRIAL_SWEEP_INTERVAL = 0.05
+        try:
+            runtime = AsyncRuntime(RecordingApi(), bot.get_db(), db_workers=2)
+            asyncio.run(runtime.run(updates=idle()))
+        finally:
+            config.TRIAL_SWEEP_INTERVAL = sweep_interval
+        expired = bot.get_db().get_connection().execute('''
+            SELECT telegram_id FROM users WHERE trial_expired = 1
+        ''').fetchall()
+        assert expired == [(8,)]
+
+        # Commands other than /search record the visit through the last_access buffer
+        print("\nTesting visits...")
+        conn = bot.get_db().get_connection()
+        conn.execute("UPDATE users SET last_access = datetime('now', '-100 days')")
+        conn.commit()
+        runtime = AsyncRuntime(RecordingApi(), bot.get_db(), db_workers=2)
+        asyncio.run(runtime.run(updates=feed([make_update(400, 1, '/profile'), make_update(401, 2, '/buy_10')])))
+        visited = bot.get_db().get_connection().execute('''
+            SELECT telegram_id FROM users WHERE last_access > datetime('now', '-1 day') ORDER BY telegram_id
+        ''').fetchall()
+        assert visited == [(1,), (2,)]
+    finally:
+        # Clean up test database
+        print("\nCleaning up...")
+        bot.close_db()
+        config.DATABASE_PATH = database_path
+        for suffix in ('', '-shm', '-wal'):
+            if os.path.exists('test_async_bot.db' + suffix):
+                os.remove('test_async_bot.db' + suffix)
+
+    print("Async runtime test completed successfully!")
+
+if __name__ == '__main__':
+    test_async_runtime()
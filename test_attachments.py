@@ -0,0 +1,127 @@
+import asyncio
+import os
+import shutil
+import sys
+import threading
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+import bot
+import config
+from async_bot import AsyncRuntime
+from bot_api import AsyncBotApi
+from catalog import Catalog
+from fake_bot_api import FakeBotApi
+
+def make_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len('/search')}]
+        }
+    }
+
+def write_file(name, content):
+    with open(os.path.join('test_attachments', name), 'wb') as f:
+        f.write(content)
+
+def test_attachments():
+    """Test that attachments are uploaded once and then sent by file_id"""
+    print("Testing attachments...")
+
+    # Set here because other tests share the imported modules
+    database_path, attachments_dir = config.DATABASE_PATH, config.ATTACHMENTS_DIR
+    config.DATABASE_PATH, config.ATTACHMENTS_DIR = 'test_attachments.db', 'test_attachments'
+    os.makedirs('test_attachments', exist_ok=True)
+    write_file('report.pdf', b'%PDF-1.4 report')
+    write_file('cover.png', b'\x89PNG cover')
+
+    server = FakeBotApi(upload_delay=0.2).start()
+    try:
+        tg_bot = Bot('123456:TEST', base_url=server.base_url, request=Request(con_pool_size=8))
+        store = bot.get_attachments()
+
+        # Concurrent senders of a file nobody has uploaded yet wait for one upload
+        threads = [
+            threading.Thread(target=bot.send_attachments, args=(tg_bot, user_id, ('report.pdf',)))
+            for user_id in range(1, 9)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"Uploads: {len(server.uploads)}, stats: {store.stats()}")
+        assert len(server.uploads) == 1
+        assert len(server.calls_to('sendDocument')) == 8
+        assert store.stats()['uploaded'] == 1 and store.stats()['reused'] == 7
+
+        # The file_id is kept in the database, so a restart does not upload again
+        print("\nRestarting...")
+        bot.close_db()
+        store = bot.get_attachments()
+        bot.send_attachments(tg_bot, 1, ('report.pdf',))
+        assert len(server.uploads) == 1 and store.stats()['reused'] == 1
+
+        # A changed file is uploaded again
+        write_file('report.pdf', b'%PDF-1.4 report, second edition')
+        bot.send_attachments(tg_bot, 1, ('report.pdf',))
+        assert len(server.uploads) == 2
+
+        # A file_id Telegram rejects is dropped and the file uploaded again
+        server.fail('sendDocument', error_code=400, retry_after=None,
+                    description='Bad Request: wrong file identifier/HTTP URL specified')
+        bot.send_attachments(tg_bot, 1, ('report.pdf',))
+        assert len(server.uploads) == 3
+
+        # Missing files and names outside the directory are skipped
+        bot.send_attachments(tg_bot, 1, ('missing.pdf', '../test_attachments.db'))
+        assert len(server.uploads) == 3
+
+        # Search results bring their entries' files along, uploaded once across concurrent searches
+        print("\nSearching in the async runtime...")
+        Catalog(bot.get_db()).upsert_entries([
+            ('cover-1', 'Обложка психологии влияния', 'Иллюстрация.', 'Тест', 'cover.png'),
+            ('cover-2', 'Обложка психологии влияния, издание 2', 'Иллюстрация.', 'Тест', 'cover.png'),
+        ])
+
+        async def search():
+            runtime = AsyncRuntime(AsyncBotApi('123456:TEST', server.base_url), bot.get_db())
+            try:
+                await asyncio.gather(*(
+                    runtime.process_update(make_update(100 + user_id, user_id, '/search обложка'))
+                    for user_id in range(20, 26)
+                ))
+            finally:
+                runtime.executor.shutdown()
+                await runtime.api.close()
+
+        asyncio.run(search())
+        photos = [upload for upload in server.uploads if upload[0] == 'sendPhoto']
+        print(f"Photo uploads: {len(photos)}, sendPhoto calls: {len(server.calls_to('sendPhoto'))}")
+        assert photos == [('sendPhoto', 'cover.png', b'\x89PNG cover')]
+        assert len(server.calls_to('sendPhoto')) == 6
+    finally:
+        server.stop()
+
+        # Clean up test database and files
+        print("\nCleaning up...")
+        bot.close_db()
+        config.DATABASE_PATH, config.ATTACHMENTS_DIR = database_path, attachments_dir
+        shutil.rmtree('test_attachments', ignore_errors=True)
+        for suffix in ('', '-shm', '-wal'):
+            if os.path.exists('test_attachments.db' + suffix):
+                os.remove('test_attachments.db' + suffix)
+
+    print("Attachments test completed successfully!")
+
+if __name__ == '__main__':
+    test_attachments()
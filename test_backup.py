@@ -0,0 +1,130 @@
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from backup import BackupScheduler, backup, snapshots
+from database import Database
+
+def test_backup():
+    """Test online backups of a database that is being written to"""
+    print("Testing backups...")
+
+    db = Database('test_backup.db')
+    for telegram_id in range(1, 501):
+        db.create_user(telegram_id, first_name='User' * 20)
+
+    # Keep charging searches while the backup copies a few pages at a time
+    stopping = threading.Event()
+    charges = []
+
+    def charge():
+        telegram_id = 1
+        while not stopping.is_set():
+            db.charge_search(telegram_id)
+            charges.append(time.perf_counter())
+            telegram_id = telegram_id % 500 + 1
+
+    writer = threading.Thread(target=charge)
+    writer.start()
+    try:
+        started = time.perf_counter()
+        result = backup('test_backup.db', 'test_backups', keep=2, step_pages=4, step_pause=0.005)
+        finished = time.perf_counter()
+    finally:
+        stopping.set()
+        writer.join()
+
+    print(f"Backup: {result}")
+    during = [at for at in charges if started <= at <= finished]
+    print(f"Charges made during the backup: {len(during)}")
+    assert during, "writers are not held up by the backup"
+    assert result['pages'] > 4 and result['pages_per_second'] > 0
+
+    # The snapshot is a consistent, self-contained copy
+    snapshot = sqlite3.connect(result['path'])
+    assert snapshot.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    assert snapshot.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    assert snapshot.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 500
+    tokens, ledger = snapshot.execute('''
+        SELECT (SELECT SUM(tokens) FROM users), (SELECT SUM(delta) FROM token_ledger)
+    ''').fetchone()
+    assert tokens == ledger, "balances and ledger come from the same moment"
+    snapshot.close()
+
+    # Only the newest snapshots are kept
+    print("\nRotating snapshots...")
+    backup('test_backup.db', 'test_backups', keep=2)
+    newest = backup('test_backup.db', 'test_backups', keep=2)['path']
+    kept = snapshots('test_backup.db', 'test_backups')
+    print(f"Kept: {kept}")
+    assert len(kept) == 2 and kept[-1] == newest and result['path'] not in kept
+    assert not [name for name in os.listdir('test_backups') if name.endswith('.partial')]
+
+    # At least one snapshot is always kept
+    for keep in (0, -1):
+        try:
+            backup('test_backup.db', 'test_backups', keep=keep)
+            assert False, f"keep={keep} is rejected"
+        except ValueError:
+            pass
+    try:
+        BackupScheduler('test_backup.db', directory='test_backups', keep=0)
+        assert False, "keep=0 is rejected"
+    except ValueError:
+        pass
+    assert len(snapshots('test_backup.db', 'test_backups')) == 2
+
+    # The scheduler waits out the interval after the newest snapshot
+    print("\nScheduling backups...")
+    scheduler = BackupScheduler('test_backup.db', interval=0.3, directory='test_backups', keep=2)
+    assert 0.2 < scheduler.next_delay() <= 0.3
+    scheduler.start()
+    time.sleep(0.5)
+    scheduler.stop()
+    print(f"Scheduler: {scheduler.stats()}")
+    assert scheduler.stats()['runs'] == 1 and scheduler.stats()['failures'] == 0
+    assert len(snapshots('test_backup.db', 'test_backups')) == 2
+
+    # The archive is backed up from the same moment, into snapshots rotated on their own
+    print("\nBacking up with an archive...")
+    db.close()
+    db = Database('test_backup.db', archive_path='test_backup-archive.db')
+    conn = db.get_connection()
+    conn.execute('''
+        UPDATE users SET trial_expires_at = datetime('now', '-200 days'), last_access = datetime('now', '-200 days')
+        WHERE telegram_id <= 100
+    ''')
+    conn.commit()
+    assert db.archive_users(db.find_cold_users('-90 days'), '-90 days') == 100
+    for _ in range(3):
+        previous, result = result, backup('test_backup.db', 'test_backups', keep=2, archive_path='test_backup-archive.db')
+    print(f"Backup: {result}")
+    assert len(snapshots('test_backup.db', 'test_backups')) == 2
+    assert snapshots('test_backup-archive.db', 'test_backups') == [previous['archive_path'], result['archive_path']]
+    live, archived = sqlite3.connect(result['path']), sqlite3.connect(result['archive_path'])
+    assert live.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 400
+    assert archived.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 100
+    live.close()
+    archived.close()
+
+    # Clean up test database and snapshots
+    print("\nCleaning up...")
+    db.close()
+    for suffix in ('', '-shm', '-wal'):
+        if os.path.exists('test_backup-archive.db' + suffix):
+            os.remove('test_backup-archive.db' + suffix)
+    shutil.rmtree('test_backups', ignore_errors=True)
+    for suffix in ('', '-shm', '-wal'):
+        if os.path.exists('test_backup.db' + suffix):
+            os.remove('test_backup.db' + suffix)
+
+    print("Backup test completed successfully!")
+
+if __name__ == '__main__':
+    test_backup()
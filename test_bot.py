@@ -1,13 +1,21 @@
 import sys
 import os
 import sqlite3
+import threading
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 
 # Add the current directory to the path so we can import modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+import bot
 from database import Database
-from payment import payment_handler
+from payment import PaymentHandler
+
+def remove_database(path):
+    for suffix in ('', '-shm', '-wal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
 
 def test_bot_functionality():
     """Test the bot functionality"""
@@ -15,6 +23,7 @@ def test_bot_functionality():
     
     # Initialize database
     db = Database('test_bot.db')
+    payment_handler = PaymentHandler(db)
     
     # Test creating a user
     print("Creating test user...")
@@ -65,6 +74,24 @@ def test_bot_functionality():
     print("\nChecking final token status...")
     final_token_status = db.get_user_token_status(user['id'])
     print(f"Final token status: {final_token_status}")
+    assert final_token_status['tokens'] == 34
+    
+    # Test idempotent confirmations
+    print("\nConfirming the same payment reference twice...")
+    first = payment_handler.process_payment_confirmation(user['id'], 10, reference='pay-001')
+    second = payment_handler.process_payment_confirmation(user['id'], 10, reference='pay-001')
+    print(f"First confirmation applied: {first}, second applied: {second}")
+    assert first and not second
+    assert db.get_user_token_status(user['id'])['tokens'] == 44
+    
+    # Test a bulk admin batch with repeats and an unknown user
+    print("\nProcessing a batch of confirmations...")
+    batch = [(user['id'], 1, None, f'batch-{i}') for i in range(250)]
+    batch += [(user['id'], 1, None, 'batch-0'), (999999, 5, None, 'unknown-user')]
+    applied = payment_handler.process_payment_confirmations(batch, batch_size=100)
+    print(f"Applied {applied} of {len(batch)} confirmations")
+    assert applied == 250
+    assert db.get_user_token_status(user['id'])['tokens'] == 294
     
     # Test trial period expiration
     print("\nTesting trial period expiration...")
@@ -72,11 +99,12 @@ def test_bot_functionality():
     conn = sqlite3.connect('test_bot.db')
     cursor = conn.cursor()
     
-    # Calculate the date 4 days ago to simulate expiration
-    expired_date = datetime.now() - timedelta(days=4)
+    # Register the user 4 days ago so the trial ended a day ago
     cursor.execute('''
-        UPDATE users SET created_at = ? WHERE id = ?
-    ''', (expired_date.isoformat(), user['id']))
+        UPDATE users SET created_at = datetime('now', '-4 days'),
+            trial_expires_at = datetime('now', '-1 day')
+        WHERE id = ?
+    ''', (user['id'],))
     
     conn.commit()
     conn.close()
@@ -85,16 +113,99 @@ def test_bot_functionality():
     expired_status = db.get_user_token_status(user['id'])
     print(f"Expired user status: {expired_status}")
     print(f"Is user still active: {expired_status['is_active']}")
+    assert not expired_status['is_active'] and expired_status['days_remaining'] == 0
+    
+    # Expired trials are found and marked by a sweep
+    print("\nSweeping expired trials...")
+    swept = db.sweep_expired_trials()
+    print(f"Marked expired: {swept}")
+    assert swept == [(user['id'], 987654321)]
+    assert db.sweep_expired_trials() == []
     
     # Clean up test database
     print("\nCleaning up...")
-    os.remove('test_bot.db')
-    if os.path.exists('test_bot.db-shm'):
-        os.remove('test_bot.db-shm')
-    if os.path.exists('test_bot.db-wal'):
-        os.remove('test_bot.db-wal')
+    db.close()
+    remove_database('test_bot.db')
     
     print("Bot functionality test completed successfully!")
 
+def test_trial_texts():
+    """Test that the help and welcome texts are built from the configured trial"""
+    print("Testing trial texts...")
+    
+    assert '3 дня и 10 токенов' in bot.HELP_TEXT
+    trial_days = bot.config.TRIAL_DAYS
+    bot.config.TRIAL_DAYS = 5
+    try:
+        assert 'длится 5 дней' in bot.welcome_text('Bot', 1) and '1 токен ' in bot.welcome_text('Bot', 1)
+    finally:
+        bot.config.TRIAL_DAYS = trial_days
+    
+    print("Trial texts test completed successfully!")
+
+def test_throttled_updates():
+    """Test flood control in front of the sync handlers"""
+    print("Testing throttled updates...")
+    
+    # A throttled button press is answered before its update is dropped
+    answers = []
+    query = SimpleNamespace(answer=answers.append)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=5550001), callback_query=query, update_id=1)
+    context = SimpleNamespace(bot_data={})
+    flood_control = bot.flood_control
+    bot.flood_control = bot.FloodControl(rate=0.01, burst=1)
+    try:
+        bot.throttle_update(update, context)
+        try:
+            bot.throttle_update(update, context)
+            assert False, "the second update is over the limit"
+        except bot.DispatcherHandlerStop:
+            pass
+    finally:
+        bot.flood_control = flood_control
+    assert answers == [bot.FLOOD_TEXT]
+    
+    # Counters stay exact while handler threads count at once
+    flood_control = bot.FloodControl(rate=1, burst=100)
+    threads = [
+        threading.Thread(target=lambda: [flood_control.allow(n % 10) for n in range(2000)])
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = flood_control.stats()
+    print(f"Flood control stats: {stats}")
+    assert stats['allowed'] + stats['throttled'] == 8 * 2000 and stats['allowed'] >= 10 * 100
+    
+    print("Throttled updates test completed successfully!")
+
+def test_trial_sweep_job():
+    """Test that the sync runtime sweeps expired trials on a schedule"""
+    print("Testing the trial sweep job...")
+    
+    updater = bot.build_updater('123:TEST', base_url='http://127.0.0.1:1/bot')
+    sweeps = updater.job_queue.get_jobs_by_name('sweep_trials')
+    assert len(sweeps) == 1 and sweeps[0].job.trigger.interval.total_seconds() == bot.config.TRIAL_SWEEP_INTERVAL
+    
+    db = Database('test_bot.db')
+    try:
+        db.create_user(987654321, first_name='Sweep')
+        conn = db.get_connection()
+        conn.execute("UPDATE users SET trial_expires_at = datetime('now', '-1 hour')")
+        conn.commit()
+        assert bot.sweep_trials(db) == 1
+        assert bot.sweep_trials(db) == 0
+    finally:
+        print("\nCleaning up...")
+        db.close()
+        remove_database('test_bot.db')
+    
+    print("Trial sweep job test completed successfully!")
+
 if __name__ == '__main__':
-    test_bot_functionality()
\ No newline at end of file
+    test_bot_functionality()
+    test_trial_texts()
+    test_throttled_updates()
+    test_trial_sweep_job()
\ No newline at end of file
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import re
+import sys
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import Database
+from bot_api import AsyncBotApi
+from broadcast import AUDIENCES, Broadcaster
+from fake_bot_api import FakeBotApi
+from telegram.ext import CommandHandler
+
+import async_bot
+import bot
+
+def test_broadcast():
+    """Test rate-limited, resumable broadcasts against a local Bot API"""
+    print("Testing broadcasts...")
+
+    db = Database('test_broadcast.db')
+    for telegram_id in range(1000, 1025):
+        db.create_user(telegram_id, f"user{telegram_id}")
+
+    # Five users are out of tokens, three trials end within a day
+    conn = db.get_connection()
+    conn.execute("UPDATE users SET tokens = 0 WHERE telegram_id BETWEEN 1000 AND 1004")
+    conn.execute('''
+        UPDATE users SET trial_expires_at = datetime('now', '+12 hours')
+        WHERE telegram_id BETWEEN 1010 AND 1012
+    ''')
+    conn.commit()
+
+    server = FakeBotApi().start()
+
+    async def run(name, audience, max_pages=None):
+        api = AsyncBotApi('TEST', server.base_url)
+        try:
+            broadcaster = Broadcaster(db, api, rate=200, chat_rate=50, page_size=4, retry_backoff=0.01)
+            broadcaster.create(name, audience)
+            return await broadcaster.run(name, max_pages)
+        finally:
+            await api.close()
+
+    try:
+        # Audiences select only their users
+        print("\nBroadcasting to users with an expiring trial...")
+        result = asyncio.run(run('trial', 'trial_expiring'))
+        print(f"Result: {result}")
+        chats = sorted(params['chat_id'] for _, params in server.calls_to('sendMessage'))
+        assert chats == [1010, 1011, 1012]
+        assert result['status'] == 'done' and result['sent'] == 3
+
+        # A 429 pauses sending for retry_after, then every message still goes out once
+        print("\nBroadcasting to users with no tokens through a rate limit...")
+        server.calls.clear()
+        server.fail('sendMessage', times=2, error_code=429, retry_after=1)
+        result = asyncio.run(run('zero', 'zero_balance'))
+        print(f"Result: {result}")
+        calls = server.calls_to('sendMessage')
+        delivered = [params['chat_id'] for _, params in calls[2:]]
+        assert sorted(delivered) == [1000, 1001, 1002, 1003, 1004]
+        assert calls[-1][0] - calls[0][0] >= 0.9
+        assert result['sent'] == 5 and result['failed'] == 0
+
+        # Blocked users are counted as failed and not retried
+        print("\nInterrupting and resuming a broadcast to everyone...")
+        server.calls.clear()
+        server.fail('sendMessage', times=1, error_code=403, retry_after=None, description='Forbidden: bot was blocked by the user')
+        result = asyncio.run(run('all', 'all', max_pages=2))
+        print(f"After two pages: {result}")
+        assert result['status'] == 'running' and result['sent'] + result['failed'] == 8
+        assert result['failed'] == 1
+
+        # A restart picks up after the last finished page without repeating anyone
+        result = asyncio.run(run('all', 'all'))
+        print(f"After resuming: {result}")
+        chats = [params['chat_id'] for _, params in server.calls_to('sendMessage')]
+        assert len(chats) == len(set(chats)) == 25
+        assert result['status'] == 'done' and result['sent'] == 24 and result['failed'] == 1
+
+        # A finished broadcast is not sent again
+        server.calls.clear()
+        asyncio.run(run('all', 'all'))
+        assert not server.calls_to('sendMessage')
+    finally:
+        server.stop()
+
+        # Clean up test database
+        print("\nCleaning up...")
+        db.close()
+        for suffix in ('', '-shm', '-wal'):
+            if os.path.exists('test_broadcast.db' + suffix):
+                os.remove('test_broadcast.db' + suffix)
+
+    print("Broadcast test completed successfully!")
+
+def test_broadcast_commands():
+    """Test that every command a default broadcast text names is registered"""
+    print("Testing broadcast commands...")
+
+    updater = bot.build_updater('123:TEST', base_url='http://127.0.0.1:1/bot')
+    registered = {
+        command
+        for handlers in updater.dispatcher.handlers.values()
+        for handler in handlers if isinstance(handler, CommandHandler)
+        for command in handler.command
+    }
+
+    for audience, (_, text) in AUDIENCES.items():
+        named = set(re.findall(r'/(\w+)', text))
+        print(f"{audience}: {sorted(named)}")
+        assert named, f"{audience} names no command"
+        assert named <= registered, f"{audience} names unregistered commands: {named - registered}"
+        assert named <= set(async_bot.COMMANDS), f"{audience} names commands the async runtime lacks"
+
+    print("Broadcast commands test completed successfully!")
+
+if __name__ == '__main__':
+    test_broadcast()
+    test_broadcast_commands()
@@ -0,0 +1,141 @@
+import csv
+import json
+import os
+import sys
+import time
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import Database
+from catalog import Catalog, SearchCache, SearchCursors, SEED_ENTRIES, build_match_query
+from ingest import ingest
+
+def test_catalog():
+    """Test the content catalog and its full-text search"""
+    print("Testing content catalog...")
+
+    db = Database('test_catalog.db')
+    catalog = Catalog(db)
+
+    # A fresh catalog is seeded
+    print("\nSearching without terms...")
+    results = catalog.search('')
+    print(f"Found {len(results)} entries")
+    assert len(results) == len(SEED_ENTRIES)
+
+    # Inflected Russian query terms match through stemming and prefixes
+    print("\nSearching with inflected terms...")
+    results = catalog.search('манипуляция')
+    print(f"Results: {[entry['title'] for entry in results]}")
+    assert results[0]['title'] == 'Манипуляции в межличностных отношениях'
+
+    # Title matches outrank summary matches
+    catalog.add_entry('Газлайтинг', summary='Скрытая форма манипуляции.', source='Тест', external_id='t-1')
+    catalog.add_entry('Манипуляция через чувство вины', summary='Разбор приемов.', source='Тест', external_id='t-2')
+    results = catalog.search('манипуляциями')
+    print(f"Ranked results: {[entry['title'] for entry in results]}")
+    titles = [entry['title'] for entry in results]
+    assert titles.index('Манипуляция через чувство вины') < titles.index('Газлайтинг')
+
+    # Duplicate external ids are rejected
+    assert catalog.add_entry('Дубликат', external_id='t-1') is None
+
+    # FTS5 syntax typed by users is treated as plain words
+    print("\nSearching with FTS operators...")
+    query = 'NEAR( "вины OR'
+    print(f"Match expression: {build_match_query(query)}")
+    assert catalog.search(query)[0]['title'] == 'Манипуляция через чувство вины'
+
+    # The limit is respected
+    assert len(catalog.search('психология', limit=2)) == 2
+
+    # Result cache
+    print("\nTesting search result cache...")
+    renders = []
+
+    def render(entries):
+        renders.append(entries)
+        return ', '.join(entry['title'] for entry in entries)
+
+    search_cache = SearchCache(catalog, render, maxsize=10)
+    first = search_cache.get('Манипуляции лжи')
+    assert search_cache.get('лжи  манипуляция') == first, "equivalent queries share an entry"
+    assert len(renders) == 1
+    print(f"Cache stats: {search_cache.stats()}")
+    assert search_cache.stats()['hit_rate'] == 0.5
+
+    # A catalog write invalidates cached results
+    catalog.add_entry('Ложь во спасение', summary='Манипуляции с благими намерениями.', external_id='t-3')
+    assert 'Ложь во спасение' in search_cache.get('Манипуляции лжи')
+    assert len(renders) == 2
+
+    # Paginated results are cached as a tuple of pages, which cursors refer to
+    print("\nTesting result cursors...")
+    paged_cache = SearchCache(catalog, lambda entries: tuple(entry['title'] for entry in entries), limit=50)
+    pages = paged_cache.get('психология')
+    assert len(pages) > 1 and paged_cache.get('психология') is pages
+
+    cursors = SearchCursors(maxsize=2, ttl=60)
+    cursor_id = cursors.open(1, pages, {'tokens': 9})
+    assert len(cursor_id.encode()) + len('page::99') <= 64, "fits in callback data"
+    assert cursors.get(cursor_id, 1) == (pages, {'tokens': 9})
+    assert cursors.get(cursor_id, 2) is None, "only the owner can turn pages"
+    cursors.open(2, pages)
+    cursors.open(3, pages)
+    assert cursors.get(cursor_id, 1) is None and cursors.stats()['evictions'] == 1
+
+    expiring = SearchCursors(ttl=0.01)
+    cursor_id = expiring.open(1, pages)
+    time.sleep(0.02)
+    assert expiring.get(cursor_id, 1) is None
+
+    # Bulk ingestion
+    print("\nIngesting a JSONL dump...")
+    with open('test_catalog.jsonl', 'w', encoding='utf-8') as f:
+        for i in range(2000):
+            f.write(json.dumps({
+                'external_id': f'bulk-{i}',
+                'title': f'Статья {i} о влиянии',
+                'summary': 'Социальное доказательство' if i % 2 else 'Эффект якоря',
+                'source': 'Дамп'
+            }, ensure_ascii=False) + '\n')
+        f.write('{not json}\n')
+        f.write(json.dumps({'external_id': 'bulk-no-title'}) + '\n')
+
+    version = catalog.version()
+    stats = ingest(catalog, 'test_catalog.jsonl', batch_size=500)
+    print(f"Ingest stats: {stats}")
+    assert stats['valid'] == 2000 and stats['invalid'] == 2
+    assert stats['changed'] == 2000 and stats['batches'] == 4
+    assert catalog.version() > version
+    assert catalog.search('якорь', limit=3)[0]['summary'] == 'Эффект якоря'
+
+    # Reloading the same dump changes nothing
+    assert ingest(catalog, 'test_catalog.jsonl', batch_size=500)['changed'] == 0
+
+    # A CSV refresh updates existing entries and keeps the index in step
+    print("\nRefreshing from a CSV dump...")
+    with open('test_catalog.csv', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['external_id', 'title', 'summary', 'source'])
+        writer.writeheader()
+        writer.writerow({'external_id': 'bulk-7', 'title': 'Ловушка взаимности', 'summary': '', 'source': 'Дамп'})
+    stats = ingest(catalog, 'test_catalog.csv', rebuild=True)
+    assert stats['changed'] == 1
+    assert catalog.search('взаимности')[0]['title'] == 'Ловушка взаимности'
+    assert not [entry for entry in catalog.search('Статья 7 о влиянии', limit=50) if entry['title'] == 'Статья 7 о влиянии']
+
+    os.remove('test_catalog.jsonl')
+    os.remove('test_catalog.csv')
+
+    # Clean up test database
+    print("\nCleaning up...")
+    db.close()
+    for suffix in ('', '-shm', '-wal'):
+        if os.path.exists('test_catalog.db' + suffix):
+            os.remove('test_catalog.db' + suffix)
+
+    print("Catalog test completed successfully!")
+
+if __name__ == '__main__':
+    test_catalog()
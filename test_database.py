@@ -1,6 +1,7 @@
 import os
 import sys
 import sqlite3
+import threading
 from datetime import datetime, timedelta
 
 # Add the current directory to the path so we can import the database module
@@ -39,6 +40,13 @@ def test_database():
         print("Failed to retrieve user")
         return
     
+    # Test user cache
+    print("\nGetting user again from cache...")
+    cached_user = db.get_user(123456789)
+    print(f"Cache stats: {db.user_cache.stats()}")
+    assert cached_user == retrieved_user
+    assert db.user_cache.hits >= 1
+    
     # Test token status
     print("\nChecking token status...")
     token_status = db.get_user_token_status(user['id'])
@@ -61,6 +69,11 @@ def test_database():
     print("\nAdding 5 tokens...")
     db.add_tokens(user['id'], 5)
     
+    # Cached balance follows token changes
+    cached_tokens = db.get_user(123456789)['tokens']
+    print(f"Cached balance after changes: {cached_tokens}")
+    assert cached_tokens == 14
+    
     # Check final token status
     print("\nChecking final token status...")
     final_token_status = db.get_user_token_status(user['id'])
@@ -74,8 +87,80 @@ def test_database():
     else:
         print("Failed to record payment")
     
+    # Test token ledger
+    print("\nChecking token ledger...")
+    history = db.get_token_history(user['id'])
+    print(f"Ledger: {[(entry['reason'], entry['delta']) for entry in history]}")
+    assert [entry['reason'] for entry in history] == ['adjustment', 'search', 'trial']
+    reconciliation = db.reconcile_balance(user['id'])
+    print(f"Reconciliation: {reconciliation}")
+    assert reconciliation['consistent'] and reconciliation['balance'] == 14
+    
+    print(f"Payment history: {db.get_payment_history(user['id'])}")
+    revenue = db.get_daily_revenue('2000-01-01', '2100-01-01')
+    print(f"Daily revenue: {revenue}")
+    assert revenue[0]['revenue'] == 100 and revenue[0]['tokens'] == 10
+    
+    # Test trial expiry lookups
+    print("\nFinding trials expiring within 4 days...")
+    expiring = db.find_expiring_trials(datetime.utcnow() + timedelta(days=4))
+    print(f"Expiring: {expiring}")
+    assert [row['id'] for row in expiring] == [user['id']]
+    assert db.find_expiring_trials(datetime.utcnow() + timedelta(days=1)) == []
+    
+    # Test buffered last access updates
+    print("\nBuffering last access update...")
+    db.last_access_flush_interval = 3600
+    conn = sqlite3.connect('test_users.db')
+    conn.execute("UPDATE users SET last_access = '2000-01-01 00:00:00' WHERE id = ?", (user['id'],))
+    conn.commit()
+    db.update_last_access(user['id'])
+    stored = conn.execute('SELECT last_access FROM users WHERE id = ?', (user['id'],)).fetchone()[0]
+    assert stored == '2000-01-01 00:00:00', "update should wait in the buffer"
+    flushed = db.flush_last_access()
+    stored = conn.execute('SELECT last_access FROM users WHERE id = ?', (user['id'],)).fetchone()[0]
+    conn.close()
+    print(f"Flushed {flushed} buffered update(s), last access is now {stored}")
+    assert flushed == 1 and stored != '2000-01-01 00:00:00'
+    
+    # Test atomic search charge
+    print("\nCharging searches concurrently for a new user...")
+    results = []
+    
+    def charge():
+        results.append(db.charge_search(555000111, username='racer'))
+    
+    threads = [threading.Thread(target=charge) for _ in range(15)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    charged = [result for result in results if result['charged']]
+    print(f"Charged {len(charged)} of {len(results)} searches")
+    assert len(charged) == 10, "only the trial tokens may be charged"
+    assert sorted(result['tokens'] for result in charged) == list(range(10))
+    assert db.get_user(555000111)['tokens'] == 0
+    assert db.find_balance_mismatches() == [], "ledger must match every balance"
+    
+    # Test connection pooling
+    print("\nChecking pooled connections...")
+    conn = db.get_connection()
+    assert conn is db.get_connection(), "connection should be reused within a thread"
+    journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    print(f"Journal mode: {journal_mode}")
+    assert journal_mode == 'wal'
+    
+    other = []
+    worker = threading.Thread(target=lambda: other.append(db.get_connection()))
+    worker.start()
+    worker.join()
+    assert other[0] is not conn, "each thread should get its own connection"
+    print("Each thread uses its own long-lived connection")
+    
     # Clean up test database
     print("\nCleaning up...")
+    db.close()
     os.remove('test_users.db')
     if os.path.exists('test_users.db-shm'):
         os.remove('test_users.db-shm')
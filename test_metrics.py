@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib.request
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import metrics
+from database import Database
+
+def test_metrics():
+    """Test handler and database metrics and the Prometheus endpoint"""
+    print("Testing metrics...")
+
+    # Handlers are counted and timed, errors included
+    def ok_handler(update, context):
+        time.sleep(0.002)
+
+    def failing_handler(update, context):
+        raise ValueError("boom")
+
+    timed_ok = metrics.timed_handler('test_ok', ok_handler)
+    timed_failing = metrics.timed_handler('test_failing', failing_handler)
+    for _ in range(20):
+        timed_ok(None, None)
+    try:
+        timed_failing(None, None)
+    except ValueError:
+        pass
+
+    summary = metrics.handler_summary()
+    print(f"Handler summary: {summary['test_ok']}")
+    assert summary['test_ok']['count'] == 20 and summary['test_ok']['errors'] == 0
+    assert 0.002 <= summary['test_ok']['p50'] <= 0.01
+    assert summary['test_failing']['count'] == 1 and summary['test_failing']['errors'] == 1
+
+    # Database calls are timed, and calls that hit a held lock are retried
+    print("\nHolding the write lock while a Database call runs...")
+    db = Database('test_metrics.db', busy_timeout=50)
+    user = db.create_user(777000111, username='metrics')
+
+    blocker = sqlite3.connect('test_metrics.db', check_same_thread=False)
+    blocker.execute('BEGIN IMMEDIATE')
+    threading.Timer(0.2, blocker.rollback).start()
+
+    retries = metrics.DB_LOCK_RETRIES.get('add_tokens')
+    db.add_tokens(user['id'], 5)
+    print(f"Lock retries: {metrics.DB_LOCK_RETRIES.get('add_tokens') - retries}")
+    assert metrics.DB_LOCK_RETRIES.get('add_tokens') > retries
+    assert db.get_user(777000111)['tokens'] == user['tokens'] + 5
+    assert metrics.DB_SECONDS.summary('add_tokens')['count'] >= 1
+    blocker.close()
+
+    # A method called by another is counted once, as the outer one
+    calls = metrics.DB_CALLS.get('charge_search'), metrics.DB_CALLS.get('charge_searches')
+    db.charge_search(777000111)
+    assert metrics.DB_CALLS.get('charge_search') == calls[0] + 1
+    assert metrics.DB_CALLS.get('charge_searches') == calls[1]
+
+    # Everything is scraped in the Prometheus text format
+    print("\nScraping the metrics endpoint...")
+    server = metrics.MetricsServer(port=0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics') as response:
+            body = response.read().decode()
+    finally:
+        server.stop()
+    assert '# TYPE bot_handler_seconds histogram' in body
+    assert 'bot_handler_calls_total{handler="test_ok"} 20' in body
+    assert 'bot_handler_seconds_bucket{handler="test_ok",le="+Inf"} 20' in body
+    assert 'bot_db_lock_retries_total{method="add_tokens"}' in body
+
+    # Clean up test database
+    print("\nCleaning up...")
+    db.close()
+    for suffix in ('', '-shm', '-wal'):
+        if os.path.exists('test_metrics.db' + suffix):
+            os.remove('test_metrics.db' + suffix)
+
+    print("Metrics test completed successfully!")
+
+if __name__ == '__main__':
+    test_metrics()
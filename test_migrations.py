@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import sys
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import migrations
+from database import Database
+
+def remove_database(path):
+    for suffix in ('', '-shm', '-wal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def test_migrations():
+    """Test versioned schema migrations on new and pre-versioning databases"""
+    print("Testing schema migrations...")
+
+    # A new database gets every migration, once
+    db = Database('test_migrations.db')
+    conn = db.get_connection()
+    versions = [row[0] for row in conn.execute('SELECT version FROM schema_migrations ORDER BY version')]
+    print(f"Applied versions: {versions}")
+    assert versions == [number for number, _, _ in migrations.MIGRATIONS]
+    assert migrations.migrate(db) == []
+    db.close()
+
+    # Reopening applies nothing and keeps the data
+    db = Database('test_migrations.db')
+    user = db.create_user(555000111, username='migrated')
+    assert db.get_user(555000111)['tokens'] == user['tokens']
+    db.close()
+    remove_database('test_migrations.db')
+
+    # A database from before versioning is adopted without losing balances
+    print("\nMigrating a legacy database...")
+    legacy = sqlite3.connect('test_migrations.db')
+    legacy.executescript('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            tokens INTEGER DEFAULT 10,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_access TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            tokens INTEGER NOT NULL,
+            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO users (telegram_id, username, tokens) VALUES (1001, 'old', 42);
+    ''')
+    legacy.close()
+
+    db = Database('test_migrations.db')
+    user = db.get_user(1001)
+    print(f"Legacy user: {user}")
+    assert user['tokens'] == 42
+    assert db.get_token_history(user['id'])[0]['delta'] == 42
+    trial = db.get_connection().execute('SELECT trial_expires_at FROM users WHERE id = ?', (user['id'],)).fetchone()[0]
+    assert trial is not None
+
+    # Later migrations apply on top of the recorded version only
+    applied = []
+    extra = migrations.MIGRATIONS + [(len(migrations.MIGRATIONS) + 1, 'test step', lambda cursor, db: applied.append(1))]
+    assert migrations.migrate(db, extra) == [len(migrations.MIGRATIONS) + 1]
+    assert migrations.migrate(db, extra) == []
+    assert applied == [1]
+
+    # Clean up test database
+    print("\nCleaning up...")
+    db.close()
+    remove_database('test_migrations.db')
+
+    print("Migrations test completed successfully!")
+
+if __name__ == '__main__':
+    test_migrations()
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import re
+import sys
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update
+
+import bot
+import config
+from async_bot import AsyncRuntime
+from bot_api import AsyncBotApi
+from fake_bot_api import FakeBotApi
+from offsets import ID_RESTART_GAP, UpdateTracker
+from ratelimit import FloodControl
+
+def make_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        }
+    }
+
+def test_offsets():
+    """Test the durable update offset, idempotent charges and the startup catch-up"""
+    print("Testing update offsets...")
+
+    # Keep the bot away from the production database and let backlogs through flood control;
+    # set here because other tests share the imported modules
+    database_path, flood_control = config.DATABASE_PATH, bot.flood_control
+    config.DATABASE_PATH = 'test_offsets.db'
+    bot.flood_control = FloodControl(config.FLOOD_RATE, burst=1000)
+    db = bot.get_db()
+
+    # The offset only moves past updates once everything below them is handled
+    tracker = UpdateTracker(db)
+    assert tracker.offset == 0
+    assert tracker.begin(1) and tracker.begin(2) and tracker.begin(3)
+    assert not tracker.begin(2)
+    assert not tracker.finish(2)
+    assert tracker.finish(1) and tracker.offset == 2
+    assert tracker.finish(3) and tracker.offset == 3
+    assert not tracker.begin(3) and tracker.duplicates == 2
+    tracker.commit()
+    assert UpdateTracker(db).offset == 3
+
+    # A charge made for an update is not made again when the update is redelivered
+    print("\nReplaying a search charge...")
+    first = db.charge_search(4242, first_name='Replay', update_id=10)
+    again = db.charge_search(4242, first_name='Replay', update_id=10)
+    print(f"First: {first}, replayed: {again}")
+    assert first['charged'] and again['charged']
+    assert again['tokens'] == first['tokens'] == 9
+    assert db.get_user(4242)['tokens'] == 9
+
+    charges = db.charge_searches([{'telegram_id': 4242, 'update_id': update_id} for update_id in (11, 10, 12)])
+    assert [charge['tokens'] for charge in charges] == [8, 9, 7]
+    assert db.get_user(4242)['tokens'] == 7
+
+    # A backlog is drained in batches before polling starts
+    print("\nCatching up on a backlog...")
+    server = FakeBotApi().start()
+    try:
+        backlog = []
+        for _ in range(12):
+            for user_id in range(1, 21):
+                backlog.append(make_update(100 + len(backlog), user_id, '/search'))
+        server.add_updates(backlog)
+
+        updater = bot.build_updater('123456:TEST', base_url=server.base_url, tracker=bot.get_update_tracker())
+        handled = bot.catch_up(updater, batch_size=100)
+        print(f"Handled {handled} updates, tracker: {bot.get_update_tracker().stats()}")
+        assert handled == len(backlog)
+        assert db.get_update_offset() == backlog[-1]['update_id']
+
+        replies = server.calls_to('sendMessage')
+        assert len(replies) == len(backlog)
+        for user_id in range(1, 21):
+            texts = [params['text'] for _, params in replies if int(params['chat_id']) == user_id]
+            balances = sorted(int(match) for text in texts for match in re.findall(r'Осталось токенов: (\d+)', text))
+            assert balances == list(range(10)), f"user {user_id}: {balances}"
+
+        # After a restart the handled updates are skipped, even if delivered again
+        print("\nRestarting...")
+        updater.stop()
+        bot.close_db()
+        db = bot.get_db()
+        tracker = bot.get_update_tracker()
+        assert tracker.offset == backlog[-1]['update_id']
+
+        updater = bot.build_updater('123456:TEST', base_url=server.base_url, tracker=tracker)
+        # The first batch is fetched without an offset, so what Telegram still holds is dropped again
+        assert bot.catch_up(updater) == 0
+        duplicates = tracker.duplicates
+        for data in backlog[-5:]:
+            updater.dispatcher.process_update(Update.de_json(data, updater.bot))
+        tracker.wait_idle(5)
+        assert tracker.duplicates == duplicates + 5
+        assert len(server.calls_to('sendMessage')) == len(backlog)
+        assert all(db.get_user(user_id)['tokens'] == 0 for user_id in range(1, 21))
+        updater.stop()
+
+        # The asyncio runtime catches up the same way
+        print("\nCatching up in the async runtime...")
+        backlog = [make_update(1000 + i, 30 + i % 5, '/search') for i in range(150)]
+        server.add_updates(backlog)
+        sent = len(server.calls_to('sendMessage'))
+
+        async def catch_up():
+            runtime = AsyncRuntime(AsyncBotApi('123456:TEST', server.base_url), db, tracker=tracker)
+            try:
+                return await runtime.catch_up(batch_size=100)
+            finally:
+                runtime.executor.shutdown()
+                await runtime.api.close()
+
+        assert asyncio.run(catch_up()) == len(backlog)
+        assert db.get_update_offset() == backlog[-1]['update_id']
+        assert all(db.get_user(user_id)['tokens'] == 0 for user_id in range(30, 35))
+        assert len(server.calls_to('sendMessage')) == sent + len(backlog)
+
+        # After a week without updates Telegram may restart the update_ids far below the offset
+        print("\nRestarting the update ids...")
+        offset = db.get_update_offset()
+        backlog = [make_update(offset - ID_RESTART_GAP - 500 + i, 40, '/help') for i in range(3)]
+        server.add_updates(backlog)
+        sent = len(server.calls_to('sendMessage'))
+        updater = bot.build_updater('123456:TEST', base_url=server.base_url, tracker=tracker)
+        assert bot.catch_up(updater) == len(backlog)
+        updater.stop()
+        print(f"Tracker: {tracker.stats()}")
+        assert len(server.calls_to('sendMessage')) == sent + len(backlog)
+        assert tracker.offset == db.get_update_offset() == backlog[-1]['update_id']
+        assert not tracker.begin(backlog[0]['update_id'])
+        assert tracker.begin(offset - 1)
+    finally:
+        server.stop()
+
+        # Clean up test database
+        print("\nCleaning up...")
+        bot.close_db()
+        config.DATABASE_PATH, bot.flood_control = database_path, flood_control
+        for suffix in ('', '-shm', '-wal'):
+            if os.path.exists('test_offsets.db' + suffix):
+                os.remove('test_offsets.db' + suffix)
+
+    print("Update offsets test completed successfully!")
+
+if __name__ == '__main__':
+    test_offsets()
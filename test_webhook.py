@@ -0,0 +1,114 @@
+import json
+import os
+import queue
+import sys
+import urllib.error
+import urllib.request
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from webhook import SECRET_TOKEN_HEADER, WebhookServer, webhook_secret
+
+# Updates as Telegram delivers them to a webhook
+RECORDED_UPDATES = [
+    {
+        'update_id': 1000 + i,
+        'message': {
+            'message_id': i,
+            'date': 1700000000 + i,
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Hook'},
+            'text': text
+        }
+    }
+    for i, text in enumerate(['/start', '/search', '/profile'])
+]
+
+def post(port, payload, secret=None, path='/webhook'):
+    """POST a JSON payload to the webhook and return the HTTP status"""
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}{path}',
+        data=json.dumps(payload).encode(),
+        headers={'Content-Type': 'application/json'}
+    )
+    if secret is not None:
+        request.add_header(SECRET_TOKEN_HEADER, secret)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+def test_webhook_server():
+    """Test the webhook endpoint by replaying recorded updates"""
+    print("Testing webhook server...")
+
+    received = queue.Queue()
+    server = WebhookServer(received.put, port=0, secret_token='s3cret').start()
+
+    try:
+        # Replay updates one by one, the way Telegram sends them
+        for update in RECORDED_UPDATES:
+            status = post(server.port, update, secret='s3cret')
+            assert status == 200, f"expected 200, got {status}"
+
+        # And as a single batch
+        assert post(server.port, RECORDED_UPDATES, secret='s3cret') == 200
+
+        ids = [received.get(timeout=1)['update_id'] for _ in range(len(RECORDED_UPDATES) * 2)]
+        print(f"Queued update ids: {ids}")
+        assert ids == [update['update_id'] for update in RECORDED_UPDATES] * 2
+
+        # Rejected requests never reach the queue
+        print("\nChecking rejected requests...")
+        assert post(server.port, RECORDED_UPDATES[0], secret='wrong') == 403
+        assert post(server.port, RECORDED_UPDATES[0]) == 403
+        assert post(server.port, RECORDED_UPDATES[0], secret='s3cret', path='/other') == 404
+        assert post(server.port, {'no': 'update'}, secret='s3cret') == 400
+        assert received.empty()
+    finally:
+        server.stop()
+
+    print("Webhook server test completed successfully!")
+
+def test_webhook_secret():
+    """Test that the webhook never runs without a secret"""
+    print("Testing webhook secret...")
+
+    for secret_token in (None, ''):
+        try:
+            WebhookServer(lambda update: None, port=0, secret_token=secret_token)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"server started with secret {secret_token!r}")
+
+    try:
+        webhook_secret(None, None)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("no secret and no URL to register one with")
+    assert webhook_secret('s3cret', 'https://example.com/webhook') == 's3cret'
+    generated = webhook_secret(None, 'https://example.com/webhook')
+    assert len(generated) >= 32 and generated != webhook_secret(None, 'https://example.com/webhook')
+
+    # A forged update without the generated secret is refused and never dispatched
+    dispatched = queue.Queue()
+    server = WebhookServer(dispatched.put, port=0, secret_token=generated).start()
+    try:
+        assert post(server.port, RECORDED_UPDATES[1]) == 403
+        assert post(server.port, RECORDED_UPDATES[1], secret='') == 403
+        assert post(server.port, RECORDED_UPDATES[1], secret=generated[:-1]) == 403
+        assert dispatched.empty()
+        assert post(server.port, RECORDED_UPDATES[1], secret=generated) == 200
+        assert dispatched.get(timeout=1)['update_id'] == RECORDED_UPDATES[1]['update_id']
+    finally:
+        server.stop()
+
+    print("Webhook secret test completed successfully!")
+
+if __name__ == '__main__':
+    test_webhook_server()
+    test_webhook_secret()
@@ -0,0 +1,141 @@
+import os
+import re
+import sys
+import time
+
+# Add the current directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Worker processes open the database named here and let every search through
+os.environ['DATABASE_PATH'] = 'test_workers.db'
+os.environ['FLOOD_BURST'] = '100'
+
+from database import Database
+from fake_bot_api import FakeBotApi
+from metrics import CombinedRegistry
+from offsets import UpdateTracker
+from workers import WorkerPool, update_user_id
+
+def make_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        }
+    }
+
+def test_worker_pool():
+    """Test partitioned worker processes against a local Bot API"""
+    print("Testing worker processes...")
+
+    assert update_user_id(make_update(1, 42, '/start')) == 42
+    assert update_user_id({'update_id': 2, 'callback_query': {'id': '1', 'from': {'id': 7}}}) == 7
+    assert update_user_id({'update_id': 3}) == 0
+
+    server = FakeBotApi().start()
+    db = Database('test_workers.db')
+    pool = WorkerPool('123456:TEST', server.base_url, processes=2, heartbeat_interval=0.5, tracker=UpdateTracker(db))
+    pool.start()
+
+    try:
+        # Each user searches 12 times with 10 trial tokens
+        updates = []
+        for _ in range(12):
+            for user_id in range(1, 7):
+                updates.append(make_update(len(updates) + 1, user_id, '/search'))
+        for data in updates:
+            pool.route(data)
+
+        deadline = time.monotonic() + 60
+        while len(server.calls_to('sendMessage')) < len(updates) and time.monotonic() < deadline:
+            time.sleep(0.2)
+
+        replies = server.calls_to('sendMessage')
+        print(f"Sent {len(updates)} updates, got {len(replies)} replies")
+        assert len(replies) == len(updates)
+
+        # Every user's searches were charged one after another, in order
+        for user_id in range(1, 7):
+            texts = [params['text'] for _, params in replies if int(params['chat_id']) == user_id]
+            balances = [int(match) for text in texts for match in re.findall(r'Осталось токенов: (\d+)', text)]
+            assert balances == list(range(9, -1, -1)), f"user {user_id}: {balances}"
+            assert len(texts) == 12
+
+        # A worker that dies is restarted and keeps serving its partition
+        print("\nKilling a worker...")
+        deadline = time.monotonic() + 10
+        status = pool.check_health()
+        while sum(report['processed'] for report in status) < len(updates) and time.monotonic() < deadline:
+            time.sleep(0.2)
+            status = pool.check_health()
+        print(f"Health: {status}")
+        assert sum(report['processed'] for report in status) == len(updates)
+
+        # The workers' metrics arrive with their heartbeats and are served summed
+        rendered = CombinedRegistry(pool.metric_snapshots).render()
+        assert f'bot_handler_calls_total{{handler="search"}} {len(updates)}' in rendered
+
+        # Acknowledged updates move the stored offset, and are not handled again
+        print(f"Tracking: {pool.tracker.stats()}")
+        assert pool.tracker.offset == len(updates) and db.get_update_offset() == len(updates)
+        assert not any(pool.pending)
+        assert not pool.route(updates[0])
+        assert UpdateTracker(db).offset == len(updates)
+
+        pool.processes[0].kill()
+        pool.processes[0].join()
+        pool.check_health()
+        assert pool.restarts == 1 and pool.processes[0].is_alive()
+
+        pool.route(make_update(1000, 2, '/help'))
+        deadline = time.monotonic() + 60
+        while len(server.calls_to('sendMessage')) == len(updates) and time.monotonic() < deadline:
+            time.sleep(0.2)
+        assert len(server.calls_to('sendMessage')) == len(updates) + 1
+
+        # A replaced worker's counts are kept
+        deadline = time.monotonic() + 10
+        while 'handler="help"' not in CombinedRegistry(pool.metric_snapshots).render() and time.monotonic() < deadline:
+            time.sleep(0.2)
+            pool.check_health()
+        rendered = CombinedRegistry(pool.metric_snapshots).render()
+        assert f'bot_handler_calls_total{{handler="search"}} {len(updates)}' in rendered
+        assert 'bot_handler_calls_total{handler="help"} 1' in rendered
+
+        # Updates routed to a dead worker go to its replacement
+        print("\nRouting updates to a dead worker...")
+        pool.processes[0].kill()
+        pool.processes[0].join()
+        queued = [make_update(2000 + i, 2, '/help') for i in range(20)]
+        for data in queued:
+            pool.route(data)
+        assert len(pool.pending[0]) == len(queued)
+        pool.check_health()
+        assert pool.restarts == 2
+        deadline = time.monotonic() + 60
+        while pool.tracker.offset < queued[-1]['update_id'] and time.monotonic() < deadline:
+            time.sleep(0.2)
+            pool.check_health()
+        print(f"Tracking: {pool.tracker.stats()}")
+        assert pool.tracker.offset == queued[-1]['update_id'] and not any(pool.pending)
+        assert len(server.calls_to('sendMessage')) >= len(updates) + 1 + len(queued)
+    finally:
+        pool.stop()
+        server.stop()
+        db.close()
+
+        # Clean up test database
+        print("\nCleaning up...")
+        for suffix in ('', '-shm', '-wal'):
+            if os.path.exists('test_workers.db' + suffix):
+                os.remove('test_workers.db' + suffix)
+
+    print("Worker pool test completed successfully!")
+
+if __name__ == '__main__':
+    test_worker_pool()
@@ -0,0 +1,108 @@
+import hmac
+import json
+import logging
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Largest request body accepted from the webhook (bytes)
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+def webhook_secret(secret_token, url):
+    """Return the secret token the webhook must require
+
+    Without a configured secret, one is generated when the bot registers url
+    itself; otherwise Telegram would not know it, so ValueError is raised.
+    """
+    if secret_token:
+        return secret_token
+    if url:
+        return secrets.token_urlsafe(32)
+    raise ValueError("Webhook mode needs WEBHOOK_SECRET, or WEBHOOK_URL so a secret can be generated and registered")
+
+class WebhookServer:
+    """Embedded HTTP endpoint that receives updates and hands them to a queue callback
+
+    The callback must only enqueue the update: requests are acknowledged as soon
+    as it returns, before any handler runs. Requests without secret_token in
+    their header are refused, so a secret is required.
+    """
+
+    def __init__(self, on_update, host='127.0.0.1', port=8443, path='/webhook', secret_token=None):
+        if not secret_token:
+            raise ValueError("WebhookServer needs a secret token")
+        self.on_update = on_update
+        self.path = path
+        self.secret_token = secret_token
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self._respond(404)
+                    return
+
+                if not hmac.compare_digest(
+                    self.headers.get(SECRET_TOKEN_HEADER, ''), server.secret_token
+                ):
+                    self._respond(403)
+                    return
+
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > MAX_BODY_SIZE:
+                    self._respond(413)
+                    return
+
+                try:
+                    payload = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self._respond(400)
+                    return
+
+                # Telegram posts one update at a time; relays may post a batch
+                updates = payload if isinstance(payload, list) else [payload]
+                if not all(isinstance(update, dict) and 'update_id' in update for update in updates):
+                    self._respond(400)
+                    return
+
+                for update in updates:
+                    server.on_update(update)
+
+                self._respond(200)
+
+            def _respond(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+        return Handler
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logger.info("Webhook listening on port %s at %s", self.port, self.path)
+        return self
+
+    def stop(self):
+        """Stop accepting requests and release the socket"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
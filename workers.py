@@ -0,0 +1,307 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+import telegram
+from telegram import Update
+from telegram.error import NetworkError
+
+import config
+import metrics
+from backup import BackupScheduler
+from database import Database
+from offsets import UpdateTracker
+from webhook import WebhookServer, webhook_secret
+
+logger = logging.getLogger(__name__)
+
+# Long polling timeout for getUpdates in the parent (seconds)
+POLL_TIMEOUT = 10
+
+# A worker that has not reported for this many heartbeats is considered stuck
+STALE_HEARTBEATS = 3
+
+# Payloads of an update that carry the sender
+USER_FIELDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query',
+    'inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+    'my_chat_member', 'chat_member', 'chat_join_request'
+)
+
+# Fresh interpreters: a forked child would inherit the parent's SQLite connections
+_context = multiprocessing.get_context('spawn')
+
+def update_user_id(data):
+    """Return the id of the user who sent a raw update, or 0 if it has none"""
+    for field in USER_FIELDS:
+        payload = data.get(field)
+        if payload:
+            sender = payload.get('from') or payload.get('chat') or {}
+            return sender.get('id', 0)
+    return 0
+
+def worker_main(index, token, base_url, updates, health, heartbeat_interval):
+    """Handle updates from one partition in arrival order until a None sentinel"""
+    # The parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Imported here so each process opens its own database connections
+    import bot
+
+    # No worker threads: updates of one user must not overtake each other
+    updater = bot.build_updater(token, base_url=base_url, workers=0)
+    dispatcher = updater.dispatcher
+    updater.job_queue.start()
+
+    processed = 0
+    # Updates handled since the last heartbeat, which acknowledges them
+    done = []
+    last_beat = 0.0
+
+    def beat():
+        health.put({
+            'worker': index,
+            'pid': multiprocessing.current_process().pid,
+            'processed': processed,
+            'errors': sum(metrics.HANDLER_ERRORS.get(name) for name in metrics.HANDLER_ERRORS.label_values()),
+            'at': time.time(),
+            'done': list(done),
+            # Summed with the other workers' for the receiving process's /metrics
+            'metrics': metrics.snapshot()
+        })
+
+    try:
+        while True:
+            try:
+                data = updates.get(timeout=heartbeat_interval)
+            except queue.Empty:
+                data = ()
+
+            if data is None:
+                break
+            if data:
+                dispatcher.process_update(Update.de_json(data, updater.bot))
+                processed += 1
+                done.append(data['update_id'])
+
+            now = time.monotonic()
+            if now - last_beat >= heartbeat_interval:
+                beat()
+                done.clear()
+                last_beat = now
+    finally:
+        updater.job_queue.stop()
+        bot.close_db()
+        beat()
+
+class WorkerPool:
+    """Fans updates out to worker processes, partitioned by user
+
+    All updates of a user go to the same worker, which handles them one at
+    a time, so they are processed in order and never charge concurrently.
+    Workers share the database file in WAL mode. Each heartbeat carries the
+    worker's metrics, which metric_snapshots returns for the receiving
+    process to serve, and acknowledges the updates handled since the last
+    one. Unacknowledged updates of a worker that dies are routed again to
+    its replacement. With a tracker, updates already handled or in flight
+    are dropped, and the offset is committed as acknowledgements arrive.
+    """
+
+    def __init__(self, token, base_url=config.BOT_API_BASE_URL, processes=config.WORKER_PROCESSES,
+                 queue_size=config.WORKER_QUEUE_SIZE, heartbeat_interval=config.WORKER_HEARTBEAT_INTERVAL,
+                 tracker=None):
+        self.token = token
+        self.base_url = base_url
+        self.heartbeat_interval = heartbeat_interval
+        self.queue_size = queue_size
+        self.queues = [None] * processes
+        self.health = _context.Queue()
+        self.processes = [None] * processes
+        self.status = [{} for _ in range(processes)]
+        self.metrics = [{} for _ in range(processes)]
+        # Last metrics of replaced workers, so restarts do not reset the totals
+        self.retired_metrics = []
+        self.restarts = 0
+        self.tracker = tracker
+        # Raw updates routed to each worker and not acknowledged yet, by update_id
+        self.pending = [{} for _ in range(processes)]
+        # Routing runs on webhook threads while check_health replaces workers
+        self._routing = threading.Lock()
+
+    def _spawn(self, index):
+        if self.metrics[index]:
+            self.retired_metrics.append(self.metrics[index])
+            self.metrics[index] = {}
+        with self._routing:
+            # A worker killed inside get() can leave its queue locked, so every start gets a new queue
+            self.queues[index] = _context.Queue(self.queue_size)
+            process = _context.Process(
+                target=worker_main,
+                args=(index, self.token, self.base_url, self.queues[index], self.health, self.heartbeat_interval),
+                name=f'bot-worker-{index}',
+                daemon=True
+            )
+            process.start()
+            self.processes[index] = process
+            self.status[index] = {'worker': index, 'pid': process.pid, 'processed': 0, 'errors': 0, 'at': time.time()}
+
+            # The updates the previous worker took or left queued go first, in their order
+            unacknowledged = sorted(self.pending[index].items())
+            if unacknowledged:
+                logger.warning("Routing %s unacknowledged updates to worker %s again", len(unacknowledged), index)
+            for _, data in unacknowledged:
+                self.queues[index].put(data)
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self._spawn(index)
+        logger.info("Started %s worker processes", len(self.processes))
+
+    def route(self, data):
+        """Queue a raw update on its user's worker, waiting while that queue is full
+
+        Returns False for an update the tracker has seen already.
+        """
+        index = update_user_id(data) % len(self.queues)
+        with self._routing:
+            if self.tracker is not None and not self.tracker.begin(data['update_id']):
+                return False
+            self.pending[index][data['update_id']] = data
+            updates = self.queues[index]
+        updates.put(data)
+        return True
+
+    def _collect_reports(self):
+        while True:
+            try:
+                report = self.health.get_nowait()
+            except queue.Empty:
+                break
+            done = report.pop('done', [])
+            worker_metrics = report.pop('metrics', {})
+            # A replaced worker's acknowledgements still count
+            with self._routing:
+                for update_id in done:
+                    self.pending[report['worker']].pop(update_id, None)
+            if self.tracker is not None:
+                for update_id in done:
+                    self.tracker.finish(update_id)
+            # Late reports from a replaced worker are ignored
+            if report['pid'] == self.processes[report['worker']].pid:
+                self.status[report['worker']] = report
+                self.metrics[report['worker']] = worker_metrics
+
+        if self.tracker is not None:
+            self.tracker.commit()
+
+    def metric_snapshots(self):
+        """Return the latest metrics snapshot of every worker, current and replaced, as of check_health"""
+        return self.retired_metrics + [values for values in self.metrics if values]
+
+    def check_health(self):
+        """Collect heartbeats, restart workers that died and warn about stuck ones
+
+        Returns the latest status reported by each worker.
+        """
+        self._collect_reports()
+
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error("Worker %s (pid %s) exited with %s, restarting", index, process.pid, process.exitcode)
+                self.restarts += 1
+                self._spawn(index)
+            elif now - self.status[index]['at'] > self.heartbeat_interval * STALE_HEARTBEATS:
+                logger.warning("Worker %s (pid %s) has not reported for %.0fs", index, process.pid, now - self.status[index]['at'])
+
+        return list(self.status)
+
+    def stop(self, timeout=30):
+        """Let every worker finish its queue, then wait for them to exit"""
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Worker %s did not stop, terminating", process.name)
+                process.terminate()
+        self._collect_reports()
+        logger.info("Workers stopped: %s", self.status)
+
+def poll(api, pool, stopping):
+    """Long-poll getUpdates and hand every update to the pool until stopping is set"""
+    # No offset at first: it would confirm updates whose ids Telegram restarted below
+    # the stored one; the pool's tracker drops the updates handled already
+    offset = None
+    last_check = time.monotonic()
+    while not stopping.is_set():
+        try:
+            updates = api.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+        except NetworkError as error:
+            logger.warning("getUpdates failed: %s", error)
+            time.sleep(1)
+            updates = []
+
+        for update in updates:
+            pool.route(update.to_dict())
+            offset = update.update_id + 1
+
+        if time.monotonic() - last_check >= pool.heartbeat_interval:
+            pool.check_health()
+            last_check = time.monotonic()
+
+def run(token, base_url=config.BOT_API_BASE_URL):
+    """Run the bot as one receiving process and WORKER_PROCESSES handling processes."""
+    # The receiving process tracks handled updates; opening the database here also migrates it before the workers start
+    db = Database(config.DATABASE_PATH)
+    pool = WorkerPool(token, base_url, tracker=UpdateTracker(db))
+    pool.start()
+    # Apart from the offset it does no database work, so it takes the backups
+    backups = None
+    if config.BACKUP_INTERVAL:
+        backups = BackupScheduler(config.DATABASE_PATH, archive_path=config.ARCHIVE_PATH or None).start()
+
+    # Serve the workers' metrics, summed, as they arrive with their heartbeats
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = metrics.MetricsServer(
+            config.METRICS_LISTEN, config.METRICS_PORT, registry=metrics.CombinedRegistry(pool.metric_snapshots)
+        )
+        metrics_server.start()
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stopping.set())
+
+    api = telegram.Bot(token, base_url=base_url)
+    try:
+        if config.UPDATE_MODE == 'webhook':
+            secret_token = webhook_secret(config.WEBHOOK_SECRET, config.WEBHOOK_URL)
+            server = WebhookServer(
+                pool.route,
+                host=config.WEBHOOK_LISTEN,
+                port=config.WEBHOOK_PORT,
+                path=config.WEBHOOK_PATH,
+                secret_token=secret_token
+            )
+            server.start()
+            if config.WEBHOOK_URL:
+                api.set_webhook(url=config.WEBHOOK_URL, secret_token=secret_token)
+            while not stopping.wait(pool.heartbeat_interval):
+                pool.check_health()
+            server.stop()
+        else:
+            api.delete_webhook()
+            poll(api, pool, stopping)
+    finally:
+        pool.stop()
+        logger.info("Update tracking stats: %s", pool.tracker.stats())
+        db.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if backups is not None:
+            backups.stop()